@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import json
+import math
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from . import metrics
+
+
+class _Endpoint:
+    """In-flight count and recent latency of one provider-backed endpoint."""
+
+    def __init__(self, kind: str, max_inflight: int, target_s: float):
+        self.kind = kind
+        self.max_inflight = max_inflight
+        self.target_s = target_s
+        self.inflight = 0
+        self.latency_s = 0.0  # EWMA of completed requests
+        self.last_sample = 0.0
+        self.shed = 0
+
+    def recent_latency(self, now: float, decay_s: float) -> float:
+        # an old estimate says nothing about the provider now: start over
+        return self.latency_s if now - self.last_sample < decay_s else 0.0
+
+    def limit(self, now: float, decay_s: float) -> int:
+        """max_inflight, scaled down by target/latency once responses get slower than the target.
+
+        By Little's law in-flight = rate x latency, so this keeps the admitted
+        rate roughly constant while the provider is slow instead of letting
+        waiting requests pile up. At least one request is always let through to
+        notice the recovery.
+        """
+        latency = self.recent_latency(now, decay_s)
+        if latency <= self.target_s:
+            return self.max_inflight
+        return max(1, int(self.max_inflight * self.target_s / latency))
+
+
+class AdmissionControl:
+    """Decides whether a provider-backed request is started at all.
+
+    Requests to `routes` (path -> kind) are refused before they reach the
+    endpoint, so no credit is taken and nothing is queued:
+
+    - 503 while every ApiFree endpoint is behind an open breaker (`unavailable`
+      returns the seconds until one may be tried again);
+    - 503 when the kind already has as many requests in flight as its limit and
+      the limit is reduced because recent responses are slower than `target_s`;
+    - 429 when it has `max_inflight` requests in flight.
+
+    Everything else (/api/me, /health, job status) never goes through here.
+
+    Latency is time to the response head minus the time the request waited
+    in the FairScheduler line (handlers put it in `request.state.queue_wait_s`),
+    so it tracks ApiFree rather than our own queue. Streamed answers give no
+    sample: their head goes out before the provider is called.
+    """
+
+    def __init__(
+        self,
+        routes: Dict[str, str],
+        limits: Dict[str, Tuple[int, float]],  # kind -> (max_inflight, target_s)
+        unavailable: Optional[Callable[[], float]] = None,
+        alpha: float = 0.2,
+        decay_s: float = 60.0,
+    ):
+        self.routes = routes
+        self.endpoints = {kind: _Endpoint(kind, n, target_s) for kind, (n, target_s) in limits.items()}
+        self.unavailable = unavailable
+        self.alpha = alpha
+        self.decay_s = decay_s
+
+    def kind(self, scope: Scope) -> Optional[str]:
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return None
+        return self.routes.get(scope["path"])
+
+    def admit(self, kind: str) -> Optional[Tuple[int, str, float]]:
+        """None to go ahead, else (status, error, retry_after_s)."""
+        ep = self.endpoints[kind]
+        now = time.monotonic()
+        wait_s = self.unavailable() if self.unavailable is not None else 0.0
+        if wait_s > 0:
+            return self._shed(ep, 503, "provider_unavailable", wait_s)
+        limit = ep.limit(now, self.decay_s)
+        if ep.inflight < limit:
+            ep.inflight += 1
+            return None
+        retry_s = max(ep.recent_latency(now, self.decay_s), 1.0)
+        if limit < ep.max_inflight:
+            return self._shed(ep, 503, "provider_slow", retry_s)
+        return self._shed(ep, 429, "busy", retry_s)
+
+    def done(self, kind: str, latency_s: Optional[float]):
+        """The request finished; `latency_s` is its provider latency sample, None if it has none."""
+        ep = self.endpoints[kind]
+        ep.inflight -= 1
+        if latency_s is None:
+            return
+        ep.latency_s = latency_s if ep.last_sample == 0.0 else ep.latency_s + self.alpha * (latency_s - ep.latency_s)
+        ep.last_sample = time.monotonic()
+
+    def _shed(self, ep: _Endpoint, status: int, error: str, retry_s: float) -> Tuple[int, str, float]:
+        ep.shed += 1
+        metrics.ADMISSION_SHED.labels(ep.kind, error).inc()
+        return status, error, retry_s
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        now = time.monotonic()
+        return {
+            kind: {
+                "inflight": ep.inflight,
+                "limit": ep.limit(now, self.decay_s),
+                "latency_s": round(ep.recent_latency(now, self.decay_s), 3),
+                "shed": ep.shed,
+            }
+            for kind, ep in self.endpoints.items()
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware applying AdmissionControl; the request counts as in flight
+    until its response (including a streamed one) is finished."""
+
+    def __init__(self, app: ASGIApp, control: AdmissionControl):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        kind = self.control.kind(scope)
+        if kind is None:
+            await self.app(scope, receive, send)
+            return
+        rejected = self.control.admit(kind)
+        if rejected is not None:
+            await _reject(send, *rejected)
+            return
+
+        latency_s: Optional[float] = None
+        started = time.monotonic()
+
+        async def _send(message: Message):
+            nonlocal latency_s
+            if message["type"] == "http.response.start":
+                latency_s = _sample(scope, message, time.monotonic() - started)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, _send)
+        finally:
+            self.control.done(kind, latency_s)
+
+
+def _sample(scope: Scope, start: Message, elapsed_s: float) -> Optional[float]:
+    """Provider latency of a response whose head took `elapsed_s`, or None."""
+    status = start["status"]
+    # 4xx (bad input, no credits, duplicates) return before the provider is called
+    if 400 <= status < 500:
+        return None
+    headers = dict(start.get("headers") or [])
+    if headers.get(b"content-type", b"").startswith(b"text/event-stream"):
+        return None
+    queue_wait_s = (scope.get("state") or {}).get("queue_wait_s", 0.0)
+    return max(0.0, elapsed_s - queue_wait_s)
+
+
+async def _reject(send: Send, status: int, error: str, retry_s: float):
+    retry_after = min(60, math.ceil(retry_s))
+    body = json.dumps(
+        {"ok": False, "error": error, "detail": f"Сервис перегружен, попробуйте через {retry_after} с", "retry_after": retry_after},
+        ensure_ascii=False,
+    ).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", str(retry_after).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
@@ -1,7 +1,14 @@
 from __future__ import annotations
 
+import asyncio
+import json
+import random
+import time
 import httpx
-from typing import Any, Dict, List
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+from .metrics import APIFREE_RETRIES, APIFREE_SECONDS, timed
 
 
 def _normalize_base_url(base_url: str) -> str:
@@ -12,27 +19,472 @@ def _normalize_base_url(base_url: str) -> str:
     return base_url.rstrip("/")
 
 
+def _http2_available() -> bool:
+    """HTTP/2 needs the optional `h2` package (pip install httpx[http2])."""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def extract_result(kind: str, data: Dict[str, Any]) -> Tuple[Optional[str], str]:
+    """Pull (url, status) out of an ApiFree result; the schema differs between models."""
+    result = data.get("result") or {}
+    url = data.get("url") or data.get("output_url") or result.get("url") or result.get("output_url")
+    if not url:
+        key = "images" if kind == "image" else "videos"
+        items = data.get(key) or result.get(key) or []
+        if items:
+            url = items[0]
+    status = str(data.get("status") or data.get("state") or data.get("phase") or "").lower()
+    return url, status
+
+
+def extract_request_id(data: Dict[str, Any]) -> Optional[str]:
+    """Job id in a submit response or callback body; the schema differs between models."""
+    resp_data = data.get("resp_data") or {}
+    request_id = (
+        data.get("request_id")
+        or resp_data.get("request_id")
+        or data.get("id")
+        or data.get("task_id")
+        or (data.get("result") or {}).get("id")
+    )
+    return str(request_id) if request_id else None
+
+
+def is_failed(status: str) -> bool:
+    return "fail" in status or "error" in status
+
+
+def is_terminal(kind: str, data: Dict[str, Any]) -> bool:
+    url, status = extract_result(kind, data)
+    return bool(url) or is_failed(status)
+
+
+class ResultCache:
+    """TTL + LRU cache with single-flight for job result lookups.
+
+    Concurrent lookups of the same key share one provider call. Non-terminal
+    results live for `pending_ttl_s` (shorter than any poll interval), terminal
+    ones (URL present / failed) for `done_ttl_s`, evicting least recently used.
+    """
+
+    def __init__(self, pending_ttl_s: float = 1.5, done_ttl_s: float = 3600.0, max_entries: int = 5000):
+        self.pending_ttl_s = pending_ttl_s
+        self.done_ttl_s = done_ttl_s
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        hit = self._data.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return hit[1]
+
+    def put(self, key: Hashable, value: Any, terminal: bool):
+        ttl = self.done_ttl_s if terminal else self.pending_ttl_s
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def get(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], terminal: Callable[[Any], bool]) -> Any:
+        value = self.peek(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.create_task(fetch())
+            self._inflight[key] = task
+
+            def _done(t: asyncio.Task):
+                self._inflight.pop(key, None)
+                if not t.cancelled() and t.exception() is None:
+                    self.put(key, t.result(), terminal(t.result()))
+
+            task.add_done_callback(_done)
+        # shield: one impatient caller must not cancel the call others are waiting on
+        return await asyncio.shield(task)
+
+
+class ApiFreeUnavailable(RuntimeError):
+    """Every ApiFree endpoint is short-circuited by its breaker; nothing was sent."""
+
+
+class CircuitBreaker:
+    """closed -> open after `failure_threshold` consecutive failures; open -> half-open
+    after `reset_timeout_s`, when a single probe request decides between the two."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout_s: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_until = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open":
+            if now - self.opened_at < self.reset_timeout_s:
+                return False
+            self.state = "half_open"
+            self._probe_until = 0.0
+        # half-open: one probe at a time; a probe that never reports back (cancelled) expires
+        if now < self._probe_until:
+            return False
+        self._probe_until = now + self.reset_timeout_s
+        return True
+
+    def retry_in(self) -> float:
+        """Seconds until allow() may return True again (0 = now); doesn't change state."""
+        if self.state == "closed":
+            return 0.0
+        now = time.monotonic()
+        if self.state == "open":
+            return max(0.0, self.opened_at + self.reset_timeout_s - now)
+        return max(0.0, self._probe_until - now)
+
+    def success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """Caps retries and hedges at `ratio` of first attempts (plus `min_per_s`),
+    so a struggling provider doesn't get extra load from our retries."""
+
+    def __init__(self, ratio: float = 0.1, min_per_s: float = 1.0, burst: float = 10.0):
+        self.ratio = ratio
+        self.min_per_s = min_per_s
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def deposit(self):
+        self.tokens = min(self.burst, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.min_per_s)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class _Endpoint:
+    def __init__(self, base_url: str, api_key: str, breaker: CircuitBreaker):
+        self.base_url = base_url
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.breaker = breaker
+
+
+def _split(value: str) -> List[str]:
+    return [v.strip() for v in (value or "").split(",") if v.strip()]
+
+
+def _failed_response(r: httpx.Response) -> bool:
+    """Provider-side trouble (counts against the breaker, worth retrying elsewhere)."""
+    return r.status_code >= 500 or r.status_code == 429
+
+
+# Raised before the request reached ApiFree: safe to resend even non-idempotent calls.
+_NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
 class ApiFreeClient:
-    def __init__(self, base_url: str, api_key: str, timeout_s: float = 120.0):
-        self.base_url = _normalize_base_url(base_url)
-        self.api_key = api_key
+    """ApiFree HTTP client over one shared connection pool.
+
+    `base_url` / `api_key` may be comma-separated lists (one key for all URLs,
+    or one per URL). Each endpoint has a circuit breaker; calls go to the first
+    endpoint whose breaker lets them through and fail over to the next one on
+    connection errors, 5xx and 429. Result polls are retried with jittered
+    backoff, and `chat` can hedge a slow request with a second one; both spend
+    from a shared RetryBudget. With every breaker open a call raises
+    ApiFreeUnavailable immediately.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        timeout_s: float = 120.0,
+        connect_timeout_s: float = 5.0,
+        max_connections: int = 100,
+        max_keepalive_connections: int = 20,
+        keepalive_expiry_s: float = 30.0,
+        http2: bool = False,
+        result_cache: Optional[ResultCache] = None,
+        breaker_failures: int = 5,
+        breaker_reset_s: float = 30.0,
+        result_retries: int = 2,
+        retry_backoff_s: float = 0.2,
+        retry_budget: Optional[RetryBudget] = None,
+        hedge_after_s: Optional[float] = None,
+        callback_url: Optional[str] = None,
+    ):
+        urls = [_normalize_base_url(u) for u in _split(base_url)] or [_normalize_base_url(base_url)]
+        keys = _split(api_key) or [api_key]
+        if len(keys) not in (1, len(urls)):
+            raise ValueError("give one ApiFree API key or one per base URL")
+        self.endpoints = [
+            _Endpoint(url, keys[i] if len(keys) > 1 else keys[0], CircuitBreaker(breaker_failures, breaker_reset_s))
+            for i, url in enumerate(urls)
+        ]
+        self.base_url = self.endpoints[0].base_url
         self.timeout_s = timeout_s
+        self.connect_timeout_s = connect_timeout_s
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry_s,
+        )
+        self.http2 = http2 and _http2_available()
+        if http2 and not self.http2:
+            print('[apifree] HTTP/2 requested but the h2 package is missing (pip install "httpx[http2]"): using HTTP/1.1')
+        self._client: Optional[httpx.AsyncClient] = None
+        self.results = result_cache or ResultCache()
+        self.result_retries = result_retries
+        self.retry_backoff_s = retry_backoff_s
+        self.retry_budget = retry_budget or RetryBudget()
+        self.hedge_after_s = hedge_after_s or None
+        self.callback_url = callback_url or None
+
+    async def start(self):
+        """Open the shared connection pool (called from app startup)."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                headers={"Content-Type": "application/json"},
+                timeout=httpx.Timeout(self.timeout_s, connect=self.connect_timeout_s),
+                limits=self.limits,
+                http2=self.http2,
+            )
 
-    def _headers(self) -> Dict[str, str]:
-        return {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json",
-        }
+    async def aclose(self):
+        """Close the shared connection pool (called from app shutdown)."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
+    async def _http(self) -> httpx.AsyncClient:
+        # Lazily open the pool so the client also works outside the app lifecycle (scripts, REPL).
+        if self._client is None or self._client.is_closed:
+            await self.start()
+        return self._client
+
+    def breakers(self) -> Dict[str, str]:
+        return {ep.base_url: ep.breaker.state for ep in self.endpoints}
+
+    def unavailable_for(self) -> float:
+        """0 if some endpoint would take a call now, else seconds until one might."""
+        return min(ep.breaker.retry_in() for ep in self.endpoints)
+
+    # -------- endpoint selection / retries --------
+    def _pick(self, skip: List[_Endpoint], offset: int = 0) -> Optional[_Endpoint]:
+        """First endpoint (rotated by `offset`) that isn't in `skip` and whose breaker allows a call."""
+        n = len(self.endpoints)
+        for i in range(n):
+            ep = self.endpoints[(offset + i) % n]
+            if ep not in skip and ep.breaker.allow():
+                return ep
+        return None
+
+    async def _request(
+        self,
+        method: str,
+        path: str,
+        json: Optional[Dict[str, Any]] = None,
+        retries: int = 0,
+        idempotent: bool = True,
+        offset: int = 0,
+    ) -> httpx.Response:
+        """Send one logical request with failover and (budgeted) retries.
+
+        Non-idempotent calls (submits) are only resent when the previous attempt
+        never reached ApiFree; everything else also retries after timeouts / 5xx.
+        4xx other than 429 are the caller's problem and raise right away.
+        """
+        client = await self._http()
+        self.retry_budget.deposit()
+        attempts = 1 + max(retries, len(self.endpoints) - 1)
+        failed: List[_Endpoint] = []
+        error: Optional[Exception] = None
+        for attempt in range(attempts):
+            ep = self._pick(failed, offset) or self._pick([], offset)
+            if ep is None:
+                APIFREE_RETRIES.labels("short_circuit").inc()
+                raise error or ApiFreeUnavailable("ApiFree is unavailable (circuit open)")
+            if attempt:
+                if not self.retry_budget.withdraw():
+                    APIFREE_RETRIES.labels("budget_exhausted").inc()
+                    raise error
+                if ep in failed:
+                    # same endpoint again: back off (full jitter) instead of hammering it
+                    await asyncio.sleep(random.uniform(0, self.retry_backoff_s * 2 ** attempt))
+                APIFREE_RETRIES.labels("retry" if ep in failed else "failover").inc()
+            try:
+                r = await client.request(method, ep.base_url + path, json=json, headers=ep.headers)
+            except httpx.TransportError as e:
+                ep.breaker.failure()
+                if not idempotent and not isinstance(e, _NOT_SENT):
+                    raise
+                error = e
+            else:
+                if not _failed_response(r):
+                    ep.breaker.success()
+                    r.raise_for_status()
+                    return r
+                ep.breaker.failure()
+                try:
+                    r.raise_for_status()
+                except httpx.HTTPStatusError as e:
+                    if not idempotent:
+                        raise
+                    error = e
+            if ep not in failed:
+                failed.append(ep)
+        raise error
+
+    # -------- calls --------
+    @timed(APIFREE_SECONDS, "chat")
     async def chat(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.7) -> str:
-        url = f"{self.base_url}/v1/chat/completions"
         payload: Dict[str, Any] = {"model": model, "messages": messages, "temperature": temperature}
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.post(url, headers=self._headers(), json=payload)
-            r.raise_for_status()
-            data = r.json()
-            return data["choices"][0]["message"]["content"]
+        if self.hedge_after_s is None:
+            return await self._chat_once(payload)
+        return await self._chat_hedged(payload)
+
+    async def _chat_once(self, payload: Dict[str, Any], offset: int = 0) -> str:
+        r = await self._request("POST", "/v1/chat/completions", json=payload, offset=offset)
+        data = r.json()
+        return data["choices"][0]["message"]["content"]
 
+    async def _chat_hedged(self, payload: Dict[str, Any]) -> str:
+        """If the first request is slower than hedge_after_s, race a second one
+        (on the next endpoint when there is one) and take whichever answers first."""
+        pending = {asyncio.create_task(self._chat_once(payload))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=self.hedge_after_s)
+            if done:
+                return done.pop().result()
+            if self.retry_budget.withdraw():
+                APIFREE_RETRIES.labels("hedge").inc()
+                pending.add(asyncio.create_task(self._chat_once(payload, offset=1)))
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        return t.result()
+                    error = t.exception()
+            raise error
+        finally:
+            for t in pending:
+                t.cancel()
+
+    async def chat_stream(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.7) -> AsyncIterator[str]:
+        """Like chat(), but yields the completion in pieces as ApiFree streams it (stream: true).
+
+        Fails over to the next endpoint only until the stream is open; a stream
+        that breaks halfway raises (the caller already showed part of the answer).
+        """
+        payload: Dict[str, Any] = {"model": model, "messages": messages, "temperature": temperature, "stream": True}
+        client = await self._http()
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            failed: List[_Endpoint] = []
+            while True:
+                ep = self._pick(failed)
+                if ep is None:
+                    if failed:
+                        raise ApiFreeUnavailable("ApiFree stream failed on every endpoint")
+                    APIFREE_RETRIES.labels("short_circuit").inc()
+                    raise ApiFreeUnavailable("ApiFree is unavailable (circuit open)")
+                req = client.build_request("POST", ep.base_url + "/v1/chat/completions", json=payload, headers=ep.headers)
+                try:
+                    r = await client.send(req, stream=True)
+                except httpx.TransportError:
+                    ep.breaker.failure()
+                    failed.append(ep)
+                    APIFREE_RETRIES.labels("failover").inc()
+                    continue
+                if _failed_response(r):
+                    await r.aclose()
+                    ep.breaker.failure()
+                    failed.append(ep)
+                    if len(failed) == len(self.endpoints):
+                        r.raise_for_status()
+                    APIFREE_RETRIES.labels("failover").inc()
+                    continue
+                ep.breaker.success()
+                break
+            try:
+                r.raise_for_status()
+                if "text/event-stream" not in r.headers.get("content-type", ""):
+                    # model/provider ignored stream=true: one regular JSON completion
+                    data = json.loads(await r.aread())
+                    yield data["choices"][0]["message"]["content"]
+                    outcome = "ok"
+                    return
+                async for line in r.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(data)
+                    except ValueError:
+                        continue
+                    choices = chunk.get("choices") or []
+                    if not choices:
+                        continue
+                    piece = (choices[0].get("delta") or {}).get("content")
+                    if piece:
+                        yield piece
+                outcome = "ok"
+            except httpx.TransportError:
+                ep.breaker.failure()
+                raise
+            finally:
+                await r.aclose()
+        finally:
+            APIFREE_SECONDS.labels("chat_stream", outcome).observe(time.perf_counter() - started)
+
+    def _with_callback(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Ask ApiFree to POST the finished job to our callback endpoint (if configured)."""
+        if not self.callback_url:
+            return payload
+        return {**payload, "callback_url": self.callback_url}
+
+    @timed(APIFREE_SECONDS, "image_submit")
     async def image_submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """Submit an image job.
 
@@ -41,30 +493,35 @@ class ApiFreeClient:
         - {model, prompt, negative_prompt, width, height, num_images}
         - {prompt, image, image_url, aspect_ratio, resolution, ...}
         """
-        url = f"{self.base_url}/v1/image/submit"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.post(url, headers=self._headers(), json=payload)
-            r.raise_for_status()
-            return r.json()
+        r = await self._request("POST", "/v1/image/submit", json=self._with_callback(payload), idempotent=False)
+        return r.json()
 
     async def image_result(self, request_id: str) -> Dict[str, Any]:
-        url = f"{self.base_url}/v1/image/{request_id}/result"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.get(url, headers=self._headers())
-            r.raise_for_status()
-            return r.json()
+        return await self.results.get(
+            ("image", request_id),
+            lambda: self._fetch_image_result(request_id),
+            lambda data: is_terminal("image", data),
+        )
+
+    @timed(APIFREE_SECONDS, "image_result")
+    async def _fetch_image_result(self, request_id: str) -> Dict[str, Any]:
+        r = await self._request("GET", f"/v1/image/{request_id}/result", retries=self.result_retries)
+        return r.json()
 
+    @timed(APIFREE_SECONDS, "video_submit")
     async def video_submit(self, payload: Dict[str, Any]) -> Dict[str, Any]:
         """Submit a video job (payload passed through as-is)."""
-        url = f"{self.base_url}/v1/video/submit"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.post(url, headers=self._headers(), json=payload)
-            r.raise_for_status()
-            return r.json()
+        r = await self._request("POST", "/v1/video/submit", json=self._with_callback(payload), idempotent=False)
+        return r.json()
 
     async def video_result(self, request_id: str) -> Dict[str, Any]:
-        url = f"{self.base_url}/v1/video/{request_id}/result"
-        async with httpx.AsyncClient(timeout=self.timeout_s) as client:
-            r = await client.get(url, headers=self._headers())
-            r.raise_for_status()
-            return r.json()
+        return await self.results.get(
+            ("video", request_id),
+            lambda: self._fetch_video_result(request_id),
+            lambda data: is_terminal("video", data),
+        )
+
+    @timed(APIFREE_SECONDS, "video_result")
+    async def _fetch_video_result(self, request_id: str) -> Dict[str, Any]:
+        r = await self._request("GET", f"/v1/video/{request_id}/result", retries=self.result_retries)
+        return r.json()
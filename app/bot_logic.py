@@ -1,13 +1,22 @@
 from __future__ import annotations
 
+import asyncio
+import html
 import re
+import time
 from typing import Any, Dict, Optional, List
 from .storage import Storage
 from .telegram_api import TelegramAPI
 from .apifree_client import ApiFreeClient
 from .config import settings
+from .chat_cache import ChatCache
+from .conversation import ConversationMemory
+from .idempotency import DuplicateInProgress, Idempotency
+from .scheduler import FairScheduler, QueueFull
 
 START_RE = re.compile(r"^/start(?:\s+(.+))?$")
+NEW_RE = re.compile(r"^/(?:new|reset)(?:@\w+)?$")
+TG_TEXT_CHUNK = 3500  # raw chars per message; stays under Telegram's 4096 after HTML escaping
 
 def _main_menu(webapp_url: str) -> Dict[str, Any]:
     return {
@@ -59,22 +68,153 @@ async def ensure_user(storage: Storage, tg_user: Dict[str, Any], start_payload:
         except Exception:
             referred_by = None
 
-    # create user
-    await storage.upsert_user(
+    # create user + referral bonuses (only on first signup) in one transaction
+    await storage.signup_user(
         tg_id=tg_id,
         username=username,
         first_name=first_name,
         credits_free=settings.FREE_CREDITS_ON_SIGNUP,
         referred_by=referred_by,
+        referrer_bonus=settings.REF_BONUS_REFERRER,
+        new_user_bonus=settings.REF_BONUS_NEW_USER,
     )
 
-    # apply referral bonuses only on first signup
-    if referred_by and referred_by != tg_id:
-        # give referrer +1, new user +1 (extra)
-        await storage.add_credits(referred_by, free_delta=settings.REF_BONUS_REFERRER)
-        await storage.add_credits(tg_id, free_delta=settings.REF_BONUS_NEW_USER)
+def is_priority(tg_id: int, bucket: Optional[str]) -> bool:
+    """PRO purchases promise priority: requests paid with a PRO credit (and admins') go first."""
+    return bucket == "pro" or tg_id in settings.admin_ids()
 
-async def handle_update(storage: Storage, tg: TelegramAPI, apifree: ApiFreeClient, update: Dict[str, Any]):
+def _ms(started: float) -> int:
+    return int((time.monotonic() - started) * 1000)
+
+def _split_text(text: str) -> List[str]:
+    return [text[i:i + TG_TEXT_CHUNK] for i in range(0, len(text), TG_TEXT_CHUNK)]
+
+async def _send_answer(tg: TelegramAPI, chat_id: int, answer: str):
+    """A whole answer as one or more messages; the menu goes under the last one."""
+    chunks = _split_text(answer) or ["…"]
+    menu = _main_menu(_webapp_url())
+    for i, chunk in enumerate(chunks, start=1):
+        await tg.send_message(chat_id, html.escape(chunk, quote=False), reply_markup=menu if i == len(chunks) else None)
+
+async def stream_answer(tg: TelegramAPI, apifree: ApiFreeClient, chat_id: int, messages: List[Dict[str, str]]) -> str:
+    """Stream a completion into a "⌛ Думаю..." placeholder, editing it as tokens arrive.
+
+    Edits are throttled to CHAT_STREAM_EDIT_INTERVAL_S and never overlap, so one
+    answer costs a handful of editMessageText calls regardless of its length.
+    """
+    sent = await tg.send_message(chat_id, "⌛ Думаю...")
+    message_id = sent["result"]["message_id"]
+    answer = ""
+    last_edit = time.monotonic()
+    edit: Optional[asyncio.Task] = None
+    try:
+        async for piece in apifree.chat_stream(settings.APIFREE_CHAT_MODEL, messages):
+            answer += piece
+            now = time.monotonic()
+            if now - last_edit >= settings.CHAT_STREAM_EDIT_INTERVAL_S and (edit is None or edit.done()) and len(answer) <= TG_TEXT_CHUNK:
+                last_edit = now
+                edit = asyncio.create_task(tg.edit_message_text(chat_id, message_id, html.escape(answer, quote=False) + " ▌"))
+    finally:
+        if edit is not None:
+            await asyncio.gather(edit, return_exceptions=True)
+
+    chunks = _split_text(answer) or ["…"]
+    menu = _main_menu(_webapp_url())
+    await tg.edit_message_text(chat_id, message_id, html.escape(chunks[0], quote=False), reply_markup=menu if len(chunks) == 1 else None)
+    for i, chunk in enumerate(chunks[1:], start=2):
+        await tg.send_message(chat_id, html.escape(chunk, quote=False), reply_markup=menu if i == len(chunks) else None)
+    return answer
+
+async def chat_reply(
+    storage: Storage,
+    tg: TelegramAPI,
+    apifree: ApiFreeClient,
+    chat_id: int,
+    from_user: Dict[str, Any],
+    text: str,
+    chat_cache: Optional[ChatCache] = None,
+    scheduler: Optional[FairScheduler] = None,
+    memory: Optional[ConversationMemory] = None,
+):
+    """Answer a plain text message with a chat completion (one credit)."""
+    await ensure_user(storage, from_user, None)
+    started = time.monotonic()
+    # context and cache lookups come before charging: if they fail, no credit is lost
+    if memory is not None:
+        messages = await memory.messages(chat_id, text)
+    else:
+        messages = [{"role": "user", "content": text}]
+    cache_key, cached = None, None
+    if chat_cache is not None:
+        cache_key, cached = await chat_cache.get(settings.APIFREE_CHAT_MODEL, messages)
+
+    bucket = await storage.consume_credit(chat_id, reason="chat")
+    if not bucket:
+        await tg.send_message(chat_id, "⚠️ У тебя закончились кредиты. Нажми ⭐ PRO или пригласи друга 🎁", reply_markup=_main_menu(_webapp_url()))
+        return
+    if cached is not None:
+        storage.record_chat_job(chat_id, text, cached, duration_ms=_ms(started), cached=True)
+        if memory is not None:
+            await memory.remember(chat_id, text, cached)
+        await _send_answer(tg, chat_id, cached)
+        return
+
+    ticket = None
+    if scheduler is not None:
+        try:
+            ticket = scheduler.ticket("chat", chat_id, priority=is_priority(chat_id, bucket))
+        except QueueFull:
+            await storage.refund_credit(chat_id, bucket, reason="chat")
+            await tg.send_message(chat_id, "🚦 Сейчас очень много запросов. Попробуй через минуту.")
+            return
+    try:
+        if ticket is not None and not ticket.granted:
+            await tg.send_message(chat_id, f"⏳ Ты в очереди: {ticket.position()}")
+            await ticket.wait()
+        if settings.CHAT_STREAMING:
+            try:
+                answer = await stream_answer(tg, apifree, chat_id, messages)
+            except Exception as e:
+                storage.record_chat_job(chat_id, text, str(e), status="failed", duration_ms=_ms(started))
+                await storage.refund_credit(chat_id, bucket, reason="chat")
+                raise
+            storage.record_chat_job(chat_id, text, answer, duration_ms=_ms(started))
+            if chat_cache is not None:
+                await chat_cache.put(cache_key, settings.APIFREE_CHAT_MODEL, answer)
+            if memory is not None:
+                await memory.remember(chat_id, text, answer)
+            return
+
+        await tg.send_message(chat_id, "⌛ Думаю...")
+        try:
+            answer = await apifree.chat(
+                model=settings.APIFREE_CHAT_MODEL,
+                messages=messages,
+            )
+        except Exception as e:
+            storage.record_chat_job(chat_id, text, str(e), status="failed", duration_ms=_ms(started))
+            await storage.refund_credit(chat_id, bucket, reason="chat")
+            raise
+        storage.record_chat_job(chat_id, text, answer, duration_ms=_ms(started))
+        if chat_cache is not None:
+            await chat_cache.put(cache_key, settings.APIFREE_CHAT_MODEL, answer)
+        if memory is not None:
+            await memory.remember(chat_id, text, answer)
+        await _send_answer(tg, chat_id, answer)
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+async def handle_update(
+    storage: Storage,
+    tg: TelegramAPI,
+    apifree: ApiFreeClient,
+    update: Dict[str, Any],
+    chat_cache: Optional[ChatCache] = None,
+    scheduler: Optional[FairScheduler] = None,
+    memory: Optional[ConversationMemory] = None,
+    idempotency: Optional[Idempotency] = None,
+):
     # message
     if "message" in update:
         msg = update["message"]
@@ -92,22 +232,42 @@ async def handle_update(storage: Storage, tg: TelegramAPI, apifree: ApiFreeClien
             )
             return
 
-        # plain text -> chat (quick mode)
-        if text:
-            await ensure_user(storage, msg["from"], None)
-            ok = await storage.consume_credit(chat_id)
-            if not ok:
-                await tg.send_message(chat_id, "⚠️ У тебя закончились кредиты. Нажми ⭐ PRO или пригласи друга 🎁", reply_markup=_main_menu(_webapp_url()))
+        if NEW_RE.match(text or ""):
+            if memory is None:
+                await tg.send_message(chat_id, "ℹ️ Память диалога выключена: на каждое сообщение я и так отвечаю с чистого листа.")
                 return
+            await memory.reset(chat_id)
+            await tg.send_message(chat_id, "🧹 Начинаем новый диалог — прошлые сообщения я больше не учитываю.")
+            return
 
-            await tg.send_message(chat_id, "⌛ Думаю...")
-            answer = await apifree.chat(
-                model=settings.APIFREE_CHAT_MODEL,
-                messages=[{"role": "user", "content": text}],
-            )
-            await tg.send_message(chat_id, answer, reply_markup=_main_menu(_webapp_url()))
+        # plain text -> chat (quick mode)
+        if text:
+            # Telegram redelivers an update it got no 2xx for: answer (and charge) it once
+            claim = None
+            if idempotency is not None and "update_id" in update:
+                claim, ttl_s, _ = idempotency.key("update", chat_id, str(update["update_id"]))
+                try:
+                    if await idempotency.begin(claim, chat_id, ttl_s) is not None:
+                        return
+                except DuplicateInProgress:
+                    return
+            try:
+                await chat_reply(storage, tg, apifree, chat_id, msg["from"], text, chat_cache, scheduler, memory)
+            except BaseException:
+                if claim is not None:
+                    await idempotency.abort(claim)
+                raise
+            if claim is not None:
+                await idempotency.finish(claim, {"ok": True})
             return
 
+    # the user blocked / unblocked the bot: broadcasts skip blocked users
+    if "my_chat_member" in update:
+        mcm = update["my_chat_member"]
+        if mcm["chat"].get("type") == "private":
+            await storage.set_blocked([mcm["chat"]["id"]], blocked=mcm["new_chat_member"]["status"] == "kicked")
+        return
+
     # callback query
     if "callback_query" in update:
         cq = update["callback_query"]
@@ -147,7 +307,9 @@ async def handle_update(storage: Storage, tg: TelegramAPI, apifree: ApiFreeClien
             await tg.answer_callback_query(cq["id"])
             await tg.send_message(
                 chat_id,
-                "🛟 <b>Как пользоваться</b>\n\n"                "1) Напиши текст — получишь ответ ChatGPT\n"                "2) Для фото/видео удобнее через Mini‑App (⚡)\n"                "3) Хочешь больше бесплатных генераций — нажми 🎁 и пригласи друга\n\n"                "Если что-то не работает — проверь токены и домен (Render env vars).",
+                "🛟 <b>Как пользоваться</b>\n\n"                "1) Напиши текст — получишь ответ ChatGPT"
+                + (" (я помню разговор; /new — начать заново)" if memory is not None else "")
+                + "\n"                "2) Для фото/видео удобнее через Mini‑App (⚡)\n"                "3) Хочешь больше бесплатных генераций — нажми 🎁 и пригласи друга\n\n"                "Если что-то не работает — проверь токены и домен (Render env vars).",
 
                 reply_markup=_main_menu(_webapp_url()),
             )
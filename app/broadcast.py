@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+from .jobs import worker_id
+from .storage import Storage
+from .telegram_api import PRIORITY_LOW, TelegramAPI, TelegramAPIError
+
+# Telegram rejects longer messages/captions outright, so every send of the broadcast would fail
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+
+def _unreachable(e: TelegramAPIError) -> bool:
+    """The user blocked the bot / deleted the account: don't try them again."""
+    description = (e.description or "").lower()
+    return e.error_code == 403 or (e.error_code == 400 and ("chat not found" in description or "user is deactivated" in description))
+
+
+class Broadcaster:
+    """Sends an admin message to every reachable user.
+
+    Users are walked in tg_id order one page at a time (keyset over the primary
+    key, the table is never loaded whole) and every page is queued on
+    TelegramAPI at PRIORITY_LOW: the shared rate limiter sends it as fast as
+    Telegram allows while replies to users still go first. Progress (cursor and
+    counters) is saved after each page under a lease, like jobs, so after a
+    restart any worker resumes where the broadcast stopped. Users Telegram
+    reports as unreachable are marked blocked and skipped from then on.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        tg: TelegramAPI,
+        page_size: int = 100,
+        lease_s: float = 60.0,
+        check_interval_s: float = 10.0,
+    ):
+        self.storage = storage
+        self.tg = tg
+        self.page_size = page_size
+        self.lease_s = lease_s
+        self.check_interval_s = check_interval_s
+        self.owner = worker_id()
+        self._running: Dict[int, Dict[str, Any]] = {}  # id -> live state of broadcasts sent by this worker
+        self._wakeup = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self, grace_s: float = 10.0):
+        # no new claims first, or the loop would pick a broadcast up again once its page is done
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        running = list(self._running.values())  # done callbacks empty _running
+        # let in-flight pages finish and be counted, so a resume doesn't send them twice
+        self._stopping.set()
+        pages = [st["task"] for st in running]
+        if pages:
+            await asyncio.wait(pages, timeout=grace_s)
+        for t in pages:
+            t.cancel()
+        await asyncio.gather(*pages, return_exceptions=True)
+        # hand the broadcasts back right away (lease in the past) with their progress
+        for st in running:
+            await self._save(st, lease_until=0.0)
+        self._running.clear()
+
+    async def create(self, created_by: int, text: str, photo: Optional[str] = None) -> Dict[str, Any]:
+        row = await self.storage.create_broadcast(created_by, text, photo)
+        self._wakeup.set()
+        return row
+
+    async def cancel(self, broadcast_id: int) -> bool:
+        ok = await self.storage.cancel_broadcast(broadcast_id)
+        st = self._running.get(broadcast_id)
+        if ok and st is not None:
+            st["task"].cancel()
+        return ok
+
+    async def progress(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Recent broadcasts with progress; `per_s`/`eta_s` are live for ones sent here."""
+        rows = await self.storage.list_broadcasts(limit)
+        out = []
+        for row in rows:
+            st = self._running.get(row["id"])
+            if st is not None:
+                row.update(cursor=st["cursor"], sent=st["sent"], failed=st["failed"], blocked=st["blocked"])
+                elapsed = time.monotonic() - st["started"]
+                per_s = (st["sent"] + st["failed"] + st["blocked"] - st["done_at_start"]) / elapsed if elapsed > 0 else 0.0
+            else:
+                per_s = self._average_rate(row)
+            handled = row["sent"] + row["failed"] + row["blocked"]
+            left = max(0, row["total"] - handled)
+            row["per_s"] = round(per_s, 2)
+            row["eta_s"] = round(left / per_s) if row["status"] == "running" and per_s > 0 else None
+            row.pop("owner", None)
+            row.pop("lease_expires_at", None)
+            out.append(row)
+        return out
+
+    @staticmethod
+    def _average_rate(row: Dict[str, Any]) -> float:
+        started = datetime.fromisoformat(row["created_at"]).replace(tzinfo=timezone.utc).timestamp()
+        ended = (
+            datetime.fromisoformat(row["finished_at"]).replace(tzinfo=timezone.utc).timestamp()
+            if row["finished_at"] else time.time()
+        )
+        handled = row["sent"] + row["failed"] + row["blocked"]
+        return handled / (ended - started) if ended > started else 0.0
+
+    # -------- internals --------
+    async def _loop(self):
+        while True:
+            try:
+                now = time.time()
+                for row in await self.storage.claim_broadcasts(self.owner, now + self.lease_s, now):
+                    if row["id"] not in self._running:
+                        self._resume(row)
+                # renew leases between pages too: a page can wait long behind user traffic
+                for st in list(self._running.values()):
+                    if not await self._save(st):
+                        st["task"].cancel()
+            except Exception as e:
+                print("[broadcast] claim failed:", e)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.check_interval_s)
+            except asyncio.TimeoutError:
+                pass
+
+    def _resume(self, row: Dict[str, Any]):
+        st = {
+            "row": row,
+            "cursor": row["cursor"],
+            "sent": row["sent"],
+            "failed": row["failed"],
+            "blocked": row["blocked"],
+            "done_at_start": row["sent"] + row["failed"] + row["blocked"],
+            "started": time.monotonic(),
+        }
+        st["task"] = asyncio.create_task(self._run(st))
+        st["task"].add_done_callback(lambda _t: self._running.pop(row["id"], None))
+        self._running[row["id"]] = st
+        if row["cursor"]:
+            print(f"[broadcast] resuming #{row['id']} after tg_id {row['cursor']}")
+
+    async def _save(self, st: Dict[str, Any], lease_until: Optional[float] = None, done: bool = False) -> bool:
+        return await self.storage.save_broadcast(
+            st["row"]["id"], self.owner, st["cursor"], st["sent"], st["failed"], st["blocked"],
+            time.time() + self.lease_s if lease_until is None else lease_until,
+            done=done,
+        )
+
+    async def _run(self, st: Dict[str, Any]):
+        row = st["row"]
+        try:
+            while True:
+                ids = await self.storage.user_ids_after(st["cursor"], self.page_size)
+                if not ids:
+                    await self._save(st, done=True)
+                    print(f"[broadcast] #{row['id']} done: sent={st['sent']} failed={st['failed']} blocked={st['blocked']}")
+                    return
+                results = await asyncio.gather(*(self._send_one(tg_id, row) for tg_id in ids))
+                blocked = [tg_id for tg_id, r in zip(ids, results) if r == "blocked"]
+                await self.storage.set_blocked(blocked)
+                st["sent"] += results.count("sent")
+                st["failed"] += results.count("failed")
+                st["blocked"] += len(blocked)
+                st["cursor"] = ids[-1]
+                if not await self._save(st):
+                    return  # cancelled, or another worker took it over
+                if self._stopping.is_set():
+                    return
+        except Exception as e:
+            # progress up to the last page is saved; the next claim round picks it up again
+            print(f"[broadcast] #{row['id']} stopped:", e)
+
+    async def _send_one(self, tg_id: int, row: Dict[str, Any]) -> str:
+        try:
+            if row["photo"]:
+                await self.tg.send_photo(tg_id, row["photo"], caption=row["text"], priority=PRIORITY_LOW)
+            else:
+                await self.tg.send_message(tg_id, row["text"], priority=PRIORITY_LOW)
+            return "sent"
+        except TelegramAPIError as e:
+            return "blocked" if _unreachable(e) else "failed"
+        except Exception:
+            return "failed"
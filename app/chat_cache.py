@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from .storage import Storage
+
+_WS_RE = re.compile(r"\s+")
+
+
+def _normalize(text: str) -> str:
+    return _WS_RE.sub(" ", text).strip().lower()
+
+
+class ChatCache:
+    """Two-tier cache of chat completions: in-memory LRU in front of a SQLite table.
+
+    Only models listed in `models` ("*" = all) are cached, only for short prompts
+    and only when temperature <= max_temperature (creative sampling is not cached).
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        models: str = "",
+        ttl_s: float = 86400.0,
+        memory_size: int = 1000,
+        max_rows: int = 50000,
+        max_temperature: float = 0.7,
+        max_prompt_chars: int = 500,
+    ):
+        self.storage = storage
+        self.models = {m.strip() for m in models.split(",") if m.strip()}
+        self.ttl_s = ttl_s
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self.max_temperature = max_temperature
+        self.max_prompt_chars = max_prompt_chars
+        self._mem: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self._puts = 0
+        self.hits = 0
+        self.misses = 0
+        self.bypass = 0
+
+    def key(self, model: str, messages: List[Dict[str, str]], temperature: float) -> Optional[str]:
+        """Cache key, or None if this request must not be cached."""
+        if not self.models or ("*" not in self.models and model not in self.models):
+            return None
+        if temperature > self.max_temperature:
+            return None
+        if sum(len(m.get("content") or "") for m in messages) > self.max_prompt_chars:
+            return None
+        norm = [[m.get("role", ""), _normalize(m.get("content") or "")] for m in messages]
+        raw = json.dumps([model, round(temperature, 2), norm], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.7) -> Tuple[Optional[str], Optional[str]]:
+        """Return (key, cached answer). key is None when the request bypasses the cache."""
+        key = self.key(model, messages, temperature)
+        if key is None:
+            self.bypass += 1
+            return None, None
+        now = time.time()
+        hit = self._mem.get(key)
+        if hit is not None:
+            if hit[0] > now:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return key, hit[1]
+            del self._mem[key]
+        row = await self.storage.chat_cache_get(key, now)
+        if row is not None:
+            self._remember(key, row[1], row[0])
+            self.hits += 1
+            return key, row[1]
+        self.misses += 1
+        return key, None
+
+    async def put(self, key: Optional[str], model: str, answer: str):
+        if key is None or not answer:
+            return
+        expires_at = time.time() + self.ttl_s
+        self._remember(key, answer, expires_at)
+        await self.storage.chat_cache_put(key, model, answer, expires_at)
+        self._puts += 1
+        if self._puts % 100 == 0:
+            await self.storage.chat_cache_evict(time.time(), self.max_rows)
+
+    def _remember(self, key: str, answer: str, expires_at: float):
+        self._mem[key] = (expires_at, answer)
+        self._mem.move_to_end(key)
+        while len(self._mem) > self.memory_size:
+            self._mem.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "bypass": self.bypass, "memory_entries": len(self._mem)}
@@ -9,18 +9,93 @@ class Settings(BaseSettings):
 
     # Telegram
     BOT_TOKEN: str = Field(..., description="Telegram bot token from BotFather")
-    PUBLIC_BASE_URL: str = Field(..., description="Public HTTPS base URL for webhooks, e.g. https://xxx.onrender.com")
+    PUBLIC_BASE_URL: str = Field(default="", description="Public HTTPS base URL for webhooks/Mini App, e.g. https://xxx.onrender.com")
     WEBHOOK_SECRET: str = Field(default="hook", description="Secret path segment for webhook")
+    TG_UPDATES_MODE: str = Field(default="webhook", description="How updates arrive: webhook | polling (getUpdates, no public URL needed)")
+    TG_POLL_TIMEOUT_S: int = Field(default=50, description="getUpdates long-poll timeout")
+    TG_POLL_LIMIT: int = Field(default=100, description="Updates per getUpdates batch (max 100)")
+    TG_POLL_BATCH_WAIT_S: float = Field(default=10.0, description="Max wait for a batch to be handled before fetching the next")
+    TG_API_BASE_URL: str = Field(default="https://api.telegram.org", description="Bot API server (local bot-api server or a test double)")
+    TG_GLOBAL_RATE: float = Field(default=30.0, description="Max outgoing messages per second for the whole bot")
+    APP_PROCESSES: int = Field(default=1, description="Processes sending with this bot token (uvicorn --workers x instances); TG_GLOBAL_RATE is split between them")
+    TG_PER_CHAT_RATE: float = Field(default=1.0, description="Max outgoing messages per second per private chat")
+    TG_PER_CHAT_BURST: float = Field(default=3.0)
+    TG_SEND_WORKERS: int = Field(default=8)
+    TG_MAX_RETRIES: int = Field(default=5, description="Retries on 429 (retry_after) / connect errors")
+    TG_UPLOAD_TIMEOUT_S: float = Field(default=300.0, description="Timeout of multipart media uploads")
+    TG_UPLOAD_WORKERS: int = Field(default=4, description="Media uploads in flight; they run apart from TG_SEND_WORKERS so replies never wait behind a file")
+    MEDIA_RELAY: bool = Field(default=True, description="Upload results to Telegram ourselves instead of passing the provider URL")
+    MEDIA_CHUNK_KB: int = Field(default=256, description="Chunk size when streaming a result from the provider to Telegram")
+    UPDATE_WORKERS: int = Field(default=8, description="Workers running handle_update (chats are processed in parallel)")
+    UPDATE_QUEUE_MAX: int = Field(default=1000, description="Queued updates before the webhook answers 429")
 
     # ApiFree
-    APIFREE_API_KEY: str = Field(..., description="ApiFree API key")
-    APIFREE_BASE_URL: str = Field(default="https://api.apifree.ai", description="ApiFree base URL")
+    APIFREE_API_KEY: str = Field(..., description="ApiFree API key (or one per base URL, comma-separated)")
+    APIFREE_BASE_URL: str = Field(default="https://api.apifree.ai", description="ApiFree base URL (comma-separated list = failover order)")
     APIFREE_CHAT_MODEL: str = Field(default="gpt-4o-mini")
+    CHAT_STREAMING: bool = Field(default=True, description="Stream chat answers (stream: true) into an edited message")
+    CHAT_STREAM_EDIT_INTERVAL_S: float = Field(default=1.5, description="Min seconds between editMessageText while streaming")
+    CHAT_CACHE_MODELS: str = Field(default="", description="Comma-separated chat models whose answers are cached ('*' = all, empty = off)")
+    CHAT_CACHE_TTL_S: float = Field(default=86400.0)
+    CHAT_CACHE_MEMORY_SIZE: int = Field(default=1000, description="Entries kept in the in-memory LRU tier")
+    CHAT_CACHE_MAX_ROWS: int = Field(default=50000, description="Rows kept in the SQLite tier")
+    CHAT_CACHE_MAX_TEMPERATURE: float = Field(default=0.7, description="Requests with a higher temperature bypass the cache")
+    CHAT_MEMORY: bool = Field(default=False, description="Multi-turn chat: earlier turns (and a rolling summary) are sent with each message")
+    CHAT_MEMORY_TOKENS: int = Field(default=1500, description="Token budget of the context sent with a chat message")
+    CHAT_MEMORY_SUMMARY_TOKENS: int = Field(default=300, description="Max size of the rolling summary of older turns")
+    CHAT_MEMORY_IDLE_S: float = Field(default=86400.0, description="A conversation idle this long starts over")
+    CHAT_MEMORY_MAX_TURNS: int = Field(default=40, description="Hard cap on stored turns per user (if compaction keeps failing)")
     APIFREE_IMAGE_MODEL: str = Field(default="stable-diffusion-xl")
     APIFREE_VIDEO_MODEL: str = Field(default="runway-gen2")
+    APIFREE_TIMEOUT_S: float = Field(default=120.0, description="Read/write timeout for provider calls")
+    APIFREE_CONNECT_TIMEOUT_S: float = Field(default=5.0)
+    APIFREE_MAX_CONNECTIONS: int = Field(default=100)
+    APIFREE_MAX_KEEPALIVE: int = Field(default=20)
+    APIFREE_HTTP2: bool = Field(default=False, description="Use HTTP/2 (needs the h2 package: pip install httpx[http2])")
+    APIFREE_RESULT_TTL_S: float = Field(default=1.5, description="Cache TTL of in-progress image/video results")
+    APIFREE_RESULT_DONE_TTL_S: float = Field(default=3600.0, description="Cache TTL of finished/failed results")
+    APIFREE_RESULT_CACHE_SIZE: int = Field(default=5000)
+    APIFREE_BREAKER_FAILURES: int = Field(default=5, description="Consecutive failures that open an endpoint's circuit")
+    APIFREE_BREAKER_RESET_S: float = Field(default=30.0, description="How long a circuit stays open before a probe request")
+    APIFREE_RESULT_RETRIES: int = Field(default=2, description="Retries of image/video result polls (jittered backoff)")
+    APIFREE_RETRY_BUDGET: float = Field(default=0.1, description="Retries + hedges allowed per first attempt")
+    APIFREE_HEDGE_AFTER_S: float = Field(default=0.0, description="Send a second chat request if the first is slower than this (0 = off)")
+    APIFREE_CALLBACK_SECRET: str = Field(default="", description="Secret path segment of /apifree/callback/{secret}; set it (with PUBLIC_BASE_URL) to get results pushed instead of polled")
+
+    # Admission scheduler (provider calls; 0 = no cap)
+    SCHED_CHAT_CONCURRENCY: int = Field(default=32, description="Chat completions in flight")
+    SCHED_IMAGE_CONCURRENCY: int = Field(default=8, description="Image submits in flight")
+    SCHED_VIDEO_CONCURRENCY: int = Field(default=4, description="Video submits in flight")
+    SCHED_PER_USER: int = Field(default=2, description="Slots one user can hold per kind")
+    SCHED_PRIORITY_WEIGHT: int = Field(default=4, description="PRO/admin requests admitted per normal one when both wait")
+    SCHED_MAX_WAITING: int = Field(default=500, description="Waiting requests per kind before new ones are refused")
+    SHED_CHAT_INFLIGHT: int = Field(default=128, description="/api/chat requests in flight (waiting included) before new ones get 429")
+    SHED_IMAGE_INFLIGHT: int = Field(default=64, description="/api/image/submit requests in flight before new ones get 429")
+    SHED_VIDEO_INFLIGHT: int = Field(default=32, description="/api/video/submit requests in flight before new ones get 429")
+    SHED_CHAT_LATENCY_S: float = Field(default=30.0, description="Recent /api/chat latency above which its in-flight limit shrinks (503)")
+    SHED_SUBMIT_LATENCY_S: float = Field(default=15.0, description="Same for image/video submits")
+    IDEMPOTENCY_WINDOW_S: float = Field(default=30.0, description="Identical image/video submits within this window return the first result (no Idempotency-Key)")
+    IDEMPOTENCY_KEY_TTL_S: float = Field(default=86400.0, description="How long an Idempotency-Key is remembered")
 
     # Storage
     DB_PATH: str = Field(default="./data/app.db")
+    DB_READ_CONNECTIONS: int = Field(default=4, description="Read connections kept open next to the single writer")
+    DB_CACHE_MB: int = Field(default=16)
+    DB_MMAP_MB: int = Field(default=128)
+    USER_CACHE_SIZE: int = Field(default=10000, description="Users kept in the in-process cache")
+    USER_CACHE_TTL_S: float = Field(default=60.0)
+
+    # Job poller (image/video results)
+    JOB_POLL_CONCURRENCY: int = Field(default=16, description="Max provider result calls in flight")
+    JOB_POLL_MIN_S: float = Field(default=2.0)
+    JOB_POLL_MAX_S: float = Field(default=15.0)
+    JOB_SAFETY_POLL_S: float = Field(default=60.0, description="Poll interval when ApiFree callbacks are on (safety net for lost callbacks)")
+    JOB_IMAGE_TIMEOUT_S: float = Field(default=240.0)
+    JOB_VIDEO_TIMEOUT_S: float = Field(default=360.0)
+    JOB_LEASE_S: float = Field(default=60.0, description="A crashed worker's jobs are taken over after this long")
+    JOB_CLAIM_INTERVAL_S: float = Field(default=10.0, description="How often leases are renewed and free jobs claimed")
+    JOB_MAX_LOCAL: int = Field(default=2000, description="Max jobs one worker polls at a time")
+    JOB_HISTORY_DAYS: float = Field(default=30.0, description="Finished jobs older than this are deleted (0 = keep forever)")
 
     # Credits / Referral
     FREE_CREDITS_ON_SIGNUP: int = Field(default=2)
@@ -33,6 +108,7 @@ class Settings(BaseSettings):
     # Stars / PRO (optional)
     PRICE_PRO_XTR: int = Field(default=0, description="Telegram Stars price (XTR). 0 disables purchase button.")
     ADMIN_IDS: str = Field(default="")
+    BROADCAST_PAGE_SIZE: int = Field(default=100, description="Users fetched and queued per broadcast step (progress is saved after each)")
 
     def admin_ids(self) -> List[int]:
         if not self.ADMIN_IDS.strip():
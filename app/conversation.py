@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Dict, List, Optional
+
+from .apifree_client import ApiFreeClient
+from .scheduler import FairScheduler, QueueFull
+from .storage import Storage
+
+MESSAGE_OVERHEAD = 4  # role/separator tokens the chat format adds per message
+COMPACTION_USER = "memory-compaction"  # scheduler user id shared by all compactions
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткую память диалога. Сожми разговор ниже в резюме до {words} слов: "
+    "факты о пользователе, его цели, договорённости и открытые вопросы. "
+    "Пиши по-русски, без вступлений, только резюме."
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count without a tokenizer.
+
+    ~4 characters per token for ASCII text and ~2 for Cyrillic (and other
+    multi-byte) text; UTF-8 byte count minus character count is a cheap way
+    to tell how many characters are non-ASCII.
+    """
+    extra = len(text.encode("utf-8")) - len(text)
+    return 1 + (len(text) - extra) // 4 + extra // 2
+
+
+def _clip(text: str, max_tokens: int) -> str:
+    while text and estimate_tokens(text) > max_tokens:
+        text = text[: int(len(text) * 0.9)]
+    return text
+
+
+class ConversationMemory:
+    """Per-user chat context that stays within a token budget.
+
+    The last turns are stored verbatim in one SQLite row per user; `messages`
+    puts as many of the newest ones as fit in `budget_tokens` in front of the
+    new message, after the rolling summary of older ones. Once stored turns go
+    over budget, the older half is folded into the summary by a background
+    completion, so prompt size is bounded regardless of conversation length.
+
+    Compactions go through the scheduler's chat queue as one shared user
+    (COMPACTION_USER), so together they hold at most its per-user slots and
+    take their turn behind every waiting user request.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        apifree: ApiFreeClient,
+        model: str,
+        budget_tokens: int = 1500,
+        summary_tokens: int = 300,
+        idle_s: float = 86400.0,
+        max_turns: int = 40,
+        compactions: int = 2,
+        scheduler: Optional[FairScheduler] = None,
+    ):
+        self.storage = storage
+        self.apifree = apifree
+        self.model = model
+        self.budget_tokens = budget_tokens
+        self.summary_tokens = summary_tokens
+        self.idle_s = idle_s
+        self.max_turns = max_turns
+        self.scheduler = scheduler
+        self._sem = asyncio.Semaphore(compactions)
+        self._compacting: Dict[int, asyncio.Task] = {}
+        self.compacted = 0
+
+    async def messages(self, tg_id: int, text: str) -> List[Dict[str, str]]:
+        """Prompt for a new user message: [summary] + recent turns + the message."""
+        current = {"role": "user", "content": text}
+        state = await self.storage.get_conversation(tg_id)
+        if state is None or state["updated_at"] <= time.time() - self.idle_s:
+            return [current]
+        budget = self.budget_tokens - estimate_tokens(text) - MESSAGE_OVERHEAD
+        head: List[Dict[str, str]] = []
+        if state["summary"]:
+            content = f"Краткое содержание предыдущего разговора: {state['summary']}"
+            budget -= estimate_tokens(content) + MESSAGE_OVERHEAD
+            head.append({"role": "system", "content": content})
+        history: List[Dict[str, str]] = []
+        for role, content, tokens in reversed(state["turns"]):
+            budget -= tokens + MESSAGE_OVERHEAD
+            if budget < 0:
+                break
+            history.append({"role": role, "content": content})
+        history.reverse()
+        return head + history + [current]
+
+    async def remember(self, tg_id: int, text: str, answer: str):
+        """Store one exchange; schedule compaction when the stored turns are over budget."""
+        turns = [["user", text, estimate_tokens(text)], ["assistant", answer, estimate_tokens(answer)]]
+        tokens = await self.storage.append_conversation(tg_id, turns, time.time(), self.idle_s, self.max_turns)
+        if tokens > self.budget_tokens and tg_id not in self._compacting:
+            task = asyncio.create_task(self._compact(tg_id))
+            self._compacting[tg_id] = task
+            task.add_done_callback(lambda _t: self._compacting.pop(tg_id, None))
+
+    async def reset(self, tg_id: int):
+        await self.storage.clear_conversation(tg_id)
+
+    async def aclose(self):
+        tasks = list(self._compacting.values())
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _compact(self, tg_id: int):
+        try:
+            async with self._sem:
+                state = await self.storage.get_conversation(tg_id)
+                if state is None:
+                    return
+                turns = state["turns"]
+                # the newest turns that fit in half the budget stay verbatim
+                keep, kept = len(turns), 0
+                while keep > 0 and kept + turns[keep - 1][2] <= self.budget_tokens // 2:
+                    keep -= 1
+                    kept += turns[keep][2]
+                old = turns[:keep]
+                if not old:
+                    return
+                transcript = "\n".join(
+                    f"{'Пользователь' if role == 'user' else 'Ассистент'}: {content}" for role, content, _ in old
+                )
+                if state["summary"]:
+                    transcript = f"Прежнее резюме: {state['summary']}\n\n{transcript}"
+                prompt = [
+                    {"role": "system", "content": SUMMARY_PROMPT.format(words=self.summary_tokens // 2)},
+                    {"role": "user", "content": transcript},
+                ]
+                summary = await self._summarize(prompt)
+                if await self.storage.compact_conversation(tg_id, old, _clip(summary.strip(), self.summary_tokens)):
+                    self.compacted += 1
+        except QueueFull:
+            pass  # busy: the next remember() tries again
+        except Exception as e:
+            print(f"[memory] compaction for {tg_id} failed:", e)
+
+    async def _summarize(self, prompt: List[Dict[str, str]]) -> str:
+        if self.scheduler is None:
+            return await self.apifree.chat(self.model, prompt, temperature=0.2)
+        async with self.scheduler.ticket("chat", COMPACTION_USER):
+            return await self.apifree.chat(self.model, prompt, temperature=0.2)
+
+    def stats(self) -> Dict[str, int]:
+        return {"compacting": len(self._compacting), "compacted": self.compacted}
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Set
+
+
+def sse(data: Dict[str, Any], event: Optional[str] = None) -> str:
+    """Format one Server-Sent Events frame."""
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class EventHub:
+    """In-process pub/sub for job status events (fan-out to SSE streams).
+
+    Subscribers get a bounded queue; a slow client loses its oldest events
+    rather than growing memory (the final event is always the newest one).
+    """
+
+    def __init__(self, max_queue: int = 100):
+        self.max_queue = max_queue
+        self._subs: Dict[Hashable, Set[asyncio.Queue]] = {}
+
+    def subscribe(self, key: Hashable) -> asyncio.Queue:
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.max_queue)
+        self._subs.setdefault(key, set()).add(q)
+        return q
+
+    def unsubscribe(self, key: Hashable, q: asyncio.Queue):
+        subs = self._subs.get(key)
+        if subs is None:
+            return
+        subs.discard(q)
+        if not subs:
+            del self._subs[key]
+
+    def subscribers(self) -> int:
+        return sum(len(s) for s in self._subs.values())
+
+    def publish(self, keys: Iterable[Hashable], event: Dict[str, Any]):
+        for key in keys:
+            for q in self._subs.get(key, ()):
+                if q.full():
+                    q.get_nowait()
+                q.put_nowait(event)
+
+    async def stream(
+        self,
+        key: Hashable,
+        initial: Optional[Dict[str, Any]] = None,
+        until_terminal: bool = False,
+        heartbeat_s: float = 15.0,
+        on_idle: Optional[Callable[[], Awaitable[Optional[Dict[str, Any]]]]] = None,
+    ) -> AsyncIterator[str]:
+        """Yield SSE frames for `key`.
+
+        `on_idle` runs at every heartbeat and may return an event to emit, which
+        lets a stream notice state it didn't get pushed (e.g. finished elsewhere).
+        """
+        q = self.subscribe(key)
+        try:
+            yield "retry: 3000\n\n"
+            if initial is not None:
+                yield sse(initial)
+                if until_terminal and initial.get("terminal"):
+                    return
+            while True:
+                try:
+                    event = await asyncio.wait_for(q.get(), timeout=heartbeat_s)
+                except asyncio.TimeoutError:
+                    event = await on_idle() if on_idle else None
+                    if event is None:
+                        yield ": ping\n\n"
+                        continue
+                yield sse(event)
+                if until_terminal and event.get("terminal"):
+                    return
+        finally:
+            self.unsubscribe(key, q)
@@ -0,0 +1,116 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from .storage import Storage
+
+
+class DuplicateInProgress(RuntimeError):
+    """The same request is still being processed (e.g. by another worker)."""
+
+
+class KeyReused(ValueError):
+    """An Idempotency-Key came back with a different request body."""
+
+
+class Idempotency:
+    """Duplicate suppression for requests that spend credits and provider capacity.
+
+    A request is identified by its `Idempotency-Key` header (kept `key_ttl_s`) or,
+    without one, by a hash of tg_id + body (kept `window_s`, catches double taps).
+    A key is bound to the body hash it first came with; reusing it for another
+    body raises KeyReused instead of replaying an unrelated response.
+    The first request claims the key in the `idempotency` table and stores its
+    response; repeats get that response back. A repeat arriving while the first
+    is still running waits for it in-process (up to `wait_s`), or gets
+    DuplicateInProgress when the first runs elsewhere.
+
+        replay = await idem.begin(key, tg_id, ttl_s, body_hash)
+        if replay is not None:
+            return replay
+        ... do the work ...
+        await idem.finish(key, response)   # or idem.abort(key) on failure
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        window_s: float = 30.0,
+        key_ttl_s: float = 86400.0,
+        lease_s: float = 300.0,
+        wait_s: float = 30.0,
+    ):
+        self.storage = storage
+        self.window_s = window_s
+        self.key_ttl_s = key_ttl_s
+        self.lease_s = lease_s
+        self.wait_s = wait_s
+        self._running: Dict[str, asyncio.Future] = {}
+        self._claims = 0
+        self.replayed = 0
+
+    def key(self, scope: str, tg_id: int, idempotency_key: Optional[str], payload: Any = None) -> Tuple[str, float, Optional[str]]:
+        """(key, ttl_s, body_hash) of a request: the client's key if given, else a hash of
+        the body. body_hash is only set with a client key (otherwise it is the key)."""
+        body = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+        if idempotency_key:
+            raw = f"{scope}:{tg_id}:key:{idempotency_key}"
+            return _sha256(raw), self.key_ttl_s, _sha256(body)
+        return _sha256(f"{scope}:{tg_id}:body:{body}"), self.window_s, None
+
+    async def begin(self, key: str, tg_id: int, ttl_s: float, body_hash: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Claim the key (returns None: go ahead) or return the stored response of the
+        first request. Raises DuplicateInProgress if it is still running elsewhere and
+        KeyReused if it was first used with another body."""
+        deadline = time.monotonic() + self.wait_s
+        while True:
+            now = time.time()
+            existing = await self.storage.idem_claim(key, tg_id, body_hash, now, now + ttl_s, now - self.lease_s)
+            if existing is None:
+                self._running[key] = asyncio.get_running_loop().create_future()
+                self._claims += 1
+                if self._claims % 100 == 0:
+                    await self.storage.idem_evict(now)
+                return None
+            if body_hash and existing["body_hash"] and existing["body_hash"] != body_hash:
+                raise KeyReused(key)
+            if existing["response_json"] is not None:
+                self.replayed += 1
+                return json.loads(existing["response_json"])
+            running = self._running.get(key)
+            left = deadline - time.monotonic()
+            if running is None or left <= 0:
+                raise DuplicateInProgress(key)
+            try:
+                await asyncio.wait_for(asyncio.shield(running), left)
+            except asyncio.TimeoutError:
+                raise DuplicateInProgress(key)
+            # the first request finished or gave up: look again
+
+    async def finish(self, key: str, response: Dict[str, Any]):
+        try:
+            await self.storage.idem_finish(key, json.dumps(response, ensure_ascii=False, default=str))
+        finally:
+            self._wake(key)
+
+    async def abort(self, key: str):
+        try:
+            await self.storage.idem_release(key)
+        finally:
+            self._wake(key)
+
+    def _wake(self, key: str):
+        running = self._running.pop(key, None)
+        if running is not None and not running.done():
+            running.set_result(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"running": len(self._running), "replayed": self.replayed}
+
+
+def _sha256(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
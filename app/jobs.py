@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import json
+import os
+import socket
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from .storage import Storage
+from .telegram_api import TelegramAPI, PRIORITY_NORMAL
+from .apifree_client import ApiFreeClient, extract_result, is_failed
+from .events import EventHub
+from .media import MediaRelay
+
+
+@dataclass
+class _Job:
+    id: int
+    tg_id: int
+    kind: str  # image/video
+    request_id: str
+    deliver: bool
+    deadline: float  # wall clock, so it survives restarts
+    interval: float
+    status: str = "pending"  # last provider status seen
+    next_poll_at: float = 0.0  # wall clock, persisted with lease renewals
+    due: float = 0.0  # monotonic time of its live heap entry; older entries are stale
+
+
+def job_event(job_id: int, kind: str, request_id: str, status: str, url: Optional[str] = None) -> Dict[str, Any]:
+    """Payload pushed to SSE subscribers."""
+    return {
+        "job_id": job_id,
+        "kind": kind,
+        "request_id": request_id,
+        "status": status,
+        "url": url,
+        "terminal": status in ("done", "failed", "timeout"),
+    }
+
+
+def worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class JobPoller:
+    """One loop that polls every pending image/video job and delivers results to Telegram.
+
+    Jobs live in the `jobs` table and are leased: a process polls only the jobs it
+    owns, renews its leases every `claim_interval_s` and claims pending jobs whose
+    lease expired (their owner crashed) or was released (clean shutdown). That
+    makes it safe to run several workers/instances and to deploy mid-generation.
+    Each job is re-polled with its own backoff (min_interval_s growing to
+    max_interval_s) and at most `concurrency` provider calls run at once.
+    Finished jobs older than `history_days` are swept from the table hourly.
+
+    When ApiFree calls back on completion (`complete`), polling is only a safety
+    net: start it with a long min_interval_s.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        tg: TelegramAPI,
+        apifree: ApiFreeClient,
+        concurrency: int = 16,
+        min_interval_s: float = 2.0,
+        max_interval_s: float = 15.0,
+        backoff: float = 1.5,
+        timeouts_s: Optional[Dict[str, float]] = None,
+        events: Optional[EventHub] = None,
+        lease_s: float = 60.0,
+        claim_interval_s: float = 10.0,
+        max_local_jobs: int = 2000,
+        max_claims: int = 20,
+        media: Optional[MediaRelay] = None,
+        history_days: float = 30.0,
+        sweep_interval_s: float = 3600.0,
+    ):
+        self.storage = storage
+        self.tg = tg
+        self.apifree = apifree
+        self.events = events
+        self.media = media
+        self.min_interval_s = min_interval_s
+        self.max_interval_s = max_interval_s
+        self.backoff = backoff
+        self.timeouts_s = timeouts_s or {"image": 240.0, "video": 360.0}
+        self.lease_s = lease_s
+        self.claim_interval_s = claim_interval_s
+        self.max_local_jobs = max_local_jobs
+        self.max_claims = max_claims
+        self.history_days = history_days
+        self.sweep_interval_s = sweep_interval_s
+        self._next_sweep = 0.0
+        self.owner = worker_id()
+        self._sem = asyncio.Semaphore(concurrency)
+        self._heap: List[Tuple[float, int]] = []
+        self._jobs: Dict[int, _Job] = {}
+        self._by_request: Dict[str, int] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._lease_task: Optional[asyncio.Task] = None
+        self._inflight: set = set()
+
+    # -------- lifecycle --------
+    async def start(self):
+        """Reclaim orphaned jobs, then start the poll and lease loops."""
+        claimed = await self._claim()
+        if claimed:
+            print(f"[jobs] {self.owner} resumed {claimed} pending job(s)")
+        self._task = asyncio.create_task(self._run())
+        self._lease_task = asyncio.create_task(self._lease_loop())
+
+    async def stop(self):
+        tasks = [t for t in (self._task, self._lease_task) if t is not None]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = self._lease_task = None
+        # let in-flight polls finish their DB writes / deliveries
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+        # hand unfinished jobs back right away instead of waiting for lease expiry
+        await self.storage.release_jobs(self.owner)
+        self._jobs.clear()
+        self._by_request.clear()
+        self._heap.clear()
+
+    def pending(self) -> Dict[str, int]:
+        out: Dict[str, int] = {}
+        for j in self._jobs.values():
+            out[j.kind] = out.get(j.kind, 0) + 1
+        return out
+
+    def snapshot(self, request_id: str) -> Optional[Dict[str, Any]]:
+        """Current state of a job this poller is tracking (None if not tracked)."""
+        job = self._jobs.get(self._by_request.get(request_id, -1))
+        if job is None:
+            return None
+        return job_event(job.id, job.kind, job.request_id, job.status)
+
+    # -------- API --------
+    async def submit(self, tg_id: int, kind: str, request_id: str, deliver: bool = True, prompt: str = "") -> int:
+        """Record a submitted provider job (leased to this process) and start tracking it."""
+        payload = {"deliver": deliver, "prompt": prompt[:500]}
+        now = time.time()
+        job_id = await self.storage.create_job(
+            tg_id, kind, request_id, payload,
+            owner=self.owner,
+            lease_expires_at=now + self.lease_s,
+            next_poll_at=now + self.min_interval_s,
+        )
+        job = _Job(
+            id=job_id,
+            tg_id=tg_id,
+            kind=kind,
+            request_id=request_id,
+            deliver=deliver,
+            deadline=now + self.timeouts_s.get(kind, 300.0),
+            interval=self.min_interval_s,
+        )
+        self._schedule(job, delay=self.min_interval_s)
+        self._publish(job, "pending")
+        if deliver:
+            icon = "🧠" if kind == "image" else "🎬"
+            self._spawn(self._notify(tg_id, f"{icon} Задача принята. ID: <code>{request_id}</code>\nЖду результат…"))
+        return job_id
+
+    async def complete(self, row: Dict[str, Any], data: Dict[str, Any]) -> str:
+        """Apply a provider callback to a pending job row: a final result is delivered
+        right away (by whichever worker got the callback), otherwise the status is
+        pushed to subscribers. Returns the status seen."""
+        url, status = extract_result(row["kind"], data)
+        if not url and not is_failed(status):
+            # the callback only said "something changed": look the result up once
+            fetch = self.apifree.video_result if row["kind"] == "video" else self.apifree.image_result
+            data = await fetch(row["request_id"])
+            url, status = extract_result(row["kind"], data)
+        job = self._jobs.get(row["id"]) or self._job_from_row(row)
+        if url:
+            self._untrack(job)
+            # deliver in the background: the provider shouldn't wait for our Telegram upload
+            self._spawn(self._finish(job, "done", url))
+            return "done"
+        if is_failed(status):
+            self._untrack(job)
+            self._spawn(self._finish(job, "failed", None, detail=str(data)[:3500]))
+            return "failed"
+        if status and status != job.status:
+            job.status = status
+            self._publish(job, status)
+        return status or "pending"
+
+    def _job_from_row(self, row: Dict[str, Any]) -> _Job:
+        payload = json.loads(row["payload_json"] or "{}")
+        created = datetime.fromisoformat(row["created_at"]).replace(tzinfo=timezone.utc).timestamp()
+        return _Job(
+            id=row["id"],
+            tg_id=row["tg_id"],
+            kind=row["kind"],
+            request_id=row["request_id"],
+            deliver=bool(payload.get("deliver", True)),
+            deadline=created + self.timeouts_s.get(row["kind"], 300.0),
+            interval=self.min_interval_s,
+        )
+
+    # -------- leasing --------
+    async def _claim(self) -> int:
+        room = self.max_local_jobs - len(self._jobs)
+        if room <= 0:
+            return 0
+        now = time.time()
+        rows = await self.storage.claim_jobs(self.owner, now + self.lease_s, now, room)
+        for row in rows:
+            job = self._job_from_row(row)
+            if row["attempts"] > self.max_claims:
+                # claimed over and over without finishing: something crashes on it
+                self._spawn(self._finish(job, "failed", None, detail="job abandoned after repeated claims"))
+                continue
+            self._schedule(job, delay=max(0.0, (row["next_poll_at"] or now) - now))
+        return len(rows)
+
+    async def _lease_loop(self):
+        while True:
+            await asyncio.sleep(self.claim_interval_s)
+            try:
+                now = time.time()
+                owned = await self.storage.renew_job_leases(
+                    self.owner,
+                    now + self.lease_s,
+                    [(j.next_poll_at, j.id) for j in self._jobs.values()],
+                )
+                for job in [j for j in self._jobs.values() if j.id not in owned]:
+                    # lease lost (we stalled past lease_s) or finished elsewhere
+                    self._untrack(job)
+                await self._claim()
+            except Exception as e:
+                print("[jobs] lease renewal failed:", e)
+            if self.history_days > 0 and time.monotonic() >= self._next_sweep:
+                self._next_sweep = time.monotonic() + self.sweep_interval_s
+                await self._sweep()
+
+    async def _sweep(self):
+        """Retention: drop finished jobs older than history_days so history stays small."""
+        cutoff = datetime.utcnow() - timedelta(days=self.history_days)
+        try:
+            deleted = await self.storage.sweep_jobs(cutoff.isoformat())
+            if deleted:
+                print(f"[jobs] retention sweep removed {deleted} finished job(s)")
+        except Exception as e:
+            print("[jobs] retention sweep failed:", e)
+
+    # -------- internals --------
+    def _spawn(self, coro):
+        t = asyncio.create_task(coro)
+        self._inflight.add(t)
+        t.add_done_callback(self._inflight.discard)
+        return t
+
+    def _publish(self, job: _Job, status: str, url: Optional[str] = None):
+        if self.events is not None:
+            self.events.publish(
+                [("job", job.request_id), ("user", job.tg_id)],
+                job_event(job.id, job.kind, job.request_id, status, url),
+            )
+
+    def _untrack(self, job: _Job):
+        self._jobs.pop(job.id, None)
+        self._by_request.pop(job.request_id, None)
+
+    def _schedule(self, job: _Job, delay: float):
+        self._jobs[job.id] = job
+        self._by_request[job.request_id] = job.id
+        job.next_poll_at = time.time() + delay
+        job.due = time.monotonic() + delay
+        heapq.heappush(self._heap, (job.due, job.id))
+        self._wakeup.set()
+
+    async def _notify(self, tg_id: int, text: str):
+        try:
+            await self.tg.send_message(tg_id, text, priority=PRIORITY_NORMAL)
+        except Exception as e:
+            print("[jobs] notify failed:", e)
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            due, job_id = self._heap[0]
+            wait = due - time.monotonic()
+            if wait > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is None or job.due != due:
+                continue  # untracked, or rescheduled/re-claimed since this entry was pushed
+            await self._sem.acquire()
+            self._spawn(self._poll(job))
+
+    async def _poll(self, job: _Job):
+        try:
+            await self._poll_once(job)
+        except Exception as e:
+            print(f"[jobs] poll {job.request_id} failed:", e)
+            self._reschedule(job)
+        finally:
+            self._sem.release()
+
+    def _reschedule(self, job: _Job):
+        if job.id not in self._jobs:
+            return  # lease lost meanwhile
+        if time.time() >= job.deadline:
+            self._untrack(job)
+            self._spawn(self._finish(job, "timeout", None))
+            return
+        job.interval = min(self.max_interval_s, job.interval * self.backoff)
+        self._schedule(job, delay=job.interval)
+
+    async def _poll_once(self, job: _Job):
+        try:
+            if job.kind == "video":
+                data = await self.apifree.video_result(job.request_id)
+            else:
+                data = await self.apifree.image_result(job.request_id)
+        except Exception:
+            # transient provider issues happen; keep polling with backoff
+            self._reschedule(job)
+            return
+        url, status = extract_result(job.kind, data)
+        # deliver outside the poll slot: a slow Telegram upload shouldn't hold up polling
+        if url:
+            self._untrack(job)
+            self._spawn(self._finish(job, "done", url))
+        elif is_failed(status):
+            self._untrack(job)
+            self._spawn(self._finish(job, "failed", None, detail=str(data)[:3500]))
+        else:
+            if status and status != job.status:
+                job.status = status
+                self._publish(job, status)
+            self._reschedule(job)
+
+    async def _finish(self, job: _Job, status: str, url: Optional[str], detail: str = ""):
+        if not await self.storage.finish_job(job.id, status, url):
+            return  # another worker already finished (and delivered) it
+        self._publish(job, status, url)
+        if not job.deliver:
+            return
+        if status == "done":
+            try:
+                if self.media is not None:
+                    await self.media.deliver(job.tg_id, job.kind, url, caption="✅ Готово!", request_id=job.request_id)
+                elif job.kind == "video":
+                    await self.tg.send_video(job.tg_id, url, caption="✅ Готово!")
+                else:
+                    await self.tg.send_photo(job.tg_id, url, caption="✅ Готово!")
+            except Exception as e:
+                # Telegram couldn't fetch the file: at least give the user the link
+                print("[jobs] media send failed:", e)
+                await self._notify(job.tg_id, f"✅ Готово! {url}")
+        elif status == "failed":
+            await self._notify(job.tg_id, f"❌ Ошибка генерации: <pre>{detail}</pre>")
+        else:
+            await self._notify(job.tg_id, "⌛ Не дождалась результата (timeout). Попробуй ещё раз.")
@@ -1,27 +1,195 @@
 from __future__ import annotations
 
+import hmac
+import json
 import os
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse, HTMLResponse
-from fastapi.staticfiles import StaticFiles
+import time
+from typing import Optional
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, HTMLResponse, StreamingResponse, Response
 from .config import settings
 from .storage import Storage
 from .telegram_api import TelegramAPI
-from .apifree_client import ApiFreeClient
-from .bot_logic import handle_update
+from .admission import AdmissionControl, AdmissionMiddleware
+from .apifree_client import ApiFreeClient, ResultCache, RetryBudget, extract_request_id
+from .bot_logic import handle_update, is_priority
+from .jobs import JobPoller, job_event
+from .events import EventHub, sse
+from .broadcast import CAPTION_LIMIT, TEXT_LIMIT, Broadcaster
+from .chat_cache import ChatCache
+from .conversation import ConversationMemory
+from .idempotency import DuplicateInProgress, Idempotency, KeyReused
+from .media import MediaRelay
+from .scheduler import FairScheduler, QueueFull
+from .static import PrecompressedStatic
+from . import metrics
+from .updates import LongPoller, UpdateDispatcher
 
 app = FastAPI(title="Creator Kristina Bot (ApiFree)")
 
-storage = Storage(settings.DB_PATH)
-tg = TelegramAPI(settings.BOT_TOKEN)
-apifree = ApiFreeClient(settings.APIFREE_BASE_URL, settings.APIFREE_API_KEY)
+storage = Storage(
+    settings.DB_PATH,
+    read_connections=settings.DB_READ_CONNECTIONS,
+    cache_mb=settings.DB_CACHE_MB,
+    mmap_mb=settings.DB_MMAP_MB,
+    user_cache_size=settings.USER_CACHE_SIZE,
+    user_cache_ttl_s=settings.USER_CACHE_TTL_S,
+)
+tg = TelegramAPI(
+    settings.BOT_TOKEN,
+    # the rate limiter is per process: each one gets its share of the bot-wide limit
+    global_rate=settings.TG_GLOBAL_RATE / max(1, settings.APP_PROCESSES),
+    per_chat_rate=settings.TG_PER_CHAT_RATE,
+    per_chat_burst=settings.TG_PER_CHAT_BURST,
+    send_workers=settings.TG_SEND_WORKERS,
+    max_retries=settings.TG_MAX_RETRIES,
+    api_base=settings.TG_API_BASE_URL,
+    upload_timeout_s=settings.TG_UPLOAD_TIMEOUT_S,
+    upload_workers=settings.TG_UPLOAD_WORKERS,
+)
+# ApiFree pushes finished jobs to /apifree/callback/{secret}; polling becomes a slow safety net
+APIFREE_CALLBACKS = bool(settings.APIFREE_CALLBACK_SECRET and settings.PUBLIC_BASE_URL)
+apifree = ApiFreeClient(
+    settings.APIFREE_BASE_URL,
+    settings.APIFREE_API_KEY,
+    timeout_s=settings.APIFREE_TIMEOUT_S,
+    connect_timeout_s=settings.APIFREE_CONNECT_TIMEOUT_S,
+    max_connections=settings.APIFREE_MAX_CONNECTIONS,
+    max_keepalive_connections=settings.APIFREE_MAX_KEEPALIVE,
+    http2=settings.APIFREE_HTTP2,
+    result_cache=ResultCache(
+        pending_ttl_s=settings.APIFREE_RESULT_TTL_S,
+        done_ttl_s=settings.APIFREE_RESULT_DONE_TTL_S,
+        max_entries=settings.APIFREE_RESULT_CACHE_SIZE,
+    ),
+    breaker_failures=settings.APIFREE_BREAKER_FAILURES,
+    breaker_reset_s=settings.APIFREE_BREAKER_RESET_S,
+    result_retries=settings.APIFREE_RESULT_RETRIES,
+    retry_budget=RetryBudget(ratio=settings.APIFREE_RETRY_BUDGET),
+    hedge_after_s=settings.APIFREE_HEDGE_AFTER_S,
+    callback_url=(
+        f"{settings.PUBLIC_BASE_URL.rstrip('/')}/apifree/callback/{settings.APIFREE_CALLBACK_SECRET}"
+        if APIFREE_CALLBACKS else None
+    ),
+)
+chat_cache = ChatCache(
+    storage,
+    models=settings.CHAT_CACHE_MODELS,
+    ttl_s=settings.CHAT_CACHE_TTL_S,
+    memory_size=settings.CHAT_CACHE_MEMORY_SIZE,
+    max_rows=settings.CHAT_CACHE_MAX_ROWS,
+    max_temperature=settings.CHAT_CACHE_MAX_TEMPERATURE,
+)
+idempotency = Idempotency(
+    storage,
+    window_s=settings.IDEMPOTENCY_WINDOW_S,
+    key_ttl_s=settings.IDEMPOTENCY_KEY_TTL_S,
+)
+scheduler = FairScheduler(
+    {
+        "chat": settings.SCHED_CHAT_CONCURRENCY,
+        "image": settings.SCHED_IMAGE_CONCURRENCY,
+        "video": settings.SCHED_VIDEO_CONCURRENCY,
+    },
+    per_user=settings.SCHED_PER_USER,
+    priority_weight=settings.SCHED_PRIORITY_WEIGHT,
+    max_waiting=settings.SCHED_MAX_WAITING,
+)
+memory = None
+if settings.CHAT_MEMORY:
+    memory = ConversationMemory(
+        storage,
+        apifree,
+        settings.APIFREE_CHAT_MODEL,
+        budget_tokens=settings.CHAT_MEMORY_TOKENS,
+        summary_tokens=settings.CHAT_MEMORY_SUMMARY_TOKENS,
+        idle_s=settings.CHAT_MEMORY_IDLE_S,
+        max_turns=settings.CHAT_MEMORY_MAX_TURNS,
+        scheduler=scheduler,
+    )
+# refuses provider-backed requests up front (no credit taken) when ApiFree is down, slow or saturated
+admission = AdmissionControl(
+    routes={"/api/chat": "chat", "/api/image/submit": "image", "/api/video/submit": "video"},
+    limits={
+        "chat": (settings.SHED_CHAT_INFLIGHT, settings.SHED_CHAT_LATENCY_S),
+        "image": (settings.SHED_IMAGE_INFLIGHT, settings.SHED_SUBMIT_LATENCY_S),
+        "video": (settings.SHED_VIDEO_INFLIGHT, settings.SHED_SUBMIT_LATENCY_S),
+    },
+    unavailable=apifree.unavailable_for,
+)
+app.add_middleware(AdmissionMiddleware, control=admission)
+job_events = EventHub()
+media = MediaRelay(storage, tg, relay=settings.MEDIA_RELAY, chunk_kb=settings.MEDIA_CHUNK_KB)
+poller = JobPoller(
+    storage,
+    tg,
+    apifree,
+    concurrency=settings.JOB_POLL_CONCURRENCY,
+    min_interval_s=settings.JOB_SAFETY_POLL_S if APIFREE_CALLBACKS else settings.JOB_POLL_MIN_S,
+    max_interval_s=max(settings.JOB_POLL_MAX_S, settings.JOB_SAFETY_POLL_S) if APIFREE_CALLBACKS else settings.JOB_POLL_MAX_S,
+    timeouts_s={"image": settings.JOB_IMAGE_TIMEOUT_S, "video": settings.JOB_VIDEO_TIMEOUT_S},
+    events=job_events,
+    lease_s=settings.JOB_LEASE_S,
+    claim_interval_s=settings.JOB_CLAIM_INTERVAL_S,
+    max_local_jobs=settings.JOB_MAX_LOCAL,
+    media=media,
+    history_days=settings.JOB_HISTORY_DAYS,
+)
+
+broadcaster = Broadcaster(storage, tg, page_size=settings.BROADCAST_PAGE_SIZE, lease_s=settings.JOB_LEASE_S)
+
+updates = UpdateDispatcher(
+    lambda update: handle_update(
+        storage, tg, apifree, update,
+        chat_cache=chat_cache, scheduler=scheduler, memory=memory, idempotency=idempotency,
+    ),
+    workers=settings.UPDATE_WORKERS,
+    max_queue=settings.UPDATE_QUEUE_MAX,
+)
+
+def _prepare_update(update: dict):
+    # optional: inject bot username if you set BOT_USERNAME env, otherwise ignore
+    update["bot_username"] = os.getenv("BOT_USERNAME", "")
+
+long_poller = None
+if settings.TG_UPDATES_MODE == "polling":
+    long_poller = LongPoller(
+        tg,
+        updates,
+        timeout_s=settings.TG_POLL_TIMEOUT_S,
+        limit=settings.TG_POLL_LIMIT,
+        batch_wait_s=settings.TG_POLL_BATCH_WAIT_S,
+        prepare=_prepare_update,
+    )
+
+metrics.bind_runtime(
+    tg,
+    updates,
+    poller,
+    job_events,
+    caches={"apifree_result": apifree.results.stats, "chat": chat_cache.stats},
+)
 
 @app.on_event("startup")
 async def startup():
     os.makedirs(os.path.dirname(settings.DB_PATH) or ".", exist_ok=True)
     await storage.init()
+    await apifree.start()
+    await tg.start()
+    await media.start()
+    await poller.start()
+    await broadcaster.start()
+    await updates.start()
+
+    if long_poller is not None:
+        await long_poller.start()
+        print("[startup] receiving updates with getUpdates (long polling)")
+        return
 
     # set webhook
+    if not settings.PUBLIC_BASE_URL:
+        print("[startup] PUBLIC_BASE_URL is empty: webhook not set (use TG_UPDATES_MODE=polling without a public URL)")
+        return
     webhook_url = f"{settings.PUBLIC_BASE_URL.rstrip('/')}/telegram/webhook/{settings.WEBHOOK_SECRET}"
     try:
         await tg.set_webhook(webhook_url)
@@ -29,89 +197,84 @@ async def startup():
     except Exception as e:
         print(f"[startup] setWebhook failed: {e}")
 
+@app.on_event("shutdown")
+async def shutdown():
+    if long_poller is not None:
+        await long_poller.stop()
+    await updates.stop()
+    await broadcaster.stop()
+    await poller.stop()
+    await tg.aclose()
+    await media.aclose()
+    if memory is not None:
+        await memory.aclose()
+    await apifree.aclose()
+    await storage.close()
+
 @app.get("/health")
 async def health():
-    return {"ok": True}
+    return {"ok": True, "tg_queue": tg.queue_depth(), "updates_queue": updates.depth(), "jobs_pending": poller.pending(), "chat_cache": chat_cache.stats(), "apifree": apifree.breakers(), "scheduler": scheduler.stats(), "memory": memory.stats() if memory else None, "idempotency": idempotency.stats(), "admission": admission.stats()}
 
 
 
-async def _deliver_image_to_tg(tg_id: int, request_id: str):
-    """Poll provider and send final image to Telegram chat."""
-    try:
-        await tg.send_message(tg_id, f"🧠 Задача принята. ID: <code>{request_id}</code>\nЖду результат…")
-    except Exception:
-        pass
-    for _ in range(120):
-        try:
-            res = await apifree.image_result(request_id)
-            data = res
-            url = data.get('url') or data.get('output_url') or (data.get('result') or {}).get('url') or (data.get('result') or {}).get('output_url')
-            if not url:
-                imgs = (data.get('images') or (data.get('result') or {}).get('images') or [])
-                if imgs:
-                    url = imgs[0]
-            status = (data.get('status') or data.get('state') or data.get('phase') or '').lower()
-            if url:
-                await tg.send_photo(tg_id, url, caption='✅ Готово!')
-                return
-            if 'fail' in status or 'error' in status:
-                await tg.send_message(tg_id, f"❌ Ошибка генерации: <pre>{str(data)[:3500]}</pre>")
-                return
-        except Exception as e:
-            # keep polling; transient provider issues happen
-            last = str(e)
-        import asyncio
-        await asyncio.sleep(2)
-    try:
-        await tg.send_message(tg_id, '⌛ Не дождалась результата (timeout). Попробуй ещё раз.')
-    except Exception:
-        pass
-
-
-async def _deliver_video_to_tg(tg_id: int, request_id: str):
-    """Poll provider and send final video to Telegram chat."""
-    try:
-        await tg.send_message(tg_id, f"🎬 Задача принята. ID: <code>{request_id}</code>\nЖду результат…")
-    except Exception:
-        pass
-    for _ in range(180):
-        try:
-            res = await apifree.video_result(request_id)
-            data = res
-            url = data.get('url') or data.get('output_url') or (data.get('result') or {}).get('url') or (data.get('result') or {}).get('output_url')
-            if not url:
-                vids = (data.get('videos') or (data.get('result') or {}).get('videos') or [])
-                if vids:
-                    url = vids[0]
-            status = (data.get('status') or data.get('state') or data.get('phase') or '').lower()
-            if url:
-                await tg.send_video(tg_id, url, caption='✅ Готово!')
-                return
-            if 'fail' in status or 'error' in status:
-                await tg.send_message(tg_id, f"❌ Ошибка генерации: <pre>{str(data)[:3500]}</pre>")
-                return
-        except Exception:
-            pass
-        import asyncio
-        await asyncio.sleep(2)
-    try:
-        await tg.send_message(tg_id, '⌛ Не дождалась результата (timeout). Попробуй ещё раз.')
-    except Exception:
-        pass
+@app.get("/metrics")
+async def metrics_endpoint():
+    body, content_type = metrics.render()
+    return Response(body, media_type=content_type)
+
 @app.post("/telegram/webhook/{secret}")
 async def telegram_webhook(secret: str, request: Request):
     if secret != settings.WEBHOOK_SECRET:
         raise HTTPException(status_code=404, detail="Not found")
-    update = await request.json()
-    # optional: inject bot username if you set BOT_USERNAME env, otherwise ignore
-    update["bot_username"] = os.getenv("BOT_USERNAME", "")
+    started = time.perf_counter()
     try:
-        await handle_update(storage, tg, apifree, update)
-    except Exception as e:
-        print("handle_update error:", e)
+        update = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid json")
+    if not isinstance(update, dict) or not isinstance(update.get("update_id"), int):
+        raise HTTPException(status_code=400, detail="not a Telegram update")
+    _prepare_update(update)
+    # ack right away; workers run handle_update. A non-2xx makes Telegram redeliver later.
+    accepted = updates.enqueue(update)
+    metrics.WEBHOOK_SECONDS.observe(time.perf_counter() - started)
+    if not accepted:
+        return JSONResponse({"ok": False, "error": "busy"}, status_code=429, headers={"Retry-After": "1"})
     return {"ok": True}
 
+@app.post("/apifree/callback/{secret}")
+async def apifree_callback(secret: str, request: Request):
+    """ApiFree reports a job change; a finished job is delivered right away."""
+    if not settings.APIFREE_CALLBACK_SECRET or not hmac.compare_digest(secret.encode(), settings.APIFREE_CALLBACK_SECRET.encode()):
+        raise HTTPException(status_code=404, detail="Not found")
+    try:
+        data = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="invalid json")
+    request_id = extract_request_id(data) if isinstance(data, dict) else None
+    if not request_id:
+        raise HTTPException(status_code=400, detail="request_id required")
+    row = await storage.get_job(request_id)
+    if not row or row["kind"] not in ("image", "video"):
+        raise HTTPException(status_code=404, detail="job not found")
+    if row["status"] != "pending":
+        return {"ok": True, "status": row["status"]}  # repeated callback
+    try:
+        status = await poller.complete(row, data)
+    except Exception as e:
+        # non-2xx: the provider retries, and the safety-net poll still runs
+        return JSONResponse({"ok": False, "error": "provider_error", "detail": str(e)}, status_code=502)
+    metrics.APIFREE_CALLBACKS.labels(status if status in ("done", "failed") else "pending").inc()
+    return {"ok": True, "status": status}
+
 # -------- Mini App API --------
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def _busy() -> JSONResponse:
+    return JSONResponse({"ok": False, "error": "busy"}, status_code=429, headers={"Retry-After": "5"})
+
+def _ms(started: float) -> int:
+    return int((time.monotonic() - started) * 1000)
+
 @app.get("/api/me")
 async def api_me(tg_id: int):
     u = await storage.get_user(tg_id)
@@ -120,33 +283,142 @@ async def api_me(tg_id: int):
     return {"tg_id": u.tg_id, "credits_free": u.credits_free, "credits_pro": u.credits_pro}
 
 @app.post("/api/chat")
-async def api_chat(payload: dict):
+async def api_chat(payload: dict, request: Request):
     tg_id = int(payload.get("tg_id", 0))
     text = (payload.get("text") or "").strip()
     if not tg_id or not text:
         raise HTTPException(status_code=400, detail="tg_id and text required")
+    started = time.monotonic()
+    # context and cache lookups come before charging: if they fail, no credit is lost
+    if memory is not None:
+        messages = await memory.messages(tg_id, text)
+    else:
+        messages = [{"role": "user", "content": text}]
+    cache_key, cached = await chat_cache.get(settings.APIFREE_CHAT_MODEL, messages)
+
     # Admins bypass credit checks (useful while payments/referrals are being wired)
+    bucket = None
     if tg_id not in settings.admin_ids():
-        ok = await storage.consume_credit(tg_id)
-        if not ok:
+        bucket = await storage.consume_credit(tg_id, reason="chat")
+        if not bucket:
             return JSONResponse({"ok": False, "error": "no_credits"}, status_code=402)
 
+    if cached is not None:
+        storage.record_chat_job(tg_id, text, cached, duration_ms=_ms(started), cached=True)
+        if memory is not None:
+            await memory.remember(tg_id, text, cached)
+        if payload.get("stream"):
+            frames = iter([sse({"delta": cached}), sse({"done": True, "cached": True})])
+            return StreamingResponse(frames, media_type="text/event-stream", headers=SSE_HEADERS)
+        return {"ok": True, "answer": cached, "cached": True}
+    if payload.get("stream"):
+        return StreamingResponse(_chat_events(tg_id, bucket, messages, cache_key), media_type="text/event-stream", headers=SSE_HEADERS)
+
     try:
-        answer = await apifree.chat(settings.APIFREE_CHAT_MODEL, [{"role": "user", "content": text}])
+        ticket = scheduler.ticket("chat", tg_id, priority=is_priority(tg_id, bucket))
+    except QueueFull:
+        if bucket:
+            await storage.refund_credit(tg_id, bucket, reason="chat")
+        return _busy()
+    try:
+        async with ticket:
+            request.state.queue_wait_s = ticket.waited_s  # not provider latency, see AdmissionControl
+            answer = await apifree.chat(settings.APIFREE_CHAT_MODEL, messages)
+        storage.record_chat_job(tg_id, text, answer, duration_ms=_ms(started))
+        await chat_cache.put(cache_key, settings.APIFREE_CHAT_MODEL, answer)
+        if memory is not None:
+            await memory.remember(tg_id, text, answer)
         return {"ok": True, "answer": answer}
     except Exception as e:
+        storage.record_chat_job(tg_id, text, str(e), status="failed", duration_ms=_ms(started))
+        if bucket:
+            await storage.refund_credit(tg_id, bucket, reason="chat")
         # Make provider errors readable in the UI
         return JSONResponse({"ok": False, "error": "provider_error", "detail": str(e)}, status_code=502)
 
+async def _chat_events(tg_id: int, bucket, messages, cache_key=None):
+    """SSE frames for a streamed /api/chat: {"queued": n}* while waiting for a slot,
+    then {"delta": ...}* and {"done": true}, or an error event."""
+    got_any = False
+    answer = ""
+    ticket = None
+    started = time.monotonic()
+    prompt = messages[-1]["content"]
+    try:
+        # admitted here rather than in the endpoint, so a stream that never starts holds no slot
+        ticket = scheduler.ticket("chat", tg_id, priority=is_priority(tg_id, bucket))
+        while not await ticket.wait(timeout=1.0):
+            yield sse({"queued": ticket.position()})
+        async for piece in apifree.chat_stream(settings.APIFREE_CHAT_MODEL, messages):
+            got_any = True
+            answer += piece
+            yield sse({"delta": piece})
+        storage.record_chat_job(tg_id, prompt, answer, duration_ms=_ms(started))
+        await chat_cache.put(cache_key, settings.APIFREE_CHAT_MODEL, answer)
+        if memory is not None:
+            await memory.remember(tg_id, prompt, answer)
+        yield sse({"done": True})
+    except QueueFull:
+        if bucket:
+            await storage.refund_credit(tg_id, bucket, reason="chat")
+        yield sse({"ok": False, "error": "busy"}, event="error")
+    except Exception as e:
+        storage.record_chat_job(tg_id, prompt, answer or str(e), status="failed", duration_ms=_ms(started))
+        if bucket and not got_any:
+            await storage.refund_credit(tg_id, bucket, reason="chat")
+        yield sse({"ok": False, "error": "provider_error", "detail": str(e)}, event="error")
+    finally:
+        if ticket is not None:
+            ticket.release()
+
+async def _idempotent(scope: str, payload: dict, request: Request, handler):
+    """Run a credit-spending handler once per Idempotency-Key (or identical body within
+    IDEMPOTENCY_WINDOW_S); repeats get the first successful response back."""
+    tg_id = int(payload.get("tg_id", 0))
+    key, ttl_s, body_hash = idempotency.key(scope, tg_id, request.headers.get("Idempotency-Key"), payload)
+    try:
+        replay = await idempotency.begin(key, tg_id, ttl_s, body_hash)
+    except DuplicateInProgress:
+        return JSONResponse({"ok": False, "error": "in_progress"}, status_code=409, headers={"Retry-After": "1"})
+    except KeyReused:
+        return JSONResponse({"ok": False, "error": "idempotency_key_reused", "detail": "Idempotency-Key was already used with a different request"}, status_code=422)
+    if replay is not None:
+        return JSONResponse(replay, headers={"Idempotent-Replayed": "true"})
+    result = None
+    try:
+        result = await handler()
+    finally:
+        # only successes are remembered: after 402/429/502 a retry should run for real
+        if isinstance(result, dict) and result.get("ok"):
+            await idempotency.finish(key, result)
+        else:
+            await idempotency.abort(key)
+    return result
+
+@app.get("/api/queue")
+async def api_queue(tg_id: int):
+    """Queue positions of the user's waiting requests by kind (empty = nothing waiting)."""
+    return {"ok": True, "queue": scheduler.positions(tg_id)}
+
+async def _track_job(tg_id: int, kind: str, request_id: str, payload: dict, prompt: str):
+    try:
+        await poller.submit(tg_id, kind, request_id, deliver=bool(payload.get("deliver_to_tg", True)), prompt=prompt)
+    except Exception as e:
+        print(f"[jobs] could not record {kind} job {request_id} for {tg_id}:", e)
+
 @app.post("/api/image/submit")
-async def api_image_submit(payload: dict, background_tasks: BackgroundTasks):
+async def api_image_submit(payload: dict, request: Request):
+    return await _idempotent("image", payload, request, lambda: _image_submit(payload, request))
+
+async def _image_submit(payload: dict, request: Request):
     tg_id = int(payload.get("tg_id", 0))
     prompt = (payload.get("prompt") or "").strip()
     if not tg_id or not prompt:
         raise HTTPException(status_code=400, detail="tg_id and prompt required")
+    bucket = None
     if tg_id not in settings.admin_ids():
-        ok = await storage.consume_credit(tg_id)
-        if not ok:
+        bucket = await storage.consume_credit(tg_id, reason="image")
+        if not bucket:
             return JSONResponse({"ok": False, "error": "no_credits"}, status_code=402)
 
     # Pass-through payload to provider with a small normalization layer.
@@ -156,20 +428,24 @@ async def api_image_submit(payload: dict, background_tasks: BackgroundTasks):
     provider_payload.setdefault("model", settings.APIFREE_IMAGE_MODEL)
 
     try:
-        res = await apifree.image_submit(provider_payload)
-        resp_data = (res or {}).get("resp_data") or {}
-        request_id = (
-            res.get("request_id")
-            or resp_data.get("request_id")
-            or res.get("id")
-            or res.get("task_id")
-            or (res.get("result") or {}).get("id")
-        )
-        if request_id and payload.get("deliver_to_tg", True):
-            background_tasks.add_task(_deliver_image_to_tg, tg_id, str(request_id))
-        return {"ok": True, "request_id": request_id, "apifree": res}
+        ticket = scheduler.ticket("image", tg_id, priority=is_priority(tg_id, bucket))
+    except QueueFull:
+        if bucket:
+            await storage.refund_credit(tg_id, bucket, reason="image")
+        return _busy()
+    try:
+        async with ticket:
+            request.state.queue_wait_s = ticket.waited_s
+            res = await apifree.image_submit(provider_payload)
     except Exception as e:
+        if bucket:
+            await storage.refund_credit(tg_id, bucket, reason="image")
         return JSONResponse({"ok": False, "error": "provider_error", "detail": str(e)}, status_code=502)
+    request_id = extract_request_id(res or {})
+    if request_id:
+        # ApiFree accepted (and bills) the job: no refund, the client can still poll it by request_id
+        await _track_job(tg_id, "image", request_id, payload, prompt)
+    return {"ok": True, "request_id": request_id, "apifree": res}
 
 
 @app.get("/api/image/result/{request_id}")
@@ -182,14 +458,18 @@ async def api_image_result(request_id: str):
 
 
 @app.post("/api/video/submit")
-async def api_video_submit(payload: dict, background_tasks: BackgroundTasks):
+async def api_video_submit(payload: dict, request: Request):
+    return await _idempotent("video", payload, request, lambda: _video_submit(payload, request))
+
+async def _video_submit(payload: dict, request: Request):
     tg_id = int(payload.get("tg_id", 0))
     prompt = (payload.get("prompt") or "").strip()
     if not tg_id or not prompt:
         raise HTTPException(status_code=400, detail="tg_id and prompt required")
+    bucket = None
     if tg_id not in settings.admin_ids():
-        ok = await storage.consume_credit(tg_id)
-        if not ok:
+        bucket = await storage.consume_credit(tg_id, reason="video")
+        if not bucket:
             return JSONResponse({"ok": False, "error": "no_credits"}, status_code=402)
 
     provider_payload = dict(payload)
@@ -197,20 +477,24 @@ async def api_video_submit(payload: dict, background_tasks: BackgroundTasks):
     provider_payload.setdefault("model", settings.APIFREE_VIDEO_MODEL)
 
     try:
-        res = await apifree.video_submit(provider_payload)
-        resp_data = (res or {}).get("resp_data") or {}
-        request_id = (
-            res.get("request_id")
-            or resp_data.get("request_id")
-            or res.get("id")
-            or res.get("task_id")
-            or (res.get("result") or {}).get("id")
-        )
-        if request_id and payload.get("deliver_to_tg", True):
-            background_tasks.add_task(_deliver_video_to_tg, tg_id, str(request_id))
-        return {"ok": True, "request_id": request_id, "apifree": res}
+        ticket = scheduler.ticket("video", tg_id, priority=is_priority(tg_id, bucket))
+    except QueueFull:
+        if bucket:
+            await storage.refund_credit(tg_id, bucket, reason="video")
+        return _busy()
+    try:
+        async with ticket:
+            request.state.queue_wait_s = ticket.waited_s
+            res = await apifree.video_submit(provider_payload)
     except Exception as e:
+        if bucket:
+            await storage.refund_credit(tg_id, bucket, reason="video")
         return JSONResponse({"ok": False, "error": "provider_error", "detail": str(e)}, status_code=502)
+    request_id = extract_request_id(res or {})
+    if request_id:
+        # ApiFree accepted (and bills) the job: no refund, the client can still poll it by request_id
+        await _track_job(tg_id, "video", request_id, payload, prompt)
+    return {"ok": True, "request_id": request_id, "apifree": res}
 
 
 @app.get("/api/video/result/{request_id}")
@@ -221,9 +505,110 @@ async def api_video_result(request_id: str):
     except Exception as e:
         return JSONResponse({"ok": False, "error": "provider_error", "detail": str(e)}, status_code=502)
 
+# -------- job status push (SSE) --------
+def _row_event(row: dict) -> dict:
+    return job_event(row["id"], row["kind"], row["request_id"], row["status"], row.get("result_url"))
+
+@app.get("/api/jobs/{request_id}/events")
+async def api_job_events(request_id: str):
+    """Stream status changes of one job until it finishes."""
+    row = await storage.get_job(request_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="job not found")
+    initial = poller.snapshot(request_id) or _row_event(row)
+
+    async def _check_db():
+        # the job may have been finished by another process; the DB is the source of truth
+        fresh = await storage.get_job(request_id)
+        if fresh and fresh["status"] != "pending":
+            return _row_event(fresh)
+        return None
+
+    stream = job_events.stream(("job", request_id), initial=initial, until_terminal=True, on_idle=_check_db)
+    return StreamingResponse(stream, media_type="text/event-stream", headers=SSE_HEADERS)
+
+@app.post("/api/jobs/{request_id}/send")
+async def api_job_send(request_id: str, payload: dict):
+    """Send a finished result to the user's chat again (reuses the stored file_id)."""
+    tg_id = int(payload.get("tg_id", 0))
+    row = await storage.get_job(request_id)
+    if not row or row["tg_id"] != tg_id or row["status"] != "done" or not row.get("result_url"):
+        raise HTTPException(status_code=404, detail="job not found")
+    try:
+        await media.deliver(tg_id, row["kind"], row["result_url"], request_id=request_id)
+    except Exception as e:
+        return JSONResponse({"ok": False, "error": "telegram_error", "detail": str(e)}, status_code=502)
+    return {"ok": True}
+
+@app.get("/api/jobs")
+async def api_jobs(tg_id: int, cursor: Optional[int] = None, limit: int = 20, kind: Optional[str] = None):
+    """The user's generations, newest first. Pass `next_cursor` back as `cursor` for the next page."""
+    limit = max(1, min(limit, 100))
+    rows = await storage.list_jobs(tg_id, before_id=cursor, limit=limit, kind=kind)
+    jobs = []
+    for row in rows:
+        payload = json.loads(row["payload_json"] or "{}")
+        jobs.append({
+            "id": row["id"],
+            "kind": row["kind"],
+            "request_id": row["request_id"],
+            "status": row["status"],
+            "url": row["result_url"],
+            "prompt": payload.get("prompt"),
+            "answer": payload.get("answer"),
+            "created_at": row["created_at"],
+            "finished_at": row["finished_at"],
+            "duration_ms": row["duration_ms"],
+        })
+    next_cursor = rows[-1]["id"] if len(rows) == limit else None
+    return {"ok": True, "jobs": jobs, "next_cursor": next_cursor}
+
+@app.get("/api/events")
+async def api_user_events(tg_id: int):
+    """Stream status changes of all jobs of one user."""
+    stream = job_events.stream(("user", tg_id))
+    return StreamingResponse(stream, media_type="text/event-stream", headers=SSE_HEADERS)
+
+# -------- admin --------
+def _require_admin(request: Request, tg_id: int):
+    """Admin API: an ADMIN_IDS tg_id plus the X-App-Secret header (APP_SECRET must be changed from the default)."""
+    secret = request.headers.get("X-App-Secret", "")  # decoded as latin-1: .encode("latin-1") gives back the raw bytes
+    configured = settings.APP_SECRET != type(settings).model_fields["APP_SECRET"].default
+    if tg_id not in settings.admin_ids() or not configured or not hmac.compare_digest(secret.encode("latin-1"), settings.APP_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="admin only")
+
+@app.post("/api/admin/broadcast")
+async def api_admin_broadcast(payload: dict, request: Request):
+    """Start a broadcast: {"tg_id": admin, "text": "...", "photo": optional URL/file_id}. Runs in the background."""
+    tg_id = int(payload.get("tg_id", 0))
+    _require_admin(request, tg_id)
+    text = (payload.get("text") or "").strip()
+    photo = payload.get("photo") or None
+    if not text:
+        raise HTTPException(status_code=400, detail="text required")
+    limit = CAPTION_LIMIT if photo else TEXT_LIMIT
+    if len(text) > limit:
+        raise HTTPException(status_code=400, detail=f"text too long: {len(text)} > {limit} characters" + (" (photo caption)" if photo else ""))
+    row = await broadcaster.create(tg_id, text, photo)
+    return {"ok": True, "broadcast_id": row["id"], "total": row["total"]}
+
+@app.get("/api/admin/broadcasts")
+async def api_admin_broadcasts(tg_id: int, request: Request):
+    """Recent broadcasts with progress, throughput (per_s) and ETA."""
+    _require_admin(request, tg_id)
+    return {"ok": True, "broadcasts": await broadcaster.progress()}
+
+@app.post("/api/admin/broadcasts/{broadcast_id}/cancel")
+async def api_admin_broadcast_cancel(broadcast_id: int, payload: dict, request: Request):
+    _require_admin(request, int(payload.get("tg_id", 0)))
+    if not await broadcaster.cancel(broadcast_id):
+        raise HTTPException(status_code=404, detail="no running broadcast with this id")
+    return {"ok": True}
+
 # -------- static miniapp --------
 WEBAPP_DIR =WEBAPP_DIR = os.path.join(os.path.dirname(__file__), "..", "webapp")
-app.mount("/webapp", StaticFiles(directory=WEBAPP_DIR, html=True), name="webapp")
+# built once at import: gzip/br variants, ETags, fingerprinted style.<hash>.css
+app.mount("/webapp", PrecompressedStatic(WEBAPP_DIR, prefix="/webapp"), name="webapp")
 
 @app.get("/")
 async def root():
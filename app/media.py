@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import mimetypes
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import httpx
+
+from .metrics import MEDIA_DELIVERIES
+from .storage import Storage
+from .telegram_api import InputFile, TelegramAPI, TelegramAPIError, PRIORITY_NORMAL
+
+# Bot API upload limits (multipart): 10 MB for photos, 50 MB for everything else.
+_MAX_BYTES = {"image": 10 * 1024 * 1024, "video": 50 * 1024 * 1024}
+_DEFAULT_TYPE = {"image": ("image/jpeg", ".jpg"), "video": ("video/mp4", ".mp4")}
+
+
+class MediaTooLarge(RuntimeError):
+    """The result is above Telegram's upload limit; Telegram gets the URL instead."""
+
+
+def sent_file_id(result: Dict[str, Any]) -> Optional[str]:
+    """file_id of the media in a sent Message (largest photo size)."""
+    if result.get("photo"):
+        return result["photo"][-1]["file_id"]
+    for key in ("video", "animation", "document"):
+        if key in result:
+            return result[key]["file_id"]
+    return None
+
+
+class MediaRelay:
+    """Delivers image/video results to Telegram with as little transfer as possible.
+
+    A result already sent once is re-sent by its stored file_id. Otherwise the
+    file is streamed from the provider straight into a multipart upload (chunk
+    by chunk, never held in memory whole), so Telegram doesn't have to fetch a
+    possibly expiring provider URL; the returned file_id is stored against the
+    URL and request_id. If relaying fails, Telegram is given the URL as before.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        tg: TelegramAPI,
+        relay: bool = True,
+        chunk_kb: int = 256,
+        download_timeout_s: float = 120.0,
+    ):
+        self.storage = storage
+        self.tg = tg
+        self.relay = relay
+        self.chunk_size = chunk_kb * 1024
+        self.download_timeout_s = download_timeout_s
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.download_timeout_s, connect=10.0),
+                follow_redirects=True,
+            )
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            await self.start()
+        return self._client
+
+    async def deliver(
+        self,
+        chat_id: int,
+        kind: str,
+        url: str,
+        caption: Optional[str] = None,
+        request_id: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL,
+    ) -> Dict[str, Any]:
+        send = self.tg.send_video if kind == "video" else self.tg.send_photo
+
+        known = await self.storage.get_media_file(url=url, request_id=request_id)
+        if known is not None:
+            try:
+                data = await send(chat_id, known["file_id"], caption=caption, priority=priority)
+                MEDIA_DELIVERIES.labels("file_id").inc()
+                return data
+            except TelegramAPIError as e:
+                if e.error_code != 400:
+                    raise
+                # file_id rejected (wrong identifier / expired): upload again below
+                await self.storage.forget_media_file(known["file_id"])
+
+        data = None
+        if self.relay:
+            try:
+                data = await send(chat_id, self._input_file(kind, url, request_id), caption=caption, priority=priority)
+                MEDIA_DELIVERIES.labels("upload").inc()
+            except (MediaTooLarge, httpx.HTTPError, TelegramAPIError) as e:
+                if isinstance(e, TelegramAPIError) and e.error_code == 403:
+                    raise  # bot blocked: a URL won't help either
+                print(f"[media] relay of {url} failed, sending the URL:", e)
+        if data is None:
+            data = await send(chat_id, url, caption=caption, priority=priority)
+            MEDIA_DELIVERIES.labels("url").inc()
+
+        file_id = sent_file_id(data.get("result") or {})
+        if file_id:
+            await self.storage.save_media_file(url, request_id, kind, file_id)
+        return data
+
+    def _input_file(self, kind: str, url: str, request_id: Optional[str]) -> InputFile:
+        content_type, ext = _DEFAULT_TYPE.get(kind, _DEFAULT_TYPE["image"])
+        name = os.path.basename(urlparse(url).path)
+        guessed, _ = mimetypes.guess_type(name)
+        if guessed and guessed.split("/")[0] == content_type.split("/")[0]:
+            content_type = guessed
+        else:
+            name = f"{request_id or 'result'}{ext}"
+        return InputFile(
+            field="video" if kind == "video" else "photo",
+            filename=name,
+            content_type=content_type,
+            open=lambda: self._download(url, _MAX_BYTES.get(kind, _MAX_BYTES["video"])),
+        )
+
+    @asynccontextmanager
+    async def _download(self, url: str, max_bytes: int) -> AsyncIterator[Tuple[AsyncIterator[bytes], Optional[int]]]:
+        client = await self._http()
+        async with client.stream("GET", url) as r:
+            r.raise_for_status()
+            length = None
+            if "content-length" in r.headers and not r.headers.get("content-encoding"):
+                length = int(r.headers["content-length"])
+                if length > max_bytes:
+                    raise MediaTooLarge(f"{length} bytes")
+            yield self._chunks(r, max_bytes), length
+
+    async def _chunks(self, r: httpx.Response, max_bytes: int) -> AsyncIterator[bytes]:
+        seen = 0
+        async for chunk in r.aiter_bytes(self.chunk_size):
+            seen += len(chunk)
+            if seen > max_bytes:
+                raise MediaTooLarge(f"more than {max_bytes} bytes")
+            yield chunk
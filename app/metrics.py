@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import functools
+import time
+from typing import Any, Callable, Dict
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Provider calls take seconds, Telegram/DB calls milliseconds: separate bucket sets.
+_SLOW = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+_FAST = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+APIFREE_SECONDS = Histogram("apifree_request_seconds", "ApiFree call latency", ["method", "outcome"], buckets=_SLOW)
+TELEGRAM_SECONDS = Histogram("telegram_request_seconds", "Telegram Bot API call latency", ["method", "outcome"], buckets=_FAST + (5, 10))
+STORAGE_SECONDS = Histogram("storage_query_seconds", "Storage method latency", ["op"], buckets=_FAST)
+WEBHOOK_SECONDS = Histogram("webhook_seconds", "Time to accept a Telegram webhook request", buckets=_FAST)
+UPDATE_SECONDS = Histogram("update_handle_seconds", "Time spent in handle_update per update", buckets=_SLOW)
+APIFREE_RETRIES = Counter("apifree_retries_total", "ApiFree retries/failovers/hedges and calls refused by breaker or budget", ["kind"])
+SCHED_WAIT_SECONDS = Histogram("scheduler_wait_seconds", "Time a provider call waited for admission", ["kind", "lane"], buckets=_SLOW)
+MEDIA_DELIVERIES = Counter("media_deliveries_total", "Image/video deliveries by how the file reached Telegram", ["mode"])  # file_id/upload/url
+APIFREE_CALLBACKS = Counter("apifree_callbacks_total", "ApiFree job callbacks by resulting status", ["status"])  # done/failed/pending
+ADMISSION_SHED = Counter("admission_shed_total", "Mini App provider requests refused before they started", ["kind", "reason"])  # busy/provider_slow/provider_unavailable
+CREDIT_CONSUME = Counter("credit_consume_total", "consume_credit outcomes", ["outcome"])  # pro/free/none
+CREDIT_REFUNDS = Counter("credit_refund_total", "Credits refunded after provider failures", ["bucket"])
+
+TG_QUEUE = Gauge("telegram_send_queue_depth", "Telegram sends waiting for a rate-limit slot")
+UPDATES_QUEUE = Gauge("update_queue_depth", "Telegram updates queued for workers")
+JOBS_IN_FLIGHT = Gauge("jobs_in_flight", "Image/video jobs polled by this process", ["kind"])
+SSE_SUBSCRIBERS = Gauge("sse_subscribers", "Open job status streams")
+CACHE_EVENTS = Gauge("cache_events", "Cache counters (hits/misses/...) by cache", ["cache", "event"])
+
+
+def timed(hist: Histogram, name: str) -> Callable:
+    """Decorator: observe the latency of an async function under (name, ok|error)."""
+    ok = hist.labels(name, "ok")
+    err = hist.labels(name, "error")
+
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                result = await fn(*args, **kwargs)
+            except BaseException:
+                err.observe(time.perf_counter() - t)
+                raise
+            ok.observe(time.perf_counter() - t)
+            return result
+        return wrapper
+    return deco
+
+
+def timed_query(op: str) -> Callable:
+    """Decorator for Storage methods (no outcome label: DB errors are rare and loud)."""
+    child = STORAGE_SECONDS.labels(op)
+
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - t)
+        return wrapper
+    return deco
+
+
+def bind_runtime(tg: Any, updates: Any, poller: Any, job_events: Any, caches: Dict[str, Callable[[], Dict[str, int]]]):
+    """Read queue depths and counters at scrape time, so the hot path pays nothing."""
+    TG_QUEUE.set_function(tg.queue_depth)
+    UPDATES_QUEUE.set_function(updates.depth)
+    SSE_SUBSCRIBERS.set_function(job_events.subscribers)
+    for kind in ("image", "video"):
+        JOBS_IN_FLIGHT.labels(kind).set_function(lambda kind=kind: poller.pending().get(kind, 0))
+    for cache, stats in caches.items():
+        for event in stats():
+            CACHE_EVENTS.labels(cache, event).set_function(lambda stats=stats, event=event: stats().get(event, 0))
+
+
+def render() -> tuple:
+    return generate_latest(), CONTENT_TYPE_LATEST
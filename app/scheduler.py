@@ -0,0 +1,201 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Hashable, Optional
+
+from .metrics import SCHED_WAIT_SECONDS
+
+LANE_PRIORITY = "priority"  # PRO users and admins
+LANE_NORMAL = "normal"
+
+
+class QueueFull(RuntimeError):
+    """Too many requests of this kind are already waiting."""
+
+
+class Ticket:
+    """One admission: `await ticket.wait()` (or `async with ticket`) until a slot is
+    granted, `release()` when done. Releasing an ungranted ticket leaves the queue."""
+
+    def __init__(self, queue: "_KindQueue", user_id: Hashable, lane: str):
+        self.queue = queue
+        self.user_id = user_id
+        self.lane = lane
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.created = time.monotonic()
+        self.waited_s = 0.0  # time spent in line before the slot was granted
+        self._released = False
+
+    @property
+    def granted(self) -> bool:
+        return self.future.done()
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the slot; with a timeout, return False if it wasn't granted in time."""
+        try:
+            await asyncio.wait_for(asyncio.shield(self.future), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def position(self) -> int:
+        """Place in line: 1 = next to run, 0 = already running."""
+        return self.queue.position(self)
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.queue.release(self)
+
+    async def __aenter__(self) -> "Ticket":
+        try:
+            await self.wait()
+        except BaseException:
+            self.release()
+            raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+
+class _KindQueue:
+    """Concurrency cap for one kind of provider call with two lanes.
+
+    Inside a lane users take turns (round-robin over users, FIFO per user), so a
+    user with many queued requests waits behind everybody else's next request.
+    Across lanes the priority lane gets `priority_weight` turns per normal turn,
+    so normal users are slowed down, not starved. A user holds at most
+    `per_user` slots at once.
+    """
+
+    def __init__(self, kind: str, limit: int, per_user: int, priority_weight: int, max_waiting: int):
+        self.kind = kind
+        self.limit = limit
+        self.per_user = per_user
+        self.priority_weight = priority_weight
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.active_by_user: Dict[Hashable, int] = {}
+        self.lanes: Dict[str, "OrderedDict[Hashable, Deque[Ticket]]"] = {
+            LANE_PRIORITY: OrderedDict(),
+            LANE_NORMAL: OrderedDict(),
+        }
+        self.waiting = 0
+        self._turn = 0
+
+    def submit(self, user_id: Hashable, priority: bool) -> Ticket:
+        if self.waiting >= self.max_waiting:
+            raise QueueFull(f"{self.kind} queue is full")
+        ticket = Ticket(self, user_id, LANE_PRIORITY if priority else LANE_NORMAL)
+        self.lanes[ticket.lane].setdefault(user_id, deque()).append(ticket)
+        self.waiting += 1
+        self._dispatch()
+        return ticket
+
+    def release(self, ticket: Ticket):
+        if ticket.granted:
+            self.active -= 1
+            n = self.active_by_user[ticket.user_id] - 1
+            if n:
+                self.active_by_user[ticket.user_id] = n
+            else:
+                del self.active_by_user[ticket.user_id]
+        else:
+            users = self.lanes[ticket.lane]
+            dq = users[ticket.user_id]
+            dq.remove(ticket)
+            if not dq:
+                del users[ticket.user_id]
+            self.waiting -= 1
+        self._dispatch()
+
+    def _next(self, lane: str) -> Optional[Ticket]:
+        users = self.lanes[lane]
+        for user_id in users:
+            if self.active_by_user.get(user_id, 0) < self.per_user:
+                dq = users.pop(user_id)
+                ticket = dq.popleft()
+                if dq:
+                    users[user_id] = dq  # back of the rotation
+                return ticket
+        return None
+
+    def _dispatch(self):
+        while self.active < self.limit:
+            priority_turn = self._turn % (self.priority_weight + 1) != self.priority_weight
+            first, second = (LANE_PRIORITY, LANE_NORMAL) if priority_turn else (LANE_NORMAL, LANE_PRIORITY)
+            ticket = self._next(first) or self._next(second)
+            if ticket is None:
+                return
+            self._turn += 1
+            self.waiting -= 1
+            self.active += 1
+            self.active_by_user[ticket.user_id] = self.active_by_user.get(ticket.user_id, 0) + 1
+            ticket.waited_s = time.monotonic() - ticket.created
+            ticket.future.set_result(None)
+            SCHED_WAIT_SECONDS.labels(self.kind, ticket.lane).observe(ticket.waited_s)
+
+    def position(self, ticket: Ticket) -> int:
+        """Approximate place in line: 1 + tickets that round-robin serves first."""
+        if ticket.granted:
+            return 0
+        users = self.lanes[ticket.lane]
+        rank = users[ticket.user_id].index(ticket)  # turns this user takes before this ticket
+        ahead = rank
+        before = True
+        for user_id, dq in users.items():
+            if user_id == ticket.user_id:
+                before = False
+                continue
+            # users earlier in the rotation get one more turn in front of us
+            ahead += min(len(dq), rank + 1 if before else rank)
+        if ticket.lane == LANE_NORMAL:
+            ahead += sum(len(dq) for dq in self.lanes[LANE_PRIORITY].values())
+        return ahead + 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self.active,
+            "waiting_priority": sum(len(dq) for dq in self.lanes[LANE_PRIORITY].values()),
+            "waiting_normal": sum(len(dq) for dq in self.lanes[LANE_NORMAL].values()),
+        }
+
+
+class FairScheduler:
+    """Admission control in front of ApiFree calls.
+
+    `limits` caps concurrent provider calls per kind (chat/image/video); a kind
+    without a limit is admitted right away. Use:
+
+        async with scheduler.ticket("chat", tg_id, priority=is_pro):
+            await apifree.chat(...)
+    """
+
+    def __init__(self, limits: Dict[str, int], per_user: int = 2, priority_weight: int = 4, max_waiting: int = 500):
+        self._queues = {
+            kind: _KindQueue(kind, limit, per_user, priority_weight, max_waiting)
+            for kind, limit in limits.items()
+            if limit > 0
+        }
+        self._unlimited = _KindQueue("unlimited", 1 << 30, 1 << 30, priority_weight, 1 << 30)
+
+    def ticket(self, kind: str, user_id: Hashable, priority: bool = False) -> Ticket:
+        """Join the queue (or get a slot right away). Raises QueueFull."""
+        return self._queues.get(kind, self._unlimited).submit(user_id, priority)
+
+    def positions(self, user_id: Hashable) -> Dict[str, int]:
+        """Best queue position of the user's waiting requests, by kind."""
+        out: Dict[str, int] = {}
+        for kind, q in self._queues.items():
+            for lane in q.lanes.values():
+                dq = lane.get(user_id)
+                if dq:
+                    pos = q.position(dq[0])
+                    out[kind] = min(out.get(kind, pos), pos)
+        return out
+
+    def stats(self) -> Dict[str, Any]:
+        return {kind: q.stats() for kind, q in self._queues.items()}
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from starlette.responses import PlainTextResponse, Response
+from starlette.types import Receive, Scope, Send
+
+try:  # optional: pip install brotli
+    import brotli
+except ImportError:  # pragma: no cover - depends on the environment
+    brotli = None
+
+_COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"  # may be stored, but always revalidated (cheap 304 via ETag)
+
+
+@dataclass
+class _Asset:
+    media_type: str
+    cache_control: str
+    bodies: Dict[str, bytes] = field(default_factory=dict)  # encoding ("identity"/"gzip"/"br") -> bytes
+    etags: Dict[str, str] = field(default_factory=dict)
+
+
+def _accepted(header: str) -> List[str]:
+    """Encodings from Accept-Encoding in preference order (q=0 excluded)."""
+    prefs: List[Tuple[float, int, str]] = []
+    for part in header.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        m = re.search(r"q=([0-9.]+)", params)
+        if m:
+            try:
+                q = float(m.group(1))
+            except ValueError:
+                q = 0.0
+        if name and q > 0:
+            # on equal q prefer br over gzip (smaller), then header order
+            name = name.lower()
+            prefs.append((-q, 0 if name == "br" else 1, name))
+    return [name for _, _, name in sorted(prefs)]
+
+
+class PrecompressedStatic:
+    """ASGI app serving a small static directory from memory.
+
+    Everything is read once at startup: each file gets a strong ETag and, when it
+    is text-like, gzip and brotli variants picked by Accept-Encoding. Non-HTML
+    assets are also published under a fingerprinted name (style.3f2a9c1e.css)
+    with `Cache-Control: immutable`, and references to them inside HTML files are
+    rewritten to that name, so only the small HTML is revalidated on each open.
+    """
+
+    def __init__(self, directory: str, prefix: str = "", index: str = "index.html"):
+        self.directory = directory
+        self.prefix = prefix.rstrip("/")
+        self.index = index
+        self._assets: Dict[str, _Asset] = {}
+        self.build()
+
+    # -------- build --------
+    def build(self):
+        assets: Dict[str, _Asset] = {}
+        fingerprints: Dict[str, str] = {}
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in sorted(names):
+                full = os.path.join(root, name)
+                files.append((os.path.relpath(full, self.directory).replace(os.sep, "/"), full))
+
+        html = []
+        for rel, full in files:
+            with open(full, "rb") as f:
+                data = f.read()
+            media_type = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+            if media_type == "text/html":
+                html.append((rel, data))
+                continue
+            digest = hashlib.sha256(data).hexdigest()[:10]
+            stem, ext = os.path.splitext(rel)
+            fingerprinted = f"{stem}.{digest}{ext}"
+            fingerprints[rel] = fingerprinted
+            assets[fingerprinted] = self._asset(data, media_type, IMMUTABLE)
+            assets[rel] = self._asset(data, media_type, REVALIDATE)
+
+        for rel, data in html:
+            text = data.decode("utf-8")
+            for original, fingerprinted in fingerprints.items():
+                # absolute (/webapp/style.css) and relative (style.css) references
+                text = text.replace(f'{self.prefix}/{original}"', f'{self.prefix}/{fingerprinted}"')
+                text = text.replace(f'"{original}"', f'"{fingerprinted}"')
+            assets[rel] = self._asset(text.encode("utf-8"), "text/html; charset=utf-8", REVALIDATE)
+        self._assets = assets
+
+    @staticmethod
+    def _asset(data: bytes, media_type: str, cache_control: str) -> _Asset:
+        asset = _Asset(media_type=media_type, cache_control=cache_control)
+        variants = {"identity": data}
+        if media_type.startswith(_COMPRESSIBLE):
+            variants["gzip"] = gzip.compress(data, compresslevel=9, mtime=0)
+            if brotli is not None:
+                variants["br"] = brotli.compress(data, quality=11)
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        for encoding, body in variants.items():
+            if encoding != "identity" and len(body) >= len(data):
+                continue  # compression doesn't pay off for this file
+            asset.bodies[encoding] = body
+            # strong ETags must differ between representations
+            asset.etags[encoding] = f'"{digest}"' if encoding == "identity" else f'"{digest}-{encoding}"'
+        return asset
+
+    # -------- serve --------
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            raise RuntimeError("PrecompressedStatic only handles HTTP")
+        response = self._respond(scope)
+        await response(scope, receive, send)
+
+    def _respond(self, scope: Scope) -> Response:
+        if scope["method"] not in ("GET", "HEAD"):
+            return PlainTextResponse("Method Not Allowed", status_code=405, headers={"Allow": "GET, HEAD"})
+        path, root = scope["path"], scope.get("root_path", "")
+        if root and path.startswith(root):
+            path = path[len(root):]  # newer Starlette keeps the mount prefix in "path"
+        rel = path.lstrip("/")
+        if rel == "" or rel.endswith("/"):
+            rel += self.index
+        asset = self._assets.get(rel)
+        if asset is None:
+            return PlainTextResponse("Not Found", status_code=404)
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        encoding = "identity"
+        for name in _accepted(headers.get("accept-encoding", "")):
+            if name in asset.bodies:
+                encoding = name
+                break
+        etag = asset.etags[encoding]
+        out = {"ETag": etag, "Cache-Control": asset.cache_control, "Vary": "Accept-Encoding"}
+        if encoding != "identity":
+            out["Content-Encoding"] = encoding
+
+        if_none_match = headers.get("if-none-match")
+        if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+            return Response(status_code=304, headers=out)
+        body = asset.bodies[encoding]
+        if scope["method"] == "HEAD":
+            out["Content-Length"] = str(len(body))
+            return Response(status_code=200, headers=out, media_type=asset.media_type)
+        return Response(body, headers=out, media_type=asset.media_type)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: {enc: len(b) for enc, b in a.bodies.items()} for name, a in self._assets.items()}
@@ -1,8 +1,15 @@
 from __future__ import annotations
+import asyncio
+import json
+import time
 import aiosqlite
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
-from typing import Optional, Dict, Any
-from datetime import datetime
+from typing import Optional, Dict, Any, AsyncIterator, List, Tuple
+from datetime import datetime, timedelta
+
+from .metrics import CREDIT_CONSUME, CREDIT_REFUNDS, timed_query
 
 @dataclass
 class User:
@@ -14,11 +21,92 @@ class User:
     referred_by: Optional[int]
 
 class Storage:
-    def __init__(self, db_path: str):
+    """SQLite storage with a small pool of long-lived connections.
+
+    WAL mode lets the read connections run alongside the single writer; all writes
+    go through one connection guarded by a lock, so SQLite never has to arbitrate
+    between writers.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        read_connections: int = 4,
+        cache_mb: int = 16,
+        mmap_mb: int = 128,
+        ledger_flush_s: float = 1.0,
+        ledger_batch: int = 500,
+        user_cache_size: int = 10000,
+        user_cache_ttl_s: float = 60.0,
+    ):
         self.db_path = db_path
+        self.read_connections = max(1, read_connections)
+        self.cache_mb = cache_mb
+        self.mmap_mb = mmap_mb
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self._readers: Optional[asyncio.Queue] = None
+        self._all: List[aiosqlite.Connection] = []
+        # credit ledger is write-behind: events are buffered and inserted in batches
+        self.ledger_flush_s = ledger_flush_s
+        self.ledger_batch = ledger_batch
+        self._ledger: List[Tuple[int, int, str, str, str]] = []
+        # finished chat jobs go through the same write-behind buffer as the ledger
+        self._chat_jobs: List[Tuple[int, str, str, str, str, int]] = []
+        self._ledger_wakeup = asyncio.Event()
+        self._ledger_task: Optional[asyncio.Task] = None
+        self._ledger_stopping = False
+        # LRU+TTL copy of hot users; refreshed from RETURNING * on every credit write,
+        # the TTL bounds staleness against writes made by other processes
+        self.user_cache_size = user_cache_size
+        self.user_cache_ttl_s = user_cache_ttl_s
+        self._users: "OrderedDict[int, Tuple[float, User]]" = OrderedDict()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self.db_path)
+        db.row_factory = aiosqlite.Row
+        await db.execute("PRAGMA journal_mode=WAL")
+        await db.execute("PRAGMA synchronous=NORMAL")
+        await db.execute(f"PRAGMA cache_size=-{self.cache_mb * 1024}")
+        await db.execute(f"PRAGMA mmap_size={self.mmap_mb * 1024 * 1024}")
+        await db.execute("PRAGMA temp_store=MEMORY")
+        await db.execute("PRAGMA busy_timeout=5000")
+        self._all.append(db)
+        return db
+
+    @asynccontextmanager
+    async def _read(self) -> AsyncIterator[aiosqlite.Connection]:
+        db = await self._readers.get()
+        try:
+            yield db
+        finally:
+            self._readers.put_nowait(db)
+
+    @asynccontextmanager
+    async def _write(self) -> AsyncIterator[aiosqlite.Connection]:
+        """One write transaction on the writer connection: commit on success, rollback on error."""
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    @staticmethod
+    async def _ensure_column(db: aiosqlite.Connection, table: str, column: str, decl: str):
+        """Tiny migration helper: add a column to an existing table if it's missing."""
+        cur = await db.execute(f"PRAGMA table_info({table})")
+        cols = {r["name"] for r in await cur.fetchall()}
+        if column not in cols:
+            await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
     async def init(self):
-        async with aiosqlite.connect(self.db_path) as db:
+        self._writer = await self._connect()
+        self._readers = asyncio.Queue()
+        for _ in range(self.read_connections):
+            self._readers.put_nowait(await self._connect())
+        async with self._write() as db:
             await db.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 tg_id INTEGER PRIMARY KEY,
@@ -41,63 +129,678 @@ class Storage:
                 created_at TEXT NOT NULL
             );
             """)
-            await db.commit()
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS credit_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                tg_id INTEGER NOT NULL,
+                delta INTEGER NOT NULL,
+                bucket TEXT NOT NULL, -- free/pro
+                reason TEXT NOT NULL, -- signup/referral/chat/image/video/refund:...
+                created_at TEXT NOT NULL
+            );
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_credit_events_tg ON credit_events(tg_id, id)")
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS chat_cache (
+                key TEXT PRIMARY KEY, -- sha256 of model/temperature/normalized messages
+                model TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_chat_cache_created ON chat_cache(created_at)")
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS media_files (
+                url TEXT PRIMARY KEY, -- provider result URL
+                request_id TEXT,
+                kind TEXT NOT NULL, -- image/video
+                file_id TEXT NOT NULL, -- Telegram file_id of the uploaded copy
+                created_at REAL NOT NULL
+            );
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_media_files_request ON media_files(request_id)")
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS idempotency (
+                key TEXT PRIMARY KEY, -- sha256 of scope/tg_id + Idempotency-Key or request body
+                tg_id INTEGER NOT NULL,
+                body_hash TEXT, -- request body behind an Idempotency-Key; a reuse must match it
+                response_json TEXT, -- NULL while the first request is still running
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            """)
+            await self._ensure_column(db, "idempotency", "body_hash", "TEXT")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency(expires_at)")
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                tg_id INTEGER PRIMARY KEY,
+                summary TEXT NOT NULL DEFAULT '', -- rolling summary of compacted turns
+                turns_json TEXT NOT NULL, -- [[role, content, tokens], ...] oldest first
+                tokens INTEGER NOT NULL, -- estimated tokens of turns_json
+                updated_at REAL NOT NULL
+            );
+            """)
+            await self._ensure_column(db, "jobs", "result_url", "TEXT")
+            await self._ensure_column(db, "jobs", "finished_at", "TEXT")
+            await self._ensure_column(db, "jobs", "owner", "TEXT")
+            await self._ensure_column(db, "jobs", "lease_expires_at", "REAL")
+            await self._ensure_column(db, "jobs", "attempts", "INTEGER NOT NULL DEFAULT 0")
+            await self._ensure_column(db, "jobs", "next_poll_at", "REAL")
+            # claim scans pending jobs by lease; renew/release look up by owner
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs(status, lease_expires_at)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_owner ON jobs(owner) WHERE owner IS NOT NULL")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_request ON jobs(request_id)")
+            await self._ensure_column(db, "jobs", "duration_ms", "INTEGER")
+            # history pages walk one user's jobs newest first; the retention sweep by age
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs(tg_id, id)")
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, finished_at)")
+            # which bucket the last consume_credit took from (set by the same UPDATE)
+            await self._ensure_column(db, "users", "last_debit", "TEXT")
+            # set when Telegram says the user blocked the bot; broadcasts skip them
+            await self._ensure_column(db, "users", "blocked_at", "TEXT")
+            await db.execute("""
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_by INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                photo TEXT, -- URL or file_id; text is the caption then
+                status TEXT NOT NULL, -- running/done/cancelled
+                cursor INTEGER NOT NULL DEFAULT 0, -- last tg_id handled (users are walked in tg_id order)
+                total INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                blocked INTEGER NOT NULL DEFAULT 0,
+                owner TEXT,
+                lease_expires_at REAL,
+                created_at TEXT NOT NULL,
+                finished_at TEXT
+            );
+            """)
+            await db.execute("CREATE INDEX IF NOT EXISTS idx_broadcasts_status ON broadcasts(status)")
+        self._ledger_stopping = False
+        self._ledger_task = asyncio.create_task(self._ledger_flusher())
+
+    async def close(self):
+        if self._ledger_task is not None:
+            # no cancel(): wait_for can swallow it when the wakeup fires in the same tick,
+            # and a cancelled flush mid-transaction would have to be undone
+            self._ledger_stopping = True
+            self._ledger_wakeup.set()
+            await asyncio.gather(self._ledger_task, return_exceptions=True)
+            self._ledger_task = None
+        await self.flush_ledger()
+        for db in self._all:
+            await db.close()
+        self._all = []
+        self._writer = None
+        self._readers = None
+
+    # -------- users (read-through cache) --------
+    @staticmethod
+    def _row_to_user(row: aiosqlite.Row) -> User:
+        return User(
+            tg_id=row["tg_id"],
+            username=row["username"],
+            first_name=row["first_name"],
+            credits_free=row["credits_free"],
+            credits_pro=row["credits_pro"],
+            referred_by=row["referred_by"],
+        )
 
+    def _cache_user(self, row: Optional[aiosqlite.Row]) -> Optional[User]:
+        """Cache the user from a fresh users row (every write RETURNING * goes through here)."""
+        if row is None:
+            return None
+        u = self._row_to_user(row)
+        self._users[u.tg_id] = (time.monotonic() + self.user_cache_ttl_s, u)
+        self._users.move_to_end(u.tg_id)
+        while len(self._users) > self.user_cache_size:
+            self._users.popitem(last=False)
+        return u
+
+    @timed_query("get_user")
     async def get_user(self, tg_id: int) -> Optional[User]:
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        hit = self._users.get(tg_id)
+        if hit is not None:
+            if hit[0] > time.monotonic():
+                self._users.move_to_end(tg_id)
+                return hit[1]
+            del self._users[tg_id]
+        async with self._read() as db:
             cur = await db.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,))
-            row = await cur.fetchone()
-            if not row:
-                return None
-            return User(
-                tg_id=row["tg_id"],
-                username=row["username"],
-                first_name=row["first_name"],
-                credits_free=row["credits_free"],
-                credits_pro=row["credits_pro"],
-                referred_by=row["referred_by"],
-            )
+            return self._cache_user(await cur.fetchone())
 
+    @timed_query("upsert_user")
     async def upsert_user(self, tg_id: int, username: Optional[str], first_name: Optional[str], credits_free: int, referred_by: Optional[int]):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self._write() as db:
             now = datetime.utcnow().isoformat()
-            await db.execute(
+            cur = await db.execute(
                 """
                 INSERT INTO users (tg_id, username, first_name, credits_free, credits_pro, referred_by, created_at)
                 VALUES (?, ?, ?, ?, 0, ?, ?)
                 ON CONFLICT(tg_id) DO UPDATE SET
                     username=excluded.username,
                     first_name=excluded.first_name
+                RETURNING *
                 """,
                 (tg_id, username, first_name, credits_free, referred_by, now),
             )
-            await db.commit()
+            row = await cur.fetchone()
+        self._cache_user(row)
+        if row and row["created_at"] == now and credits_free:
+            # fresh insert (an existing row keeps its original created_at)
+            self._record(tg_id, credits_free, "free", "signup")
 
-    async def add_credits(self, tg_id: int, free_delta: int = 0, pro_delta: int = 0):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                "UPDATE users SET credits_free = credits_free + ?, credits_pro = credits_pro + ? WHERE tg_id=?",
+    @timed_query("signup_user")
+    async def signup_user(
+        self,
+        tg_id: int,
+        username: Optional[str],
+        first_name: Optional[str],
+        credits_free: int,
+        referred_by: Optional[int],
+        referrer_bonus: int = 0,
+        new_user_bonus: int = 0,
+    ) -> bool:
+        """Create a user and apply referral bonuses in one transaction.
+
+        Bonuses apply only if the user is really new and didn't refer themselves.
+        Returns False if the user already existed (nothing is changed then).
+        """
+        referral = bool(referred_by) and referred_by != tg_id
+        bonus = new_user_bonus if referral else 0
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                INSERT INTO users (tg_id, username, first_name, credits_free, credits_pro, referred_by, created_at)
+                VALUES (?, ?, ?, ?, 0, ?, ?)
+                ON CONFLICT(tg_id) DO NOTHING
+                RETURNING *
+                """,
+                (tg_id, username, first_name, credits_free + bonus, referred_by, datetime.utcnow().isoformat()),
+            )
+            row = await cur.fetchone()
+            ref_row = None
+            if row and referral and referrer_bonus:
+                cur = await db.execute(
+                    "UPDATE users SET credits_free = credits_free + ? WHERE tg_id=? RETURNING *",
+                    (referrer_bonus, referred_by),
+                )
+                ref_row = await cur.fetchone()
+        if not row:
+            return False
+        self._cache_user(row)
+        if credits_free:
+            self._record(tg_id, credits_free, "free", "signup")
+        if bonus:
+            self._record(tg_id, bonus, "free", "referral")
+        if ref_row is not None:
+            self._cache_user(ref_row)
+            self._record(referred_by, referrer_bonus, "free", "referral")
+        return True
+
+    @timed_query("add_credits")
+    async def add_credits(self, tg_id: int, free_delta: int = 0, pro_delta: int = 0, reason: str = "grant"):
+        async with self._write() as db:
+            cur = await db.execute(
+                "UPDATE users SET credits_free = credits_free + ?, credits_pro = credits_pro + ? WHERE tg_id=? RETURNING *",
                 (free_delta, pro_delta, tg_id),
             )
-            await db.commit()
+            self._cache_user(await cur.fetchone())
+        if free_delta:
+            self._record(tg_id, free_delta, "free", reason)
+        if pro_delta:
+            self._record(tg_id, pro_delta, "pro", reason)
+
+    @timed_query("consume_credit")
+    async def consume_credit(self, tg_id: int, reason: str = "spend") -> Optional[str]:
+        """Consume one credit, PRO first, then free, in a single atomic UPDATE.
+
+        Returns the bucket that was charged ("pro"/"free"), or None if the user
+        has no credits (or doesn't exist). Truthy/falsy like the old bool result.
+        """
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                UPDATE users SET
+                    credits_pro = credits_pro - (credits_pro > 0),
+                    credits_free = credits_free - (credits_pro <= 0),
+                    last_debit = CASE WHEN credits_pro > 0 THEN 'pro' ELSE 'free' END
+                WHERE tg_id=? AND (credits_pro > 0 OR credits_free > 0)
+                RETURNING *
+                """,
+                (tg_id,),
+            )
+            row = await cur.fetchone()
+        if not row:
+            # balance may have been changed by another process: don't trust the cached copy
+            self._users.pop(tg_id, None)
+            CREDIT_CONSUME.labels("none").inc()
+            return None
+        self._cache_user(row)
+        bucket = row["last_debit"]
+        CREDIT_CONSUME.labels(bucket).inc()
+        self._record(tg_id, -1, bucket, reason)
+        return bucket
+
+    @timed_query("refund_credit")
+    async def refund_credit(self, tg_id: int, bucket: str, reason: str = "provider_error"):
+        """Give back a credit taken by consume_credit (e.g. the provider call failed)."""
+        column = "credits_pro" if bucket == "pro" else "credits_free"
+        async with self._write() as db:
+            cur = await db.execute(f"UPDATE users SET {column} = {column} + 1 WHERE tg_id=? RETURNING *", (tg_id,))
+            self._cache_user(await cur.fetchone())
+        CREDIT_REFUNDS.labels(bucket).inc()
+        self._record(tg_id, 1, bucket, f"refund:{reason}")
+
+    @timed_query("set_blocked")
+    async def set_blocked(self, tg_ids: List[int], blocked: bool = True):
+        """Mark users who blocked the bot (or clear the mark when they come back)."""
+        if not tg_ids:
+            return
+        value = datetime.utcnow().isoformat() if blocked else None
+        async with self._write() as db:
+            await db.executemany("UPDATE users SET blocked_at=? WHERE tg_id=?", [(value, i) for i in tg_ids])
+
+    @timed_query("user_ids_after")
+    async def user_ids_after(self, after_id: int, limit: int) -> List[int]:
+        """Next page of reachable users in tg_id order (keyset over the primary key)."""
+        async with self._read() as db:
+            cur = await db.execute(
+                "SELECT tg_id FROM users WHERE tg_id>? AND blocked_at IS NULL ORDER BY tg_id LIMIT ?",
+                (after_id, limit),
+            )
+            return [r["tg_id"] for r in await cur.fetchall()]
+
+    # -------- broadcasts (leased like jobs) --------
+    @timed_query("create_broadcast")
+    async def create_broadcast(self, created_by: int, text: str, photo: Optional[str] = None) -> Dict[str, Any]:
+        async with self._write() as db:
+            cur = await db.execute("SELECT COUNT(*) AS n FROM users WHERE blocked_at IS NULL")
+            total = (await cur.fetchone())["n"]
+            cur = await db.execute(
+                """
+                INSERT INTO broadcasts (created_by, text, photo, status, total, created_at)
+                VALUES (?, ?, ?, 'running', ?, ?)
+                RETURNING *
+                """,
+                (created_by, text, photo, total, datetime.utcnow().isoformat()),
+            )
+            return dict(await cur.fetchone())
+
+    @timed_query("claim_broadcasts")
+    async def claim_broadcasts(self, owner: str, lease_until: float, now: float) -> List[Dict[str, Any]]:
+        """Lease running broadcasts nobody is sending (new, or their worker died)."""
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                UPDATE broadcasts SET owner=?, lease_expires_at=?
+                WHERE status='running' AND (owner IS NULL OR lease_expires_at < ? OR owner=?)
+                RETURNING *
+                """,
+                (owner, lease_until, now, owner),
+            )
+            return [dict(r) for r in await cur.fetchall()]
 
-    async def consume_credit(self, tg_id: int) -> bool:
-        """Consume one credit. Prefer PRO credits, then free. Return True if consumed."""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            cur = await db.execute("SELECT credits_pro, credits_free FROM users WHERE tg_id=?", (tg_id,))
+    @timed_query("save_broadcast")
+    async def save_broadcast(
+        self, broadcast_id: int, owner: str, cursor: int, sent: int, failed: int, blocked: int,
+        lease_until: float, done: bool = False,
+    ) -> bool:
+        """Persist progress (and renew the lease). False if the broadcast was cancelled
+        or taken over meanwhile: the caller must stop sending."""
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                UPDATE broadcasts SET cursor=?, sent=?, failed=?, blocked=?, lease_expires_at=?,
+                    status=CASE WHEN ? THEN 'done' ELSE status END,
+                    finished_at=CASE WHEN ? THEN ? ELSE finished_at END
+                WHERE id=? AND owner=? AND status='running'
+                RETURNING id
+                """,
+                (cursor, sent, failed, blocked, lease_until, done, done, datetime.utcnow().isoformat(), broadcast_id, owner),
+            )
+            return await cur.fetchone() is not None
+
+    @timed_query("cancel_broadcast")
+    async def cancel_broadcast(self, broadcast_id: int) -> bool:
+        async with self._write() as db:
+            cur = await db.execute(
+                "UPDATE broadcasts SET status='cancelled', finished_at=? WHERE id=? AND status='running' RETURNING id",
+                (datetime.utcnow().isoformat(), broadcast_id),
+            )
+            return await cur.fetchone() is not None
+
+    @timed_query("list_broadcasts")
+    async def list_broadcasts(self, limit: int = 20) -> List[Dict[str, Any]]:
+        async with self._read() as db:
+            cur = await db.execute("SELECT * FROM broadcasts ORDER BY id DESC LIMIT ?", (limit,))
+            return [dict(r) for r in await cur.fetchall()]
+
+    # -------- jobs (leased to one worker at a time) --------
+    @timed_query("create_job")
+    async def create_job(
+        self,
+        tg_id: int,
+        kind: str,
+        request_id: Optional[str],
+        payload: Optional[Dict[str, Any]] = None,
+        status: str = "pending",
+        owner: Optional[str] = None,
+        lease_expires_at: Optional[float] = None,
+        next_poll_at: Optional[float] = None,
+    ) -> int:
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                INSERT INTO jobs (tg_id, kind, request_id, status, payload_json, created_at, owner, lease_expires_at, next_poll_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (tg_id, kind, request_id, status, json.dumps(payload or {}, ensure_ascii=False), datetime.utcnow().isoformat(), owner, lease_expires_at, next_poll_at),
+            )
+            return cur.lastrowid
+
+    @timed_query("finish_job")
+    async def finish_job(self, job_id: int, status: str, result_url: Optional[str] = None) -> bool:
+        """Mark a pending job finished. False if it was already finished (e.g. by another worker)."""
+        now = datetime.utcnow().isoformat()
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                UPDATE jobs SET status=?, result_url=?, finished_at=?, owner=NULL, lease_expires_at=NULL,
+                    duration_ms=CAST((julianday(?) - julianday(created_at)) * 86400000 AS INTEGER)
+                WHERE id=? AND status='pending'
+                RETURNING id
+                """,
+                (status, result_url, now, now, job_id),
+            )
+            return await cur.fetchone() is not None
+
+    @timed_query("claim_jobs")
+    async def claim_jobs(self, owner: str, lease_until: float, now: float, limit: int) -> List[Dict[str, Any]]:
+        """Atomically lease up to `limit` pending jobs that are unowned or whose lease expired."""
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                UPDATE jobs SET owner=?, lease_expires_at=?, attempts=attempts+1
+                WHERE id IN (
+                    SELECT id FROM jobs
+                    WHERE status='pending' AND (owner IS NULL OR lease_expires_at < ?)
+                    ORDER BY next_poll_at
+                    LIMIT ?
+                )
+                RETURNING *
+                """,
+                (owner, lease_until, now, limit),
+            )
+            return [dict(r) for r in await cur.fetchall()]
+
+    @timed_query("renew_job_leases")
+    async def renew_job_leases(self, owner: str, lease_until: float, next_polls: List[Tuple[float, int]]) -> set:
+        """Extend this owner's leases (persisting next poll times); returns ids still owned."""
+        async with self._write() as db:
+            await db.executemany("UPDATE jobs SET next_poll_at=? WHERE id=? AND owner=?", [(t, i, owner) for t, i in next_polls])
+            cur = await db.execute(
+                "UPDATE jobs SET lease_expires_at=? WHERE owner=? AND status='pending' RETURNING id",
+                (lease_until, owner),
+            )
+            return {r["id"] for r in await cur.fetchall()}
+
+    @timed_query("release_jobs")
+    async def release_jobs(self, owner: str):
+        """Give up all leases of an owner (clean shutdown) so another worker claims them at once."""
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE jobs SET owner=NULL, lease_expires_at=NULL WHERE owner=? AND status='pending'",
+                (owner,),
+            )
+
+    @timed_query("get_job")
+    async def get_job(self, request_id: str) -> Optional[Dict[str, Any]]:
+        async with self._read() as db:
+            cur = await db.execute("SELECT * FROM jobs WHERE request_id=? ORDER BY id DESC LIMIT 1", (request_id,))
+            row = await cur.fetchone()
+            return dict(row) if row else None
+
+    @timed_query("list_jobs")
+    async def list_jobs(self, tg_id: int, before_id: Optional[int] = None, limit: int = 20, kind: Optional[str] = None) -> List[Dict[str, Any]]:
+        """One page of a user's jobs, newest first (keyset: pass the last id as before_id).
+
+        Walks idx_jobs_user from before_id down, so a page costs the same no
+        matter how long the history is.
+        """
+        sql = "SELECT * FROM jobs WHERE tg_id=? AND id<?"
+        args: List[Any] = [tg_id, before_id if before_id is not None else 1 << 62]
+        if kind:
+            sql += " AND kind=?"
+            args.append(kind)
+        sql += " ORDER BY id DESC LIMIT ?"
+        args.append(limit)
+        async with self._read() as db:
+            cur = await db.execute(sql, args)
+            return [dict(r) for r in await cur.fetchall()]
+
+    def record_chat_job(self, tg_id: int, prompt: str, answer: str, status: str = "done", duration_ms: int = 0, cached: bool = False):
+        """Log a finished chat request in the job history (buffered, written with the ledger)."""
+        payload = {"prompt": prompt[:500], "answer": answer[:1000]}
+        if cached:
+            payload["cached"] = True
+        now = datetime.utcnow()
+        started = now - timedelta(milliseconds=duration_ms)
+        self._chat_jobs.append((tg_id, status, json.dumps(payload, ensure_ascii=False), started.isoformat(), now.isoformat(), duration_ms))
+        if len(self._chat_jobs) >= self.ledger_batch:
+            self._ledger_wakeup.set()
+
+    @timed_query("sweep_jobs")
+    async def sweep_jobs(self, finished_before: str, batch: int = 1000) -> int:
+        """Delete finished jobs older than finished_before (ISO time), a batch per transaction
+        so the writer is never held for long. Pending jobs are kept. Returns rows deleted."""
+        deleted = 0
+        while True:
+            async with self._write() as db:
+                cur = await db.execute(
+                    """
+                    DELETE FROM jobs WHERE id IN (
+                        SELECT id FROM jobs
+                        WHERE status IN ('done', 'failed', 'timeout') AND finished_at < ?
+                        LIMIT ?
+                    )
+                    """,
+                    (finished_before, batch),
+                )
+                n = cur.rowcount
+            deleted += n
+            if n < batch:
+                return deleted
+            await asyncio.sleep(0)  # let queued writes in between batches
+
+    # -------- chat response cache --------
+    @timed_query("chat_cache_get")
+    async def chat_cache_get(self, key: str, now: float) -> Optional[Tuple[float, str]]:
+        """(expires_at, answer) of a live cache entry."""
+        async with self._read() as db:
+            cur = await db.execute("SELECT expires_at, answer FROM chat_cache WHERE key=? AND expires_at>?", (key, now))
+            row = await cur.fetchone()
+            return (row["expires_at"], row["answer"]) if row else None
+
+    @timed_query("chat_cache_put")
+    async def chat_cache_put(self, key: str, model: str, answer: str, expires_at: float):
+        async with self._write() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO chat_cache (key, model, answer, created_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                (key, model, answer, time.time(), expires_at),
+            )
+
+    @timed_query("chat_cache_evict")
+    async def chat_cache_evict(self, now: float, max_rows: int):
+        """Drop expired entries, then the oldest ones above max_rows."""
+        async with self._write() as db:
+            await db.execute("DELETE FROM chat_cache WHERE expires_at<=?", (now,))
+            await db.execute(
+                "DELETE FROM chat_cache WHERE key IN (SELECT key FROM chat_cache ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (max_rows,),
+            )
+
+    # -------- Telegram file_id cache --------
+    @timed_query("get_media_file")
+    async def get_media_file(self, url: Optional[str] = None, request_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """Stored Telegram copy of a result, looked up by provider URL or request_id."""
+        async with self._read() as db:
+            cur = await db.execute(
+                "SELECT * FROM media_files WHERE url=? OR request_id=? LIMIT 1",
+                (url, request_id),
+            )
+            row = await cur.fetchone()
+            return dict(row) if row else None
+
+    @timed_query("save_media_file")
+    async def save_media_file(self, url: str, request_id: Optional[str], kind: str, file_id: str):
+        async with self._write() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO media_files (url, request_id, kind, file_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                (url, request_id, kind, file_id, time.time()),
+            )
+
+    @timed_query("forget_media_file")
+    async def forget_media_file(self, file_id: str):
+        """Drop a file_id Telegram no longer accepts."""
+        async with self._write() as db:
+            await db.execute("DELETE FROM media_files WHERE file_id=?", (file_id,))
+
+    # -------- idempotency keys --------
+    @timed_query("idem_claim")
+    async def idem_claim(self, key: str, tg_id: int, body_hash: Optional[str], now: float, expires_at: float, stale_before: float) -> Optional[Dict[str, Any]]:
+        """Claim a key for a new request. None if it is ours now; otherwise the existing row
+        (response_json is NULL while that request runs). Expired keys and claims left
+        unfinished since stale_before (crashed worker) are taken over."""
+        async with self._write() as db:
+            cur = await db.execute(
+                """
+                INSERT INTO idempotency (key, tg_id, body_hash, response_json, created_at, expires_at) VALUES (?, ?, ?, NULL, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    tg_id=excluded.tg_id, body_hash=excluded.body_hash, response_json=NULL,
+                    created_at=excluded.created_at, expires_at=excluded.expires_at
+                WHERE idempotency.expires_at <= excluded.created_at
+                    OR (idempotency.response_json IS NULL AND idempotency.created_at < ?)
+                RETURNING key
+                """,
+                (key, tg_id, body_hash, now, expires_at, stale_before),
+            )
+            if await cur.fetchone() is not None:
+                return None
+            cur = await db.execute("SELECT * FROM idempotency WHERE key=?", (key,))
+            row = await cur.fetchone()
+            return dict(row) if row else None
+
+    @timed_query("idem_finish")
+    async def idem_finish(self, key: str, response_json: str):
+        async with self._write() as db:
+            await db.execute("UPDATE idempotency SET response_json=? WHERE key=?", (response_json, key))
+
+    @timed_query("idem_release")
+    async def idem_release(self, key: str):
+        """Forget a claim whose request failed, so a retry runs for real."""
+        async with self._write() as db:
+            await db.execute("DELETE FROM idempotency WHERE key=? AND response_json IS NULL", (key,))
+
+    @timed_query("idem_evict")
+    async def idem_evict(self, now: float):
+        async with self._write() as db:
+            await db.execute("DELETE FROM idempotency WHERE expires_at<=?", (now,))
+
+    # -------- chat memory --------
+    @timed_query("get_conversation")
+    async def get_conversation(self, tg_id: int) -> Optional[Dict[str, Any]]:
+        async with self._read() as db:
+            cur = await db.execute("SELECT * FROM conversations WHERE tg_id=?", (tg_id,))
+            row = await cur.fetchone()
+        if row is None:
+            return None
+        return {"summary": row["summary"], "turns": json.loads(row["turns_json"]), "tokens": row["tokens"], "updated_at": row["updated_at"]}
+
+    @timed_query("append_conversation")
+    async def append_conversation(self, tg_id: int, turns: List[list], now: float, idle_s: float, max_turns: int) -> int:
+        """Append [role, content, tokens] turns; a conversation idle for idle_s starts over.
+        Keeps at most max_turns turns. Returns the estimated tokens now stored."""
+        async with self._write() as db:
+            cur = await db.execute("SELECT summary, turns_json, updated_at FROM conversations WHERE tg_id=?", (tg_id,))
+            row = await cur.fetchone()
+            summary, old = "", []
+            if row is not None and row["updated_at"] > now - idle_s:
+                summary, old = row["summary"], json.loads(row["turns_json"])
+            merged = (old + turns)[-max_turns:]
+            tokens = sum(t[2] for t in merged)
+            await db.execute(
+                "INSERT OR REPLACE INTO conversations (tg_id, summary, turns_json, tokens, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (tg_id, summary, json.dumps(merged, ensure_ascii=False), tokens, now),
+            )
+        return tokens
+
+    @timed_query("compact_conversation")
+    async def compact_conversation(self, tg_id: int, compacted: List[list], summary: str) -> bool:
+        """Replace the leading `compacted` turns with `summary`. False if the turns
+        changed meanwhile (reset / trimmed), in which case nothing is written."""
+        async with self._write() as db:
+            cur = await db.execute("SELECT turns_json FROM conversations WHERE tg_id=?", (tg_id,))
             row = await cur.fetchone()
-            if not row:
+            if row is None:
                 return False
-            pro = row["credits_pro"]
-            free = row["credits_free"]
-            if pro > 0:
-                await db.execute("UPDATE users SET credits_pro = credits_pro - 1 WHERE tg_id=?", (tg_id,))
-                await db.commit()
-                return True
-            if free > 0:
-                await db.execute("UPDATE users SET credits_free = credits_free - 1 WHERE tg_id=?", (tg_id,))
-                await db.commit()
-                return True
-            return False
+            turns = json.loads(row["turns_json"])
+            if turns[: len(compacted)] != compacted:
+                return False
+            rest = turns[len(compacted):]
+            await db.execute(
+                "UPDATE conversations SET summary=?, turns_json=?, tokens=? WHERE tg_id=?",
+                (summary, json.dumps(rest, ensure_ascii=False), sum(t[2] for t in rest), tg_id),
+            )
+            return True
+
+    @timed_query("clear_conversation")
+    async def clear_conversation(self, tg_id: int):
+        async with self._write() as db:
+            await db.execute("DELETE FROM conversations WHERE tg_id=?", (tg_id,))
+
+    # -------- credit ledger (write-behind) --------
+    def _record(self, tg_id: int, delta: int, bucket: str, reason: str):
+        self._ledger.append((tg_id, delta, bucket, reason, datetime.utcnow().isoformat()))
+        if len(self._ledger) >= self.ledger_batch:
+            self._ledger_wakeup.set()
+
+    @timed_query("flush_ledger")
+    async def flush_ledger(self):
+        """Insert all buffered credit events and chat jobs in one transaction."""
+        if not (self._ledger or self._chat_jobs) or self._writer is None:
+            return
+        batch, self._ledger = self._ledger, []
+        chats, self._chat_jobs = self._chat_jobs, []
+        try:
+            async with self._write() as db:
+                await db.executemany(
+                    "INSERT INTO credit_events (tg_id, delta, bucket, reason, created_at) VALUES (?, ?, ?, ?, ?)",
+                    batch,
+                )
+                await db.executemany(
+                    """
+                    INSERT INTO jobs (tg_id, kind, status, payload_json, created_at, finished_at, duration_ms)
+                    VALUES (?, 'chat', ?, ?, ?, ?, ?)
+                    """,
+                    chats,
+                )
+        except BaseException:
+            # keep the events for the next attempt (also when cancelled mid-flush)
+            self._ledger = batch + self._ledger
+            self._chat_jobs = chats + self._chat_jobs
+            raise
+
+    async def _ledger_flusher(self):
+        while not self._ledger_stopping:
+            try:
+                await asyncio.wait_for(self._ledger_wakeup.wait(), timeout=self.ledger_flush_s)
+            except asyncio.TimeoutError:
+                pass
+            self._ledger_wakeup.clear()
+            try:
+                await self.flush_ledger()
+            except Exception as e:
+                print("[storage] ledger flush failed:", e)
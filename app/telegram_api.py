@@ -1,52 +1,399 @@
 from __future__ import annotations
+import asyncio
+import itertools
+import json as jsonlib
+import time
+import uuid
 import httpx
-from typing import Any, Dict, Optional
+from dataclasses import dataclass
+from typing import Any, AsyncContextManager, AsyncIterator, Callable, Dict, Optional, Tuple, Union
+
+from .metrics import TELEGRAM_SECONDS
+
+# Send priorities (lower is sent first).
+PRIORITY_HIGH = 0     # direct replies to a user action
+PRIORITY_NORMAL = 1   # background deliveries (job results)
+PRIORITY_LOW = 2      # bulk traffic (broadcasts)
+
+
+class TelegramAPIError(RuntimeError):
+    """Telegram returned ok=false. Keeps the raw response for callers."""
+
+    def __init__(self, data: Dict[str, Any]):
+        super().__init__(f"Telegram API error: {data}")
+        self.data = data
+        self.error_code = data.get("error_code")
+        self.description = data.get("description", "")
+        self.retry_after = (data.get("parameters") or {}).get("retry_after")
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Seconds until one token is available (0 if it is available now)."""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self):
+        self.tokens -= 1
+
+    def idle(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+@dataclass
+class InputFile:
+    """A file uploaded as multipart/form-data without buffering it in memory.
+
+    `open()` is an async context manager yielding (chunks, length or None). It is
+    entered again on every retry, so it must be re-readable (e.g. re-download).
+    """
+    field: str  # "photo", "video", "document", ...
+    filename: str
+    content_type: str
+    open: Callable[[], AsyncContextManager[Tuple[AsyncIterator[bytes], Optional[int]]]]
+
+
+def _form_value(value: Any) -> str:
+    """Bot API form fields: JSON for objects (reply_markup), lowercase booleans."""
+    if isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return jsonlib.dumps(value, ensure_ascii=False)
+    return str(value)
+
+
+def _multipart(fields: Dict[str, Any], upload: InputFile, chunks: AsyncIterator[bytes], length: Optional[int]) -> Tuple[str, AsyncIterator[bytes], Optional[int]]:
+    """Stream a multipart body: text fields, then the file chunks as they arrive."""
+    boundary = uuid.uuid4().hex
+    head = b""
+    for name, value in fields.items():
+        head += f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode() + _form_value(value).encode("utf-8") + b"\r\n"
+    head += (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{upload.field}"; filename="{upload.filename}"\r\n'
+        f"Content-Type: {upload.content_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body():
+        yield head
+        async for chunk in chunks:
+            yield chunk
+        yield tail
+
+    total = len(head) + length + len(tail) if length is not None else None
+    return f"multipart/form-data; boundary={boundary}", body(), total
+
+
+@dataclass
+class _SendJob:
+    chat_id: int
+    method: str
+    payload: Dict[str, Any]
+    future: asyncio.Future
+    attempts: int = 0
+    upload: Optional[InputFile] = None
+
 
 class TelegramAPI:
-    def __init__(self, bot_token: str):
+    def __init__(
+        self,
+        bot_token: str,
+        timeout_s: float = 60.0,
+        global_rate: float = 30.0,
+        per_chat_rate: float = 1.0,
+        per_chat_burst: float = 3.0,
+        group_rate: float = 20.0 / 60.0,
+        send_workers: int = 8,
+        max_retries: int = 5,
+        api_base: str = "https://api.telegram.org",
+        upload_timeout_s: float = 300.0,
+        upload_workers: int = 4,
+    ):
         self.bot_token = bot_token
-        self.base = f"https://api.telegram.org/bot{bot_token}"
+        self.base = f"{api_base.rstrip('/')}/bot{bot_token}"
+        self.timeout_s = timeout_s
+        self.upload_timeout_s = upload_timeout_s
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.group_rate = group_rate
+        self.send_workers = send_workers
+        self.upload_workers = upload_workers
+        self.max_retries = max_retries
+        self._client: Optional[httpx.AsyncClient] = None
+        self._global = _TokenBucket(global_rate, global_rate)
+        self._chats: Dict[int, _TokenBucket] = {}
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._workers: list = []
+        self._seq = itertools.count()
+        self._delayed = 0
+        # file uploads run off the send workers: one can take minutes, replies must not wait for it
+        self._upload_slots = asyncio.Semaphore(upload_workers)
+        self._uploads: set = set()
+
+    # -------- lifecycle --------
+    async def start(self):
+        """Open the shared connection pool and start the send queue workers."""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout_s)
+        if not self._workers:
+            self._queue = asyncio.PriorityQueue()
+            self._workers = [asyncio.create_task(self._send_worker()) for _ in range(self.send_workers)]
+
+    async def aclose(self, drain_timeout_s: float = 5.0):
+        """Flush queued sends (bounded by drain_timeout_s), stop workers and close the pool."""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=drain_timeout_s)
+            except asyncio.TimeoutError:
+                pass
+        for w in self._workers:
+            w.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        uploads = list(self._uploads)
+        if uploads:
+            await asyncio.wait(uploads, timeout=drain_timeout_s)
+        for t in uploads:
+            t.cancel()
+        await asyncio.gather(*uploads, return_exceptions=True)
+        self._workers = []
+        if self._queue is not None:
+            while not self._queue.empty():
+                _, _, job = self._queue.get_nowait()
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError("Telegram sender stopped"))
+            self._queue = None
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def queue_depth(self) -> int:
+        """Sends waiting for a rate-limit slot (queued + delayed for retry) or an upload slot."""
+        if self._queue is None:
+            return 0
+        return self._queue.qsize() + self._delayed + len(self._uploads)
 
-    async def _post(self, method: str, json: Dict[str, Any]) -> Dict[str, Any]:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            r = await client.post(f"{self.base}/{method}", json=json)
+    async def _http(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=self.timeout_s)
+        return self._client
+
+    # -------- raw calls --------
+    @staticmethod
+    def _parse(r: httpx.Response) -> Dict[str, Any]:
+        try:
             data = r.json()
-            if not data.get("ok"):
-                raise RuntimeError(f"Telegram API error: {data}")
+        except ValueError:
+            data = {"ok": False, "error_code": r.status_code, "description": r.text[:500]}
+        if not data.get("ok"):
+            raise TelegramAPIError(data)
+        return data
+
+    async def _post(self, method: str, json: Dict[str, Any], upload: Optional[InputFile] = None, timeout_s: Optional[float] = None) -> Dict[str, Any]:
+        client = await self._http()
+        t = time.perf_counter()
+        outcome = "error"
+        try:
+            if upload is None:
+                r = await client.post(f"{self.base}/{method}", json=json, timeout=timeout_s or self.timeout_s)
+            else:
+                async with upload.open() as (chunks, length):
+                    content_type, body, total = _multipart(json, upload, chunks, length)
+                    headers = {"Content-Type": content_type}
+                    if total is not None:
+                        headers["Content-Length"] = str(total)
+                    r = await client.post(
+                        f"{self.base}/{method}",
+                        content=body,
+                        headers=headers,
+                        timeout=httpx.Timeout(self.upload_timeout_s, connect=10.0),
+                    )
+            data = self._parse(r)
+            outcome = "ok"
             return data
+        finally:
+            TELEGRAM_SECONDS.labels(method, outcome).observe(time.perf_counter() - t)
 
     async def _get(self, method: str, params: Optional[Dict[str, Any]]=None) -> Dict[str, Any]:
-        async with httpx.AsyncClient(timeout=60.0) as client:
+        client = await self._http()
+        t = time.perf_counter()
+        outcome = "error"
+        try:
             r = await client.get(f"{self.base}/{method}", params=params)
-            data = r.json()
-            if not data.get("ok"):
-                raise RuntimeError(f"Telegram API error: {data}")
+            data = self._parse(r)
+            outcome = "ok"
             return data
+        finally:
+            TELEGRAM_SECONDS.labels(method, outcome).observe(time.perf_counter() - t)
+
+    # -------- rate-limited send queue --------
+    def _chat_bucket(self, chat_id: int) -> _TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if len(self._chats) > 10000:
+                self._chats = {k: v for k, v in self._chats.items() if not v.idle()}
+            # negative ids are groups/channels: Telegram allows ~20 msg/min there
+            rate = self.group_rate if chat_id < 0 else self.per_chat_rate
+            b = self._chats[chat_id] = _TokenBucket(rate, self.per_chat_burst if chat_id > 0 else 1)
+        return b
+
+    def _requeue_later(self, item: Tuple[int, int, _SendJob], delay: float):
+        self._delayed += 1
+
+        def _put():
+            self._delayed -= 1
+            if self._queue is not None:
+                self._queue.put_nowait(item)
+            elif not item[2].future.done():
+                item[2].future.set_exception(RuntimeError("Telegram sender stopped"))
+
+        asyncio.get_running_loop().call_later(delay, _put)
+
+    async def _send_worker(self):
+        while True:
+            item = await self._queue.get()
+            try:
+                await self._process(item)
+            except Exception as e:
+                job = item[2]
+                if not job.future.done():
+                    job.future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, item: Tuple[int, int, _SendJob]):
+        job = item[2]
+        if job.future.done():  # caller gave up
+            return
+        bucket = self._chat_bucket(job.chat_id)
+        wait = bucket.delay()
+        if wait > 0:
+            # don't block the worker on one busy chat; other chats keep flowing
+            self._requeue_later(item, wait)
+            return
+        while (wait := self._global.delay()) > 0:
+            await asyncio.sleep(wait)
+        self._global.take()
+        bucket.take()
+        if job.upload is not None:
+            task = asyncio.create_task(self._upload(item, bucket))
+            self._uploads.add(task)
+            task.add_done_callback(self._uploads.discard)
+            return
+        await self._deliver(item, bucket)
+
+    async def _upload(self, item: Tuple[int, int, _SendJob], bucket: _TokenBucket):
+        try:
+            async with self._upload_slots:
+                await self._deliver(item, bucket)
+        except Exception as e:
+            if not item[2].future.done():
+                item[2].future.set_exception(e)
+
+    async def _deliver(self, item: Tuple[int, int, _SendJob], bucket: _TokenBucket):
+        """The call itself, once rate tokens are taken; retries go back through the queue."""
+        job = item[2]
+        try:
+            data = await self._post(job.method, job.payload, job.upload)
+        except TelegramAPIError as e:
+            if e.retry_after and job.attempts < self.max_retries:
+                # The global bucket keeps us under the bot-wide limit, so a 429 is
+                # almost always a per-chat flood: pause only that chat.
+                job.attempts += 1
+                bucket.blocked_until = time.monotonic() + float(e.retry_after)
+                self._requeue_later(item, float(e.retry_after))
+                return
+            raise
+        except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+            # only retry errors where the request surely never reached Telegram (no duplicates)
+            if job.attempts < self.max_retries:
+                job.attempts += 1
+                self._requeue_later(item, min(0.5 * 2 ** job.attempts, 30.0))
+                return
+            raise
+        if not job.future.done():
+            job.future.set_result(data)
+
+    async def _send(self, chat_id: int, method: str, payload: Dict[str, Any], priority: int=PRIORITY_HIGH, upload: Optional[InputFile]=None) -> Dict[str, Any]:
+        """Send through the rate-limited queue; falls back to a direct call if the queue isn't running."""
+        if not self._workers:
+            return await self._post(method, payload, upload)
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), _SendJob(chat_id, method, payload, fut, upload=upload)))
+        return await fut
+
+    async def _send_media(self, chat_id: int, method: str, field: str, media: Union[str, InputFile], caption: Optional[str], reply_markup: Optional[Dict[str, Any]], priority: int) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {"chat_id": chat_id, "parse_mode": "HTML"}
+        upload = None
+        if isinstance(media, InputFile):
+            upload = media
+        else:
+            payload[field] = media  # URL or file_id
+        if caption:
+            payload["caption"] = caption
+        if reply_markup:
+            payload["reply_markup"] = reply_markup
+        return await self._send(chat_id, method, payload, priority, upload)
 
+    # -------- methods --------
     async def set_webhook(self, url: str):
         return await self._post("setWebhook", {"url": url})
 
-    async def send_message(self, chat_id: int, text: str, reply_markup: Optional[Dict[str, Any]]=None, disable_web_page_preview: bool=True):
+    async def delete_webhook(self, drop_pending_updates: bool = False):
+        return await self._post("deleteWebhook", {"drop_pending_updates": drop_pending_updates})
+
+    async def get_updates(self, offset: Optional[int] = None, timeout_s: int = 50, limit: int = 100, allowed_updates: Optional[list] = None):
+        """Long-poll for updates. Passing `offset` confirms every update below it."""
+        payload: Dict[str, Any] = {"timeout": timeout_s, "limit": limit}
+        if offset is not None:
+            payload["offset"] = offset
+        if allowed_updates is not None:
+            payload["allowed_updates"] = allowed_updates
+        # the HTTP timeout must outlast the long-poll timeout
+        return await self._post("getUpdates", payload, timeout_s=timeout_s + 10)
+
+    async def send_message(self, chat_id: int, text: str, reply_markup: Optional[Dict[str, Any]]=None, disable_web_page_preview: bool=True, priority: int=PRIORITY_HIGH):
         payload: Dict[str, Any] = {"chat_id": chat_id, "text": text, "parse_mode": "HTML", "disable_web_page_preview": disable_web_page_preview}
         if reply_markup:
             payload["reply_markup"] = reply_markup
-        return await self._post("sendMessage", payload)
+        return await self._send(chat_id, "sendMessage", payload, priority)
 
-    async def send_photo(self, chat_id: int, photo_url: str, caption: Optional[str]=None, reply_markup: Optional[Dict[str, Any]]=None):
-        payload: Dict[str, Any] = {"chat_id": chat_id, "photo": photo_url, "parse_mode": "HTML"}
-        if caption:
-            payload["caption"] = caption
-        if reply_markup:
-            payload["reply_markup"] = reply_markup
-        return await self._post("sendPhoto", payload)
+    async def send_photo(self, chat_id: int, photo: Union[str, InputFile], caption: Optional[str]=None, reply_markup: Optional[Dict[str, Any]]=None, priority: int=PRIORITY_NORMAL):
+        """`photo` is a URL, a file_id or an InputFile (multipart upload)."""
+        return await self._send_media(chat_id, "sendPhoto", "photo", photo, caption, reply_markup, priority)
 
-    async def send_video(self, chat_id: int, video_url: str, caption: Optional[str]=None, reply_markup: Optional[Dict[str, Any]]=None):
-        payload: Dict[str, Any] = {"chat_id": chat_id, "video": video_url, "parse_mode": "HTML"}
-        if caption:
-            payload["caption"] = caption
+    async def send_video(self, chat_id: int, video: Union[str, InputFile], caption: Optional[str]=None, reply_markup: Optional[Dict[str, Any]]=None, priority: int=PRIORITY_NORMAL):
+        """`video` is a URL, a file_id or an InputFile (multipart upload)."""
+        return await self._send_media(chat_id, "sendVideo", "video", video, caption, reply_markup, priority)
+
+    async def edit_message_text(self, chat_id: int, message_id: int, text: str, reply_markup: Optional[Dict[str, Any]]=None, priority: int=PRIORITY_HIGH):
+        payload: Dict[str, Any] = {"chat_id": chat_id, "message_id": message_id, "text": text, "parse_mode": "HTML", "disable_web_page_preview": True}
         if reply_markup:
             payload["reply_markup"] = reply_markup
-        return await self._post("sendVideo", payload)
+        try:
+            return await self._send(chat_id, "editMessageText", payload, priority)
+        except TelegramAPIError as e:
+            if "message is not modified" in e.description:
+                return {"ok": True, "result": None}
+            raise
 
     async def answer_callback_query(self, callback_query_id: str, text: Optional[str]=None, show_alert: bool=False):
         payload: Dict[str, Any] = {"callback_query_id": callback_query_id, "show_alert": show_alert}
@@ -66,4 +413,4 @@ class TelegramAPI:
             "prices": prices,
             "start_parameter": start_parameter
         }
-        return await self._post("sendInvoice", req)
+        return await self._send(chat_id, "sendInvoice", req)
@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict, deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from .metrics import UPDATE_SECONDS
+from .telegram_api import TelegramAPI
+
+Handler = Callable[[Dict[str, Any]], Awaitable[Any]]
+
+
+def chat_key(update: Dict[str, Any]) -> Any:
+    """Ordering key of an update: its chat, or the user for chat-less updates."""
+    for field in ("message", "edited_message", "channel_post"):
+        if field in update:
+            return update[field]["chat"]["id"]
+    if "callback_query" in update:
+        cq = update["callback_query"]
+        msg = cq.get("message") or {}
+        return (msg.get("chat") or {}).get("id") or cq["from"]["id"]
+    for field in ("pre_checkout_query", "inline_query", "shipping_query"):
+        if field in update:
+            return update[field]["from"]["id"]
+    return ("update", update.get("update_id"))
+
+
+class UpdateDispatcher:
+    """Bounded queue of Telegram updates drained by a pool of workers.
+
+    Updates of one chat are handled strictly in arrival order; different chats
+    run in parallel. Recently seen update_ids are remembered so Telegram's
+    redeliveries are dropped.
+    """
+
+    def __init__(self, handler: Handler, workers: int = 8, max_queue: int = 1000, dedupe_size: int = 10000):
+        self.handler = handler
+        self.workers = workers
+        self.max_queue = max_queue
+        self.dedupe_size = dedupe_size
+        self._seen: "OrderedDict[int, None]" = OrderedDict()
+        # per chat: (update, future resolved once it's handled)
+        self._pending: Dict[Any, Deque[Tuple[Dict[str, Any], Optional[asyncio.Future]]]] = {}
+        self._ready: Optional[asyncio.Queue] = None
+        self._size = 0
+        self._tasks: list = []
+
+    async def start(self):
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, drain_timeout_s: float = 10.0):
+        """Give queued updates a chance to finish, then stop the workers."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + drain_timeout_s
+        while self._size and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def depth(self) -> int:
+        return self._size
+
+    def is_duplicate(self, update_id: int) -> bool:
+        return update_id in self._seen
+
+    def enqueue(self, update: Dict[str, Any], done: Optional[asyncio.Future] = None) -> bool:
+        """Queue an update. Returns False when the queue is full (caller should make Telegram retry).
+
+        `done` (optional) is resolved once the update has been handled.
+        """
+        update_id = update.get("update_id")
+        if update_id in self._seen:
+            if done is not None and not done.done():
+                done.set_result(None)
+            return True
+        if self._size >= self.max_queue:
+            return False
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedupe_size:
+            self._seen.popitem(last=False)
+        key = chat_key(update)
+        self._size += 1
+        dq = self._pending.get(key)
+        if dq is not None:
+            # chat is queued or being processed; its worker will pick this up next
+            dq.append((update, done))
+            return True
+        self._pending[key] = deque([(update, done)])
+        self._ready.put_nowait(key)
+        return True
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            dq = self._pending[key]
+            update, done = dq[0]
+            t = time.perf_counter()
+            try:
+                await self.handler(update)
+            except Exception as e:
+                print("handle_update error:", e)
+            finally:
+                UPDATE_SECONDS.observe(time.perf_counter() - t)
+                if done is not None and not done.done():
+                    done.set_result(None)
+                dq.popleft()
+                self._size -= 1
+                if dq:
+                    self._ready.put_nowait(key)
+                else:
+                    del self._pending[key]
+
+
+class LongPoller:
+    """getUpdates loop feeding an UpdateDispatcher (no public webhook URL needed).
+
+    Each batch (up to `limit` updates) is fanned out to the dispatcher workers and
+    its offset is confirmed to Telegram with the next getUpdates only once the
+    batch has been handled, so a crash redelivers it. A batch that takes longer
+    than `batch_wait_s` (e.g. a long streamed answer) stops holding up the next
+    one: its remaining updates are still queued and finish in the background.
+    """
+
+    def __init__(
+        self,
+        tg: TelegramAPI,
+        dispatcher: UpdateDispatcher,
+        timeout_s: int = 50,
+        limit: int = 100,
+        batch_wait_s: float = 10.0,
+        prepare: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        self.tg = tg
+        self.dispatcher = dispatcher
+        self.timeout_s = timeout_s
+        self.limit = limit
+        self.batch_wait_s = batch_wait_s
+        self.prepare = prepare
+        self.offset: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        if self.offset is not None:
+            try:
+                # confirm the last handled batch so a restart doesn't redeliver it
+                await self.tg.get_updates(offset=self.offset, timeout_s=0, limit=1)
+            except Exception as e:
+                print("[updates] final offset commit failed:", e)
+
+    async def _run(self):
+        backoff = 1.0
+        webhook_removed = False
+        while True:
+            try:
+                if not webhook_removed:
+                    # getUpdates is refused while a webhook is set
+                    await self.tg.delete_webhook()
+                    webhook_removed = True
+                data = await self.tg.get_updates(offset=self.offset, timeout_s=self.timeout_s, limit=self.limit)
+            except Exception as e:
+                print("[updates] getUpdates failed:", e)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = 1.0
+            batch = data.get("result") or []
+            if batch:
+                await self._dispatch(batch)
+                self.offset = batch[-1]["update_id"] + 1
+
+    async def _dispatch(self, batch: List[Dict[str, Any]]):
+        loop = asyncio.get_running_loop()
+        futures = []
+        for update in batch:
+            if self.prepare is not None:
+                self.prepare(update)
+            done = loop.create_future()
+            while not self.dispatcher.enqueue(update, done):
+                await asyncio.sleep(0.05)  # queue full: wait for workers instead of dropping
+            futures.append(done)
+        await asyncio.wait(futures, timeout=self.batch_wait_s)
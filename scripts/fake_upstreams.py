@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""Local stand-ins for ApiFree and the Telegram Bot API (used by scripts/loadtest.py).
+
+ApiFree:  POST /v1/chat/completions (plain and stream=true),
+          POST /v1/{image,video}/submit, GET /v1/{image,video}/{id}/result;
+          a submit with callback_url gets the result POSTed there when the job is done
+Telegram: POST /bot<token>/<method> (sendMessage, sendPhoto, sendVideo, editMessageText, ...),
+          JSON or multipart uploads; getUpdates serves updates queued with POST /_updates
+Files:    GET /files/<name> — result media (--file-kb bytes) the result URLs point to
+Stats:    GET /_stats — calls per endpoint, so the load test can report upstream traffic.
+
+    python scripts/fake_upstreams.py --port 9100 --latency-ms 300 --fail-rate 0.02 --job-s 5
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+def create_app(
+    latency_ms: float = 200.0,
+    jitter_ms: float = 50.0,
+    fail_rate: float = 0.0,
+    job_s: float = 5.0,
+    stream_chunks: int = 20,
+    tg_latency_ms: float = 30.0,
+    tg_fail_rate: float = 0.0,
+    file_kb: int = 512,
+) -> FastAPI:
+    app = FastAPI(title="fake upstreams")
+    calls: Counter = Counter()
+    jobs: Dict[str, float] = {}  # request_id -> finishes at (monotonic)
+    ids = itertools.count(1)
+    message_ids = itertools.count(1)
+    updates: List[Dict[str, Any]] = []  # not yet confirmed through getUpdates offset
+    new_updates = asyncio.Event()
+    update_ids = itertools.count(1)
+    pending_callbacks: set = set()  # keeps callback tasks referenced until they finish
+    callback_http = httpx.AsyncClient(timeout=30.0)  # one pool: a client per callback costs an SSL context each
+
+    async def _delay(base_ms: float):
+        await asyncio.sleep(max(0.0, random.gauss(base_ms, jitter_ms)) / 1000.0)
+
+    def _failed(rate: float) -> bool:
+        return rate > 0 and random.random() < rate
+
+    # -------- ApiFree --------
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        calls["apifree.chat"] += 1
+        await _delay(latency_ms)
+        if _failed(fail_rate):
+            calls["apifree.chat.failed"] += 1
+            return JSONResponse({"error": "fake upstream failure"}, status_code=500)
+        text = (body.get("messages") or [{}])[-1].get("content") or ""
+        words = [f"w{i}" for i in range(stream_chunks)] + [text[:50]]
+        if not body.get("stream"):
+            return {"choices": [{"message": {"role": "assistant", "content": " ".join(words)}}]}
+
+        async def _events():
+            for w in words:
+                chunk = {"choices": [{"delta": {"content": w + " "}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(latency_ms / 1000.0 / max(1, stream_chunks))
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(_events(), media_type="text/event-stream")
+
+    async def _submit(kind: str, request: Request):
+        calls[f"apifree.{kind}_submit"] += 1
+        body = await request.json()
+        await _delay(latency_ms)
+        if _failed(fail_rate):
+            calls[f"apifree.{kind}_submit.failed"] += 1
+            return JSONResponse({"error": "fake upstream failure"}, status_code=500)
+        request_id = f"{kind}-{next(ids)}"
+        jobs[request_id] = time.monotonic() + job_s
+        if body.get("callback_url"):
+            ext = "png" if kind == "image" else "mp4"
+            result = {"request_id": request_id, "status": "succeeded", "url": f"{request.base_url}files/{request_id}.{ext}"}
+            pending_callbacks.add(asyncio.create_task(_callback(body["callback_url"], result)))
+        return {"request_id": request_id, "status": "queued"}
+
+    async def _callback(url: str, result: Dict[str, Any]):
+        await asyncio.sleep(job_s)
+        calls["apifree.callback"] += 1
+        try:
+            r = await callback_http.post(url, json=result)
+            if r.status_code >= 400:
+                calls["apifree.callback.failed"] += 1
+        except httpx.HTTPError:
+            calls["apifree.callback.failed"] += 1
+        finally:
+            pending_callbacks.discard(asyncio.current_task())
+
+    async def _result(kind: str, request_id: str, request: Request):
+        calls[f"apifree.{kind}_result"] += 1
+        await _delay(latency_ms / 4)
+        done_at = jobs.get(request_id)
+        if done_at is None:
+            return JSONResponse({"error": "unknown request_id"}, status_code=404)
+        if time.monotonic() < done_at:
+            return {"request_id": request_id, "status": "processing"}
+        ext = "png" if kind == "image" else "mp4"
+        return {"request_id": request_id, "status": "succeeded", "url": f"{request.base_url}files/{request_id}.{ext}"}
+
+    @app.post("/v1/image/submit")
+    async def image_submit(request: Request):
+        return await _submit("image", request)
+
+    @app.post("/v1/video/submit")
+    async def video_submit(request: Request):
+        return await _submit("video", request)
+
+    @app.get("/v1/image/{request_id}/result")
+    async def image_result(request_id: str, request: Request):
+        return await _result("image", request_id, request)
+
+    @app.get("/v1/video/{request_id}/result")
+    async def video_result(request_id: str, request: Request):
+        return await _result("video", request_id, request)
+
+    @app.get("/files/{name}")
+    async def files(name: str):
+        calls["files.download"] += 1
+        media_type = "video/mp4" if name.endswith(".mp4") else "image/png"
+
+        async def _body():
+            chunk = b"\0" * 65536
+            left = file_kb * 1024
+            while left > 0:
+                yield chunk[:left]
+                left -= len(chunk)
+
+        return StreamingResponse(_body(), media_type=media_type, headers={"Content-Length": str(file_kb * 1024)})
+
+    # -------- Telegram --------
+    @app.api_route("/bot{token}/{method}", methods=["GET", "POST"])
+    async def telegram(token: str, method: str, request: Request):
+        calls[f"telegram.{method}"] += 1
+        await _delay(tg_latency_ms)
+        if method.startswith("send") and _failed(tg_fail_rate):
+            calls[f"telegram.{method}.429"] += 1
+            return JSONResponse(
+                {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}},
+                status_code=429,
+            )
+        if method == "getUpdates":
+            return await _get_updates(await request.json())
+        body: Dict[str, Any] = {}
+        if request.method == "POST":
+            if request.headers.get("content-type", "").startswith("multipart/form-data"):
+                form = await request.form()
+                body = {k: v for k, v in form.items() if isinstance(v, str)}
+                calls[f"telegram.{method}.upload"] += 1
+            else:
+                try:
+                    body = await request.json()
+                except ValueError:
+                    body = {}
+        if method in ("setWebhook", "answerCallbackQuery", "deleteWebhook"):
+            return {"ok": True, "result": True}
+        result: Dict[str, Any] = {"message_id": next(message_ids), "chat": {"id": body.get("chat_id")}, "date": int(time.time())}
+        file_id = f"file-{next(ids)}"
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 512, "height": 512}]
+        elif method == "sendVideo":
+            result["video"] = {"file_id": file_id, "file_unique_id": file_id, "duration": 5}
+        return {"ok": True, "result": result}
+
+    async def _get_updates(params: Dict[str, Any]):
+        offset = params.get("offset")
+        if offset is not None:
+            updates[:] = [u for u in updates if u["update_id"] >= offset]
+        if not updates and params.get("timeout"):
+            new_updates.clear()
+            try:
+                await asyncio.wait_for(new_updates.wait(), timeout=float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        batch = updates[: int(params.get("limit") or 100)]
+        calls["telegram.getUpdates.delivered"] += len(batch)
+        return {"ok": True, "result": batch}
+
+    @app.post("/_updates")
+    async def push_updates(request: Request):
+        body = await request.json()
+        for update in body if isinstance(body, list) else [body]:
+            # like Telegram: ids increase in queue order (concurrent pushes may arrive out of order)
+            update["update_id"] = next(update_ids)
+            updates.append(update)
+        new_updates.set()
+        return {"ok": True}
+
+    @app.get("/_updates")
+    async def pending_updates():
+        return {"pending": len(updates)}
+
+    @app.get("/_stats")
+    async def stats():
+        return dict(calls)
+
+    return app
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--latency-ms", type=float, default=200.0, help="mean ApiFree latency")
+    ap.add_argument("--jitter-ms", type=float, default=50.0)
+    ap.add_argument("--fail-rate", type=float, default=0.0, help="share of ApiFree calls answered with 500")
+    ap.add_argument("--job-s", type=float, default=5.0, help="image/video generation time")
+    ap.add_argument("--stream-chunks", type=int, default=20)
+    ap.add_argument("--tg-latency-ms", type=float, default=30.0)
+    ap.add_argument("--tg-fail-rate", type=float, default=0.0, help="share of Telegram sends answered with 429")
+    ap.add_argument("--file-kb", type=int, default=512, help="size of result files")
+    args = ap.parse_args()
+    app = create_app(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        fail_rate=args.fail_rate,
+        job_s=args.job_s,
+        stream_chunks=args.stream_chunks,
+        tg_latency_ms=args.tg_latency_ms,
+        tg_fail_rate=args.tg_fail_rate,
+        file_kb=args.file_kb,
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""Offline load test: runs the bot against fake ApiFree/Telegram servers and reports latency.
+
+Starts scripts/fake_upstreams.py and `uvicorn app.main:app` (with a throwaway DB)
+as subprocesses, signs up --users users through the webhook, then replays a mix of
+webhook updates and Mini App API calls for --duration seconds and prints req/s and
+p50/p95/p99 per endpoint, plus the calls the app made to the fake upstreams.
+
+    python scripts/loadtest.py --duration 30 --concurrency 50 --latency-ms 300
+    python scripts/loadtest.py --mix webhook=1 --json result.json
+    python scripts/loadtest.py --ingest polling   # updates via getUpdates instead of the webhook
+
+App settings (TG_GLOBAL_RATE, UPDATE_WORKERS, CHAT_CACHE_MODELS, ...) can be
+overridden through the environment as usual.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOK_SECRET = "bench"
+DEFAULT_MIX = "webhook=4,me=3,chat=2,chat_stream=1,image=1,health=1"
+
+# Settings that make the app measure itself instead of Telegram's limits; any of
+# them can be overridden from the environment.
+APP_DEFAULTS = {
+    "FREE_CREDITS_ON_SIGNUP": "1000000",
+    "TG_GLOBAL_RATE": "10000",
+    "TG_PER_CHAT_RATE": "1000",
+    "TG_PER_CHAT_BURST": "1000",
+    "APIFREE_HTTP2": "false",
+    "CHAT_STREAM_EDIT_INTERVAL_S": "0.5",
+    "JOB_POLL_MIN_S": "1",
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+async def _wait_ready(url: str, timeout_s: float = 30.0):
+    deadline = time.monotonic() + timeout_s
+    async with httpx.AsyncClient(timeout=2.0) as c:
+        while time.monotonic() < deadline:
+            try:
+                if (await c.get(url)).status_code < 500:
+                    return
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up in {timeout_s}s")
+
+
+class LoadTest:
+    def __init__(self, app_url: str, users: int, mix: Dict[str, int], chat_prompts: int, updates_url: Optional[str] = None):
+        self.app_url = app_url
+        # where "webhook" traffic goes: the app's webhook, or the fake Telegram's getUpdates queue
+        self.updates_url = updates_url or f"{app_url}/telegram/webhook/{WEBHOOK_SECRET}"
+        self.user_ids = [100000 + i for i in range(users)]
+        self.scenarios = list(mix)
+        self.weights = [mix[k] for k in self.scenarios]
+        self.chat_prompts = chat_prompts
+        self.update_ids = itertools.count(1)
+        self.submit_ids = itertools.count(1)  # unique submit bodies: identical ones are replayed (IDEMPOTENCY_WINDOW_S)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.client: Optional[httpx.AsyncClient] = None
+
+    def _update(self, tg_id: int, text: str) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": tg_id, "type": "private"},
+                "from": {"id": tg_id, "is_bot": False, "first_name": f"bench{tg_id}", "username": f"bench{tg_id}"},
+                "text": text,
+            },
+        }
+
+    def _prompt(self) -> str:
+        # a small pool of prompts so CHAT_CACHE_MODELS (if enabled) sees repeats
+        return f"benchmark question {random.randrange(self.chat_prompts)}"
+
+    async def _record(self, name: str, coro):
+        t = time.perf_counter()
+        try:
+            r = await coro
+            if r.status_code >= 400:
+                self.errors[name] += 1
+        except httpx.HTTPError:
+            self.errors[name] += 1
+        self.latencies[name].append(time.perf_counter() - t)
+
+    async def _stream(self, path: str, payload: dict) -> httpx.Response:
+        async with self.client.stream("POST", path, json=payload) as r:
+            async for _ in r.aiter_bytes():
+                pass
+            return r
+
+    async def signup(self):
+        await asyncio.gather(*(self.client.post(self.updates_url, json=self._update(u, "/start")) for u in self.user_ids))
+        # /start is handled after the webhook acks; don't measure against half-created users
+        await _drain(self.app_url, timeout_s=30.0, updates_url=self.updates_url)
+
+    async def one(self, scenario: str):
+        tg_id = random.choice(self.user_ids)
+        if scenario == "webhook":
+            coro = self.client.post(self.updates_url, json=self._update(tg_id, self._prompt()))
+        elif scenario == "me":
+            coro = self.client.get("/api/me", params={"tg_id": tg_id})
+        elif scenario == "chat":
+            coro = self.client.post("/api/chat", json={"tg_id": tg_id, "text": self._prompt()})
+        elif scenario == "chat_stream":
+            coro = self._stream("/api/chat", {"tg_id": tg_id, "text": self._prompt(), "stream": True})
+        elif scenario == "image":
+            coro = self.client.post("/api/image/submit", json={"tg_id": tg_id, "prompt": f"a cat #{next(self.submit_ids)}", "deliver_to_tg": True})
+        elif scenario == "video":
+            coro = self.client.post("/api/video/submit", json={"tg_id": tg_id, "prompt": f"a cat #{next(self.submit_ids)}", "deliver_to_tg": True})
+        elif scenario == "image_dup":
+            # the same body per user: after the first submit these are duplicate taps, answered as replays
+            coro = self.client.post("/api/image/submit", json={"tg_id": tg_id, "prompt": "a cat", "deliver_to_tg": True})
+        elif scenario == "health":
+            coro = self.client.get("/health")
+        else:
+            raise ValueError(f"unknown scenario {scenario!r}")
+        await self._record(scenario, coro)
+
+    async def _worker(self, until: float):
+        while time.monotonic() < until:
+            await self.one(random.choices(self.scenarios, self.weights)[0])
+
+    async def run(self, duration_s: float, concurrency: int) -> float:
+        limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+        async with httpx.AsyncClient(base_url=self.app_url, timeout=60.0, limits=limits) as self.client:
+            await self.signup()
+            started = time.monotonic()
+            until = started + duration_s
+            await asyncio.gather(*(self._worker(until) for _ in range(concurrency)))
+            return time.monotonic() - started
+
+    def report(self, elapsed_s: float) -> Dict[str, dict]:
+        out = {}
+        for name in sorted(self.latencies):
+            values = sorted(self.latencies[name])
+            out[name] = {
+                "count": len(values),
+                "errors": self.errors[name],
+                "rps": round(len(values) / elapsed_s, 1),
+                "p50_ms": round(percentile(values, 50) * 1000, 1),
+                "p95_ms": round(percentile(values, 95) * 1000, 1),
+                "p99_ms": round(percentile(values, 99) * 1000, 1),
+                "max_ms": round(values[-1] * 1000, 1),
+            }
+        return out
+
+
+async def _drain(app_url: str, timeout_s: float, updates_url: Optional[str] = None):
+    """Wait until the app has handled queued updates, finished its jobs and sent queued messages."""
+    deadline = time.monotonic() + timeout_s
+    async with httpx.AsyncClient(base_url=app_url, timeout=5.0) as c:
+        while time.monotonic() < deadline:
+            h = (await c.get("/health")).json()
+            idle = not h.get("updates_queue") and not h.get("tg_queue") and not any((h.get("jobs_pending") or {}).values())
+            if idle and updates_url and updates_url.endswith("/_updates"):
+                # polling mode: also wait until the app has fetched and confirmed every update
+                idle = not (await c.get(updates_url)).json()["pending"]
+            if idle:
+                return
+            await asyncio.sleep(0.25)
+
+
+def _print_table(results: Dict[str, dict], elapsed_s: float, upstream: Dict[str, int]):
+    total = sum(r["count"] for r in results.values())
+    print(f"\n{total} requests in {elapsed_s:.1f}s ({total / elapsed_s:.1f} req/s)\n")
+    print(f"{'endpoint':<14}{'count':>8}{'errors':>8}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, r in results.items():
+        print(f"{name:<14}{r['count']:>8}{r['errors']:>8}{r['rps']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}{r['max_ms']:>9}")
+    if upstream:
+        print("\nupstream calls:")
+        for name in sorted(upstream):
+            print(f"  {name:<28}{upstream[name]:>8}")
+
+
+def _parse_mix(spec: str) -> Dict[str, int]:
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip():
+            mix[name.strip()] = int(weight or 1)
+    return mix
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--duration", type=float, default=20.0, help="seconds of load after signup")
+    ap.add_argument("--concurrency", type=int, default=20, help="concurrent virtual clients")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="scenario weights: webhook,me,chat,chat_stream,image,image_dup,video,health")
+    ap.add_argument("--chat-prompts", type=int, default=50, help="distinct chat prompts in rotation")
+    ap.add_argument("--latency-ms", default="200", help="fake ApiFree mean latency")
+    ap.add_argument("--fail-rate", default="0", help="fake ApiFree failure share")
+    ap.add_argument("--job-s", default="3", help="fake image/video generation time")
+    ap.add_argument("--tg-latency-ms", default="30")
+    ap.add_argument("--tg-fail-rate", default="0", help="fake Telegram 429 share")
+    ap.add_argument("--app-workers", default="1", help="uvicorn --workers for the app")
+    ap.add_argument("--callbacks", action="store_true", help="ApiFree pushes finished jobs to /apifree/callback instead of being polled")
+    ap.add_argument("--ingest", choices=("webhook", "polling"), default="webhook", help="how the app receives updates")
+    ap.add_argument("--json", help="also write the results to this file")
+    args = ap.parse_args()
+
+    fake_port, app_port = _free_port(), _free_port()
+    fake_url, app_url = f"http://127.0.0.1:{fake_port}", f"http://127.0.0.1:{app_port}"
+    tmp = tempfile.mkdtemp(prefix="loadtest-")
+    env = dict(os.environ)
+    for key, value in APP_DEFAULTS.items():
+        env.setdefault(key, value)
+    env.update(
+        BOT_TOKEN="bench:token",
+        APIFREE_API_KEY="bench",
+        APIFREE_BASE_URL=fake_url,
+        TG_API_BASE_URL=fake_url,
+        PUBLIC_BASE_URL=app_url,
+        WEBHOOK_SECRET=WEBHOOK_SECRET,
+        DB_PATH=os.path.join(tmp, "app.db"),
+        ADMIN_IDS="",
+        TG_UPDATES_MODE=args.ingest,
+        TG_POLL_TIMEOUT_S="5",
+        APP_PROCESSES=args.app_workers,
+    )
+    if args.callbacks:
+        env["APIFREE_CALLBACK_SECRET"] = "bench-callback"
+
+    procs = [
+        subprocess.Popen([
+            sys.executable, os.path.join(ROOT, "scripts", "fake_upstreams.py"),
+            "--port", str(fake_port),
+            "--latency-ms", args.latency_ms,
+            "--fail-rate", args.fail_rate,
+            "--job-s", args.job_s,
+            "--tg-latency-ms", args.tg_latency_ms,
+            "--tg-fail-rate", args.tg_fail_rate,
+        ], cwd=ROOT),
+        subprocess.Popen([
+            sys.executable, "-m", "uvicorn", "app.main:app",
+            "--host", "127.0.0.1", "--port", str(app_port),
+            "--workers", args.app_workers, "--log-level", "warning", "--no-access-log",
+        ], cwd=ROOT, env=env),
+    ]
+
+    async def _main():
+        await _wait_ready(f"{fake_url}/_stats")
+        await _wait_ready(f"{app_url}/health")
+        updates_url = f"{fake_url}/_updates" if args.ingest == "polling" else None
+        lt = LoadTest(app_url, args.users, _parse_mix(args.mix), args.chat_prompts, updates_url)
+        elapsed = await lt.run(args.duration, args.concurrency)
+        results = lt.report(elapsed)
+        await _drain(app_url, timeout_s=30.0, updates_url=updates_url)
+        async with httpx.AsyncClient() as c:
+            upstream = (await c.get(f"{fake_url}/_stats")).json()
+        return results, elapsed, upstream
+
+    try:
+        results, elapsed, upstream = asyncio.run(_main())
+    finally:
+        for p in procs:
+            p.terminate()
+        for p in procs:
+            try:
+                p.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+    _print_table(results, elapsed, upstream)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"elapsed_s": elapsed, "endpoints": results, "upstream": upstream, "args": vars(args)}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()